@@ -0,0 +1,117 @@
+"""Compiled annotation indices shared by the dataset constructors.
+
+Parsing the raw CelebA text annotations (or the AFLW/Chimps/300W `.mat` files) takes
+several seconds and happens for every dataset construction.  The functions here store
+the parsed arrays in a versioned `.npz` file next to the dataset, which is rebuilt
+whenever one of the source files is modified (or the index version is bumped).  The
+same mechanism is used for manifests of large image directories, which are rebuilt
+when the directory itself is modified.
+"""
+import os
+import hashlib
+import numpy as np
+from pathlib import Path
+
+# Bump this whenever the layout of any of the compiled indices changes
+ANNO_CACHE_VERSION = 1
+
+# Indices loaded in the current process (e.g. train, val and evaluation datasets)
+_loaded = {}
+
+
+def source_mtimes(sources):
+    return np.array([os.stat(str(x)).st_mtime for x in sources], dtype=np.float64)
+
+
+def load_annotation_index(name, sources, builder, cache_dir, use_cache=True):
+    """Return the arrays produced by `builder`, compiling them to disk on first use.
+
+    Args:
+        name (str): a unique name for the index (used as the file name).
+        sources (list[str]): the annotation files that the index is built from. Their
+            modification times are used to invalidate stale indices.
+        builder (callable): returns a dict of numpy arrays (no object arrays).
+        cache_dir (str): the directory in which the compiled index is stored.
+        use_cache (bool :: True): if False, always parse the sources directly.
+
+    Returns:
+        (dict): the compiled arrays, keyed by name.
+    """
+    if not use_cache:
+        return builder()
+
+    cache_path = Path(cache_dir) / "{}.npz".format(name)
+    mtimes = source_mtimes(sources)
+    key = str(cache_path)
+    if key in _loaded and np.array_equal(_loaded[key][0], mtimes):
+        return _loaded[key][1]
+
+    index = None
+    if cache_path.exists():
+        with np.load(str(cache_path)) as stored:
+            fresh = (int(stored["__version__"]) == ANNO_CACHE_VERSION
+                     and np.array_equal(stored["__mtimes__"], mtimes))
+            if fresh:
+                index = {k: stored[k] for k in stored.files if not k.startswith("__")}
+
+    if index is None:
+        index = builder()
+        try:
+            cache_path.parent.mkdir(exist_ok=True, parents=True)
+            tmp_path = cache_path.with_suffix(".tmp-{}".format(os.getpid()))
+            with open(str(tmp_path), "wb") as f:
+                np.savez(f, __version__=np.array(ANNO_CACHE_VERSION),
+                         __mtimes__=mtimes, **index)
+            os.replace(str(tmp_path), str(cache_path))
+            print("compiled annotation index to {}".format(cache_path))
+        except OSError as exc:
+            print("could not write annotation index to {} ({})".format(cache_path, exc))
+
+    _loaded[key] = (mtimes, index)
+    return index
+
+
+def file_manifest(directory, suffix, cache_dir, use_cache=True, sizes=False,
+                  checksums=False):
+    """Return the sorted names of the files in `directory` ending with `suffix`.
+
+    Listing a large directory (particularly on a network filesystem) can take minutes,
+    so the listing is stored as an annotation index.  It is invalidated by the
+    modification time of the directory, which changes whenever files are added,
+    removed or renamed (but not when the contents of a file are edited).
+
+    Args:
+        directory (str): the directory to be listed (non-recursively).
+        suffix (str): only file names ending with this suffix are kept (e.g. ".jpg").
+        cache_dir (str): the directory in which the manifest is stored.
+        use_cache (bool :: True): if False, always list the directory.
+        sizes (bool :: False): whether to also record the file sizes in bytes.
+        checksums (bool :: False): whether to also record the md5 digest of each
+            file (this reads every file when the manifest is built).
+
+    Returns:
+        (dict): "names" holds the sorted file names as a fixed-width byte string
+            array, alongside "sizes" (int64) and "checksums" (hex digests) if
+            requested.
+    """
+    def builder():
+        names = sorted(x.name for x in os.scandir(str(directory))
+                       if x.name.endswith(suffix))
+        manifest = {"names": np.array(names, dtype=np.string_)}
+        paths = [os.path.join(str(directory), x) for x in names]
+        if sizes:
+            manifest["sizes"] = np.array([os.stat(x).st_size for x in paths],
+                                         dtype=np.int64)
+        if checksums:
+            digests = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    digests.append(hashlib.md5(f.read()).hexdigest())
+            manifest["checksums"] = np.array(digests, dtype=np.string_)
+        return manifest
+
+    name = "manifest-{}{}{}{}".format(Path(directory).name, suffix.replace(".", "-"),
+                                      "-sizes" if sizes else "",
+                                      "-checksums" if checksums else "")
+    return load_annotation_index(name=name, sources=[directory], builder=builder,
+                                 cache_dir=cache_dir, use_cache=use_cache)
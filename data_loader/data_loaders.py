@@ -10,22 +10,42 @@ ipy data_loader/data_loaders.py -- \
 
 ipy data_loader/data_loaders.py -- \
         --dataset Chimps
+
+ipy data_loader/data_loaders.py -- \
+        --dataset MAFLAligned \
+        --fast_decode_check
+
+ipy data_loader/data_loaders.py -- \
+        --dataset ThreeHundredW \
+        --crop_check
 """
 import numpy as np
 import pandas as pd
 import os
+import json
 from PIL import Image
 from utils import tps
-import glob
 import torch
 from os.path import join as pjoin
-from utils.util import label_colormap
-from utils.util import pad_and_crop
+from utils.util import label_colormap, pad_and_crop, decode_name
 from scipy.io import loadmat
 from torchvision import transforms
 import torchvision.transforms.functional as TF
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler
+try:
+    from torch.utils.data.dataset import IterableDataset
+    HAS_ITERABLE_DATASET = True
+except ImportError:
+    # torch<1.2 has no streaming datasets, so `CelebAShards` is unavailable (this
+    # stand-in keeps `isinstance(dataset, IterableDataset)` checks valid)
+    class IterableDataset(Dataset):
+        pass
+    HAS_ITERABLE_DATASET = False
 from data_loader.augmentations import get_composed_augmentations
+from data_loader.anno_cache import load_annotation_index, file_manifest
+from data_loader.shards import ShardIndex
+from data_loader import tensor_transforms
 
 from io import BytesIO
 import sys
@@ -62,11 +82,25 @@ class PcaAug(object):
 
 
 class JPEGNoise(object):
-    def __init__(self, low=30, high=99):
+    """Rescale an image by a random factor, JPEG compress it at a random quality and
+    resize it back.
+
+    With `fast=True`, the encoder round trip is replaced by the blockwise DCT
+    quantisation of `tensor_transforms.JPEGNoise` (see `misc/check_jpeg_noise.py` for
+    a comparison of the two), while still accepting and returning PIL images.
+    """
+
+    def __init__(self, low=30, high=99, fast=False):
         self.low = low
         self.high = high
+        self.fast = fast
+        if fast:
+            self.tensor_noise = tensor_transforms.JPEGNoise(low, high)
 
     def __call__(self, im):
+        if self.fast:
+            x = self.tensor_noise(to_uint8_tensor(im).float().div_(255))
+            return TF.to_pil_image(x.mul(255).round_().byte())
         H = im.height
         W = im.width
         rW = max(int(0.8 * W), int(W * (1 + 0.5 * torch.randn([]))))
@@ -79,6 +113,36 @@ class JPEGNoise(object):
         return im
 
 
+def draft_crop_resize(im, crop, imwidth):
+    """Crop and resize an image, decoding JPEGs at a reduced resolution where possible.
+
+    Equivalent to `Resize(imwidth)(TF.crop(im, *crop))`, except that libjpeg is asked
+    (via `Image.draft`) to perform DCT-domain downscaling by the largest power of two
+    that still leaves the cropped region at least `imwidth` pixels across.  The crop
+    and the final resize are then applied in a single resampling pass.
+
+    Args:
+        im (PIL.Image): an image that has been opened, but not yet loaded.
+        crop (tuple): the (top, left, height, width) crop in full resolution pixels.
+        imwidth (int): the size of the smaller edge of the output.
+
+    Returns:
+        (PIL.Image): the cropped and resized RGB image.
+    """
+    top, left, height, width = crop
+    if height <= width:
+        out_size = (int(imwidth * width / height), imwidth)
+    else:
+        out_size = (imwidth, int(imwidth * height / width))
+    full_w, full_h = im.size
+    requested = (int(np.ceil(full_w * out_size[0] / width)),
+                 int(np.ceil(full_h * out_size[1] / height)))
+    im.draft("RGB", requested)
+    sx, sy = im.size[0] / full_w, im.size[1] / full_h
+    box = (left * sx, top * sy, (left + width) * sx, (top + height) * sy)
+    return im.convert("RGB").resize(out_size, Image.BILINEAR, box=box)
+
+
 def kp_normalize(H, W, kp):
     kp = kp.clone()
     kp[..., 0] = 2. * kp[..., 0] / (W - 1) - 1
@@ -86,40 +150,295 @@ def kp_normalize(H, W, kp):
     return kp
 
 
+def to_uint8_tensor(im):
+    """Convert an RGB PIL image to a C x H x W uint8 tensor (tensors are returned
+    as they are)."""
+    if torch.is_tensor(im):
+        return im
+    return torch.from_numpy(np.array(im, dtype=np.uint8)).permute(2, 0, 1).contiguous()
+
+
+def to_float_tensor(im):
+    """Convert an RGB PIL image (or a C x H x W uint8 tensor) to the C x H x W float
+    tensor with values in [0, 255] expected by the warpers."""
+    if torch.is_tensor(im):
+        return im.float()
+    return TF.to_tensor(im) * 255
+
+
+def compact_metadata(dataset):
+    """Store the per-image metadata of `dataset` as flat numpy arrays.
+
+    Forked DataLoader workers update the reference counts of every Python object they
+    read, which copies the memory pages holding lists of strings (or of keypoint
+    arrays) into each worker.  A fixed-width byte string array or a contiguous float32
+    array is a single object, so its pages remain shared between the workers.  Names
+    are utf-8 encoded (a numpy unicode array would spend four bytes per character),
+    so they should be read with `decode_name`.
+    """
+    for name in ("filenames", "im_list"):
+        val = getattr(dataset, name, None)
+        if val is not None and not (isinstance(val, np.ndarray) and val.dtype.kind == "S"):
+            names = [decode_name(x).encode() for x in val]
+            setattr(dataset, name, np.array(names, dtype=np.string_))
+    if getattr(dataset, "keypoints", None) is not None:
+        dataset.keypoints = np.ascontiguousarray(dataset.keypoints, dtype=np.float32)
+    if getattr(dataset, "bounding_boxes", None) is not None:
+        dataset.bounding_boxes = np.ascontiguousarray(dataset.bounding_boxes)
+
+
+class RepeatSampler(Sampler):
+    """Shuffle `num_items` indices, each repeated so that an epoch has `num_samples`
+    samples (equivalent to shuffling a dataset tiled up to that length, without
+    materialising the copies)."""
+
+    def __init__(self, num_items, num_samples):
+        self.num_items = num_items
+        self.num_samples = num_samples
+
+    def __iter__(self):
+        repeats = -(-self.num_samples // self.num_items)
+        indices = torch.arange(self.num_items).repeat(repeats)[:self.num_samples]
+        return iter(indices[torch.randperm(self.num_samples)].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def tensor_pipeline(tx):
+    """Convert a `transforms.Compose` of the training augmentations into the
+    equivalent `tensor_transforms.Compose`, which operates on uint8 image tensors."""
+    out = [tensor_transforms.ToFloat()]
+    for t in tx.transforms:
+        if isinstance(t, transforms.ToTensor):
+            continue
+        elif isinstance(t, transforms.Normalize):
+            out.append(tensor_transforms.Normalize(t.mean, t.std))
+        elif isinstance(t, transforms.ColorJitter):
+            # newer torchvision versions store the (min, max) range of the factor
+            spread = [x[1] - 1 if isinstance(x, (tuple, list)) else x
+                      for x in (t.brightness, t.contrast, t.saturation)]
+            hue = t.hue[1] if isinstance(t.hue, (tuple, list)) else t.hue
+            if hue:
+                raise NotImplementedError("No tensor version of hue jitter in {}".format(t))
+            out.append(tensor_transforms.ColorJitter(*spread))
+        elif isinstance(t, JPEGNoise):
+            # the tensor pipeline always uses the DCT quantisation, configured as
+            # for the fast PIL transform where one was requested
+            if t.fast:
+                out.append(t.tensor_noise)
+            else:
+                out.append(tensor_transforms.JPEGNoise(t.low, t.high))
+        elif isinstance(t, PcaAug):
+            out.append(tensor_transforms.PcaAug(t.alpha))
+        else:
+            raise NotImplementedError("No tensor version of {}".format(t))
+    return tensor_transforms.Compose(out)
+
+
+def apply_transforms(tx, im):
+    """Apply either kind of transform pipeline to a PIL image or uint8 tensor."""
+    if isinstance(tx, tensor_transforms.Compose):
+        if not torch.is_tensor(im):
+            im = to_uint8_tensor(im)
+        return tx(im)
+    if torch.is_tensor(im):
+        im = TF.to_pil_image(im)
+    return tx(im)
+
+
+def batch_transforms(tx, ims):
+    """Apply a per-sample `transforms.Compose` to a B x C x H x W uint8 batch.
+
+    Tensor pipelines (see `tensor_pipeline`) are applied to the whole batch on its
+    current device, as are pipelines that only consist of `ToTensor` and `Normalize`.
+    Otherwise each image is passed through the PIL transforms on the CPU.
+    """
+    if isinstance(tx, tensor_transforms.Compose):
+        return tx(ims)
+    if all(isinstance(t, (transforms.ToTensor, transforms.Normalize))
+           for t in tx.transforms):
+        ims = ims.float() / 255
+        for t in tx.transforms:
+            if isinstance(t, transforms.Normalize):
+                mean = torch.tensor(t.mean, device=ims.device).reshape(1, -1, 1, 1)
+                std = torch.tensor(t.std, device=ims.device).reshape(1, -1, 1, 1)
+                ims = (ims - mean) / std
+        return ims
+    out = [tx(TF.to_pil_image(im)) for im in ims.cpu()]
+    return torch.stack(out).to(ims.device)
+
+
+def select_payload(meta, payload):
+    """Keep only the `meta` fields listed in `payload` (all of them if it is None).
+
+    Warped pairs otherwise ship `im1`, `im2` and `flow` alongside `data`, doubling the
+    number of bytes passed between the DataLoader workers and the trainer.  The
+    payload should list the fields needed by the loss, metrics and visualizations
+    (e.g. ["grid", "index"] for the dense correlation losses).
+    """
+    if payload is None:
+        return meta
+    return {key: val for key, val in meta.items() if key in payload}
+
+
+def warp_collated_batch(dataset, batch, device=None):
+    """Warp a minibatch collated from a dataset constructed with `batch_warp=True`.
+
+    Produces the same "data" and "meta" entries as the per-sample warping path of
+    `__getitem__`, but with a single call to the warper for the whole minibatch.
+
+    Args:
+        dataset (Dataset): the dataset that produced the batch.
+        batch (dict): the collated batch of uint8 images (and raw keypoints).
+        device (torch.device): where the warping should take place (defaults to the
+            device of the batch).
+
+    Returns:
+        (dict): the warped minibatch.
+    """
+    ims = batch["data"]
+    if device is not None:
+        ims = ims.to(device, non_blocking=True)
+    index = batch["meta"]["index"]
+    kp = batch["meta"].get("keypts", None) if dataset.use_keypoints else None
+    warper = dataset.warper
+
+    if warper.returns_pairs:
+        im1, im2, flow, grid, kp1, kp2 = warper.warp_batch(ims.float(), keypts=kp,
+                                                           crop=dataset.crop)
+        im1 = batch_transforms(dataset.transforms, im1.to(torch.uint8))
+        im2 = batch_transforms(dataset.transforms, im2.to(torch.uint8))
+        B, C, H, W = im1.shape
+        data = torch.stack((im1, im2), 1).reshape(-1, C, H, W)
+        meta = {'flow': flow, 'grid': grid, 'im1': im1, 'im2': im2, 'index': index}
+        if dataset.use_keypoints:
+            meta = {**meta, **{'kp1': kp1, 'kp2': kp2}}
+    else:
+        im1, kp = warper.warp_batch(ims.float(), keypts=kp, crop=dataset.crop)
+        data = batch_transforms(dataset.transforms, im1.to(torch.uint8))
+        B, C, H, W = data.shape
+        meta = {'index': index}
+        if dataset.use_keypoints:
+            meta = {**meta, **{'keypts': kp, 'keypts_normalized': kp_normalize(H, W, kp)}}
+    return {"data": data, "meta": select_payload(meta, dataset.payload)}
+
+
 class CelebABase(Dataset):
+    image_store = None
+    initial_crop = None
+    fast_decode = False
+    batch_warp = False
+    payload = None
+    repeat_sampler = None
+    decoded = None
 
     def __len__(self):
         return len(self.filenames)
 
     def restrict_annos(self, num):
+        """Keep only `num` annotated images for few-shot training.
+
+        The epoch length of the full dataset is preserved by `self.repeat_sampler`
+        (which should be passed to the DataLoader), rather than by tiling the
+        annotations.  The picked images are decoded once, here, so that forked
+        workers share the decoded copies.
+        """
         anno_count = len(self.filenames)
         pick = np.random.choice(anno_count, num, replace=False)
-        print(f"Picking annotation for images: {np.array(self.filenames)[pick].tolist()}")
+        picked = [decode_name(x) for x in np.array(self.filenames)[pick]]
+        print(f"Picking annotation for images: {picked}")
         # exit(0)
         repeat = int(anno_count // num)
-        self.filenames = np.tile(np.array(self.filenames)[pick], repeat)
-        self.keypoints = np.tile(self.keypoints[pick], (repeat, 1, 1))
-
+        self.filenames = np.array(self.filenames)[pick]
+        self.keypoints = np.ascontiguousarray(self.keypoints[pick])
+        self.repeat_sampler = RepeatSampler(num, num * repeat)
+        self.decoded = None
+        if getattr(self, "use_ims", True):
+            self.decoded = [self.load_image(ii) for ii in range(num)]
+
+    def open_image_store(self, image_store, initial_crop=None):
+        """Serve images from a store written by `data_loader.image_store`."""
+        from data_loader.image_store import PackedImageStore
+        self.image_store = PackedImageStore(image_store, imwidth=self.imwidth,
+                                            initial_crop=initial_crop,
+                                            subdir=self.subdir)
+
+    def load_image(self, index, as_tensor=False):
+        """Return the RGB image for `index` after the initial transforms.
+
+        If `as_tensor` is set, images served from an image store are returned as
+        (read-only) uint8 tensors viewing the memory map, rather than PIL copies.
+        """
+        if self.decoded is not None:
+            return self.decoded[index].copy()
+        name = decode_name(self.filenames[index])
+        if self.image_store is not None:
+            if as_tensor:
+                return self.image_store.get_tensor(name)
+            return self.image_store.get(name)
+        im = Image.open(os.path.join(self.subdir, name))
+        if self.fast_decode and self.initial_crop is not None:
+            return draft_crop_resize(im, self.initial_crop, self.imwidth)
+        return self.initial_transforms(im.convert("RGB"))
+
+    def fast_decode_check(self, num_ims=100, tol=2.):
+        """Bound the pixel differences between the draft and full decoding paths.
+
+        Args:
+            num_ims (int :: 100): the number of images to compare.
+            tol (float :: 2.): the largest allowed mean absolute difference (in
+                uint8 intensity levels) for any single image.
+        """
+        assert self.initial_crop is not None, "draft decoding requires a fixed crop"
+        diffs = []
+        for index in np.linspace(0, len(self) - 1, num_ims).astype(int):
+            path = os.path.join(self.subdir, decode_name(self.filenames[index]))
+            ref = self.initial_transforms(Image.open(path).convert("RGB"))
+            fast = draft_crop_resize(Image.open(path), self.initial_crop, self.imwidth)
+            assert ref.size == fast.size, "{} vs {}".format(ref.size, fast.size)
+            diff = np.abs(np.asarray(ref, dtype=np.float32)
+                          - np.asarray(fast, dtype=np.float32))
+            diffs.append(diff.mean())
+        msg = "draft decoding: mean abs diff {:.3f}, worst image {:.3f} (tol {})"
+        print(msg.format(np.mean(diffs), np.max(diffs), tol))
+        assert np.max(diffs) <= tol, "draft decoding differs from the reference path"
+
+    def warp_batch(self, batch, device=None):
+        return warp_collated_batch(self, batch, device=device)
 
     def __getitem__(self, index):
         if (not self.use_ims and not self.use_keypoints):
             # early exit when caching is used
             return {"data": torch.zeros(3, 1, 1), "meta": {"index": index}}
 
+        im = None
         if self.use_ims:
-            im = Image.open(os.path.join(self.subdir, self.filenames[index]))
+            # the warping paths consume tensors, so they can skip the PIL copy
+            im = self.load_image(index, as_tensor=self.warper is not None)
         # print("imread: {:.3f}s".format(time.time() - tic)) ; tic = time.time()
         kp = None
         if self.use_keypoints:
             kp = self.keypoints[index].copy()
+        return self.build_sample(index, im, kp)
+
+    def build_sample(self, index, im, kp):
+        """Warp and transform a loaded image (and its keypoints) into a sample."""
         meta = {}
 
+        if self.batch_warp and self.warper is not None and self.use_ims:
+            # warping and the subsequent transforms are applied to the collated
+            # minibatch by `warp_batch`
+            meta = {'index': index}
+            if self.use_keypoints:
+                meta['keypts'] = torch.tensor(kp)
+            return {"data": to_uint8_tensor(im), "meta": meta}
+
         if self.warper is not None:
             if self.warper.returns_pairs:
                 # tic = time.time()
-                im1 = self.initial_transforms(im.convert("RGB"))
+                im1 = to_float_tensor(im)
                 # print("tx1: {:.3f}s".format(time.time() - tic)) ; tic = time.time()
-                im1 = TF.to_tensor(im1) * 255
                 if False:
                     from utils.visualization import norm_range
                     plt.imshow(norm_range(im1).permute(1, 2, 0).cpu().numpy())
@@ -128,16 +447,8 @@ class CelebABase(Dataset):
                 im1, im2, flow, grid, kp1, kp2 = self.warper(im1, keypts=kp, crop=self.crop)
                 # print("warper: {:.3f}s".format(time.time() - tic)) ; tic = time.time()
 
-                im1 = im1.to(torch.uint8)
-                im2 = im2.to(torch.uint8)
-
-                C, H, W = im1.shape
-
-                im1 = TF.to_pil_image(im1)
-                im2 = TF.to_pil_image(im2)
-
-                im1 = self.transforms(im1)
-                im2 = self.transforms(im2)
+                im1 = apply_transforms(self.transforms, im1.to(torch.uint8))
+                im2 = apply_transforms(self.transforms, im2.to(torch.uint8))
                 # print("tx-2: {:.3f}s".format(time.time() - tic)) ; tic = time.time()
 
                 C, H, W = im1.shape
@@ -152,14 +463,11 @@ class CelebABase(Dataset):
                 if self.use_keypoints:
                     meta = {**meta, **{'kp1': kp1, 'kp2': kp2}}
             else:
-                im1 = self.initial_transforms(im.convert("RGB"))
-                im1 = TF.to_tensor(im1) * 255
+                im1 = to_float_tensor(im)
 
                 im1, kp = self.warper(im1, keypts=kp, crop=self.crop)
 
-                im1 = im1.to(torch.uint8)
-                im1 = TF.to_pil_image(im1)
-                im1 = self.transforms(im1)
+                im1 = apply_transforms(self.transforms, im1.to(torch.uint8))
 
 
                 C, H, W = im1.shape
@@ -173,7 +481,7 @@ class CelebABase(Dataset):
 
         else:
             if self.use_ims:
-                data = self.transforms(self.initial_transforms(im.convert("RGB")))
+                data = apply_transforms(self.transforms, im)
                 if self.crop != 0:
                     data = data[:, self.crop:-self.crop, self.crop:-self.crop]
                 C, H, W = data.shape
@@ -227,7 +535,7 @@ class CelebABase(Dataset):
             # else:
             #     ims = norm_range(make_grid(data)).permute(1, 2, 0).cpu().numpy()
             #     plt.imshow(ims)
-        return {"data": data, "meta": meta}
+        return {"data": data, "meta": select_payload(meta, self.payload)}
 
 
 class ProfileData(Dataset):
@@ -243,11 +551,16 @@ class ProfileData(Dataset):
 
 
 class IJBB(Dataset):
-    def __init__(self, root, imwidth, prototypes, **kwargs):
+    def __init__(self, root, imwidth, prototypes, anno_cache=True, **kwargs):
         self.root = root
         self.imwidth = imwidth
         self.prototypes = prototypes
-        self.im_list = sorted(glob.glob(str(Path(root) / "crop_det/*.jpg")))
+        self.im_dir = Path(root) / "crop_det"
+        # the image names are kept as a byte string array, rather than a list of
+        # python strings, to avoid copy-on-write duplication in DataLoader workers
+        manifest = file_manifest(self.im_dir, suffix=".jpg", use_cache=anno_cache,
+                                 cache_dir=Path(root) / "anno_cache")
+        self.im_list = manifest["names"]
         expected = 227630
         assert len(self.im_list) == expected, "expected {} images".format(expected)
         if prototypes:
@@ -259,7 +572,8 @@ class IJBB(Dataset):
                 "2782.jpg",
                 "1082.jpg",
             ]
-            self.im_list = [x for x in self.im_list if Path(x).name in prototype_list]
+            keep = np.isin(self.im_list, np.array(prototype_list, dtype=np.string_))
+            self.im_list = self.im_list[keep]
 
         normalize = transforms.Normalize(mean=[0.5084, 0.4224, 0.3769],
                                          std=[0.2599, 0.2371, 0.2323])
@@ -270,7 +584,7 @@ class IJBB(Dataset):
         self.transforms = transforms.Compose([transforms.ToTensor(), normalize])
 
     def __getitem__(self, index):
-        im_path = self.im_list[index]
+        im_path = str(self.im_dir / self.im_list[index].decode())
         im = Image.open(im_path).convert("RGB")
         data = self.transforms(self.initial_transforms(im))
         if False:
@@ -291,8 +605,12 @@ class AFLW(CelebABase):
 
     def __init__(self, root, imwidth, train, pair_warper, visualize=False, use_ims=True,
                  use_keypoints=False, do_augmentations=False, crop=0, use_minival=False,
-                 **kwargs):
+                 anno_cache=True, batch_warp=False, payload=None, tensor_augs=False,
+                 fast_jpeg=False, **kwargs):
         self.root = root
+        self.anno_cache = anno_cache
+        self.batch_warp = batch_warp
+        self.payload = payload
         self.crop = crop
         self.imwidth = imwidth
         self.use_ims = use_ims
@@ -327,12 +645,15 @@ class AFLW(CelebABase):
         # be fairly tolerant to this
         self.initial_transforms = transforms.Resize((self.imwidth, self.imwidth))
         augmentations = [
-            JPEGNoise(),
+            JPEGNoise(fast=fast_jpeg),
             transforms.transforms.ColorJitter(.4, .4, .4),
             transforms.ToTensor(),
             PcaAug()
         ] if (train and do_augmentations) else [transforms.ToTensor()]
         self.transforms = transforms.Compose(augmentations + [normalize])
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        compact_metadata(self)
 
     def load_dataset(self, data_dir):
         # borrowed from Tom and Ankush
@@ -340,11 +661,29 @@ class AFLW(CelebABase):
             load_subset = "train"
         else:
             load_subset = "test"
-        with open(pjoin(data_dir, 'aflw_{}_images.txt'.format(load_subset)), 'r') as f:
-            images = f.read().splitlines()
-        mat = loadmat(os.path.join(data_dir, 'aflw_' + load_subset + '_keypoints.mat'))
-        keypoints = mat['gt'][:, :, [1, 0]]
-        sizes = mat['hw']
+        images_path = pjoin(data_dir, 'aflw_{}_images.txt'.format(load_subset))
+        mat_path = os.path.join(data_dir, 'aflw_' + load_subset + '_keypoints.mat')
+
+        def builder():
+            with open(images_path, 'r') as f:
+                images = f.read().splitlines()
+            mat = loadmat(mat_path)
+            return {
+                "images": np.array(images, dtype=str),
+                "keypoints": mat['gt'][:, :, [1, 0]],
+                "sizes": mat['hw'],
+            }
+
+        annos = load_annotation_index(
+            name="aflw-{}".format(load_subset),
+            sources=[images_path, mat_path],
+            builder=builder,
+            cache_dir=os.path.join(data_dir, "anno_cache"),
+            use_cache=self.anno_cache,
+        )
+        images = annos["images"].tolist()
+        keypoints = annos["keypoints"]
+        sizes = annos["sizes"]
 
         # import ipdb; ipdb.set_trace()
         # if self.data.shape[0] == 19000:
@@ -368,8 +707,13 @@ class AFLW(CelebABase):
 class Chimps(CelebABase):
 
     def __init__(self, root, imwidth, train, pair_warper, visualize=False,
-                 use_keypoints=False, do_augmentations=False, crop=0, **kwargs):
+                 use_keypoints=False, do_augmentations=False, crop=0, anno_cache=True,
+                 batch_warp=False, payload=None, tensor_augs=False,
+                 fast_jpeg=False, **kwargs):
         self.root = root
+        self.anno_cache = anno_cache
+        self.batch_warp = batch_warp
+        self.payload = payload
         self.crop = crop
         self.imwidth = imwidth
         self.visualize = visualize
@@ -396,23 +740,44 @@ class Chimps(CelebABase):
         # be fairly tolerant to this
         self.initial_transforms = transforms.Resize((self.imwidth, self.imwidth))
         augmentations = [
-            JPEGNoise(),
+            JPEGNoise(fast=fast_jpeg),
             transforms.transforms.ColorJitter(.4, .4, .4),
             transforms.ToTensor(),
             PcaAug()
         ] if (train and do_augmentations) else [transforms.ToTensor()]
         self.transforms = transforms.Compose(augmentations + [normalize])
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        compact_metadata(self)
 
     def load_dataset(self, data_dir, subset):
         # borrowed from Tom and Ankush
-        with open(pjoin(data_dir, "filelist_face_images.txt"), "r") as f:
-            images = f.read().splitlines()
-        mat = loadmat(os.path.join(data_dir, 'keypoint_information.mat'))
-        keypoints = mat["f_keypoints"].reshape(-1, 5, 2)
-
-        with open(pjoin(data_dir, "im_sizes.txt"), "r") as f:
-            rows = [(x.split(",")) for x in f.read().splitlines()]
-            sizes = np.array([[int(x[0]), int(x[1])] for x in rows])
+        images_path = pjoin(data_dir, "filelist_face_images.txt")
+        mat_path = os.path.join(data_dir, 'keypoint_information.mat')
+        sizes_path = pjoin(data_dir, "im_sizes.txt")
+
+        def builder():
+            with open(images_path, "r") as f:
+                images = f.read().splitlines()
+            mat = loadmat(mat_path)
+            with open(sizes_path, "r") as f:
+                rows = [(x.split(",")) for x in f.read().splitlines()]
+            return {
+                "images": np.array(images, dtype=str),
+                "keypoints": mat["f_keypoints"].reshape(-1, 5, 2),
+                "sizes": np.array([[int(x[0]), int(x[1])] for x in rows]),
+            }
+
+        annos = load_annotation_index(
+            name="chimps",
+            sources=[images_path, mat_path, sizes_path],
+            builder=builder,
+            cache_dir=os.path.join(data_dir, "anno_cache"),
+            use_cache=self.anno_cache,
+        )
+        images = annos["images"].tolist()
+        keypoints = annos["keypoints"]
+        sizes = annos["sizes"]
 
         if subset in ['train', 'val']:
             # put the last 10 percent of the training aside for validation
@@ -439,7 +804,7 @@ class Chimps(CelebABase):
 class Helen(Dataset):
     def __init__(self, root, imwidth, train, visualize=False, thresh=0.5, rand_in=False,
                  crop2face=False, downsample_labels=0, break_preproc=False,
-                 restrict_to=0, restrict_seed=0, **kwargs):
+                 restrict_to=0, restrict_seed=0, image_store=None, **kwargs):
         self.root = root
         self.thresh = thresh
         self.break_preproc = break_preproc
@@ -510,17 +875,24 @@ class Helen(Dataset):
             label_w = self.imwidth // downsample_labels
         else:
             label_w = self.imwidth
+        self.label_width = label_w
         self.label_resizer = transforms.Resize((label_w, label_w),
                                                interpolation=Image.NEAREST)
         if self.break_preproc:
             normalize = transforms.Normalize(mean=[0, 0, 0], std=[1, 1, 1])
         self.transforms = transforms.Compose([transforms.ToTensor(), normalize])
         # transforms.Resize(self.imwidth),
-
-    def __getitem__(self, index):
-        im_path = Path(self.root) / "images/{}.jpg".format(self.im_list[index])
-        im = Image.open(im_path).convert("RGB")
-        name = Path(im_path).stem
+        self.image_store = None
+        if image_store is not None:
+            from data_loader.image_store import PackedImageStore
+            self.image_store = PackedImageStore(image_store, imwidth=self.imwidth,
+                                                label_width=label_w, thresh=thresh,
+                                                subdir=self.root)
+        compact_metadata(self)
+
+    def decode_sample(self, name):
+        """Return the resized image and fused (resized) label map for `name`."""
+        im = Image.open(Path(self.root) / "images/{}.jpg".format(name)).convert("RGB")
         anno_template = str(Path(self.root) / "labels/{}/{}_lbl{:02d}.png")
         seg = np.zeros((im.size[1], im.size[0]), dtype=np.uint8)
         # for ii in range(10, 0, -1):
@@ -540,8 +912,17 @@ class Helen(Dataset):
         #     im, seg = self.augs(im, seg)
 
         seg = self.label_resizer(seg)
-        seg = torch.from_numpy(np.array(seg))
-        data = self.resizer(im)
+        return self.resizer(im), np.array(seg)
+
+    def __getitem__(self, index):
+        name = decode_name(self.im_list[index])
+        im_path = Path(self.root) / "images/{}.jpg".format(name)
+        if self.image_store is not None:
+            data = self.image_store.get(name)
+            seg = self.image_store.get_labels(name)
+        else:
+            data, seg = self.decode_sample(name)
+        seg = torch.from_numpy(seg)
         data = self.transforms(data)
 
         if False:
@@ -580,16 +961,62 @@ class Helen(Dataset):
         return len(self.im_list)
 
 
+def celeba_annotations(root, anno_cache=True):
+    """Return the CelebA landmarks together with the CelebA and MAFL partitions.
+
+    The returned `mafl` array marks MAFL training images with 1 and MAFL test images
+    with 2 (all other images are 0).
+    """
+    anno_path = os.path.join(root, 'Anno', 'list_landmarks_align_celeba.txt')
+    split_path = os.path.join(root, 'Eval', 'list_eval_partition.txt')
+    mafltrain_path = os.path.join(root, 'MAFL', 'training.txt')
+    mafltest_path = os.path.join(root, 'MAFL', 'testing.txt')
+
+    def builder():
+        anno = pd.read_csv(anno_path, header=1, delim_whitespace=True)
+        assert len(anno.index) == 202599
+        split = pd.read_csv(split_path, header=None, delim_whitespace=True, index_col=0)
+        assert len(split.index) == 202599
+        assert (split.index == anno.index).all(), "expected matching image orderings"
+        mafltrain = pd.read_csv(mafltrain_path, header=None, delim_whitespace=True,
+                                index_col=0)
+        mafltest = pd.read_csv(mafltest_path, header=None, delim_whitespace=True,
+                               index_col=0)
+        mafl = np.zeros(len(split.index), dtype=np.int8)
+        mafl[split.index.get_indexer(mafltrain.index)] = 1
+        mafl[split.index.get_indexer(mafltest.index)] = 2
+        # lefteye_x lefteye_y ; righteye_x righteye_y ; nose_x nose_y ;
+        # leftmouth_x leftmouth_y ; rightmouth_x rightmouth_y
+        return {
+            "filenames": np.array(anno.index, dtype=str),
+            "keypoints": np.array(anno, dtype=np.float32).reshape(-1, 5, 2),
+            "partition": np.array(split[1], dtype=np.int8),
+            "mafl": mafl,
+        }
+
+    return load_annotation_index(
+        name="celeba",
+        sources=[anno_path, split_path, mafltrain_path, mafltest_path],
+        builder=builder,
+        cache_dir=os.path.join(root, "anno_cache"),
+        use_cache=anno_cache,
+    )
+
+
 class CelebAPrunedAligned_MAFLVal(CelebABase):
     eye_kp_idxs = [0, 1]
 
     def __init__(self, root, train=True, pair_warper=None, imwidth=100, crop=18,
                  do_augmentations=True, use_keypoints=False, use_hq_ims=True,
                  visualize=False, use_ims=True, val_split="celeba", val_size=2000,
-                 **kwargs):
+                 image_store=None, anno_cache=True, fast_decode=False, batch_warp=False,
+                 payload=None, tensor_augs=False, fast_jpeg=False, **kwargs):
         self.root = root
         self.imwidth = imwidth
         self.train = train
+        self.fast_decode = fast_decode
+        self.batch_warp = batch_warp
+        self.payload = payload
         self.use_ims = use_ims
         self.warper = pair_warper
         self.visualize = visualize
@@ -602,46 +1029,35 @@ class CelebAPrunedAligned_MAFLVal(CelebABase):
             subdir = "img_align_celeba"
         self.subdir = os.path.join(root, 'Img', subdir)
 
-        anno = pd.read_csv(
-            os.path.join(root, 'Anno', 'list_landmarks_align_celeba.txt'), header=1,
-            delim_whitespace=True)
-        assert len(anno.index) == 202599
-        split = pd.read_csv(os.path.join(root, 'Eval', 'list_eval_partition.txt'),
-                            header=None, delim_whitespace=True, index_col=0)
-        assert len(split.index) == 202599
-
-        mafltrain = pd.read_csv(os.path.join(root, 'MAFL', 'training.txt'), header=None,
-                                delim_whitespace=True, index_col=0)
-        mafltest = pd.read_csv(os.path.join(root, 'MAFL', 'testing.txt'), header=None,
-                               delim_whitespace=True, index_col=0)
+        annos = celeba_annotations(root, anno_cache=anno_cache)
         # Ensure that we are not using mafl images
-        split.loc[mafltrain.index] = 3
-        split.loc[mafltest.index] = 4
+        split = annos["partition"].copy()
+        split[annos["mafl"] == 1] = 3
+        split[annos["mafl"] == 2] = 4
 
-        assert (split[1] == 4).sum() == 1000
+        assert (split == 4).sum() == 1000
 
         if train:
-            self.data = anno.loc[split[split[1] == 0].index]
+            keep = np.flatnonzero(split == 0)
         elif val_split == "celeba":
             # subsample images from CelebA val, otherwise training gets slow
-            self.data = anno.loc[split[split[1] == 2].index][:val_size]
+            keep = np.flatnonzero(split == 2)[:val_size]
         elif val_split == "mafl":
-            self.data = anno.loc[split[split[1] == 4].index]
+            keep = np.flatnonzero(split == 4)
 
-        # lefteye_x lefteye_y ; righteye_x righteye_y ; nose_x nose_y ;
-        # leftmouth_x leftmouth_y ; rightmouth_x rightmouth_y
-        self.keypoints = np.array(self.data, dtype=np.float32).reshape(-1, 5, 2)
-        self.filenames = list(self.data.index)
+        self.keypoints = annos["keypoints"][keep]
+        self.filenames = annos["filenames"][keep].tolist()
 
         # Move head up a bit
-        initial_crop = lambda im: transforms.functional.crop(im, 30, 0, 178, 178)
+        self.initial_crop = (30, 0, 178, 178)
+        initial_crop = lambda im: transforms.functional.crop(im, *self.initial_crop)
         self.keypoints[:, :, 1] -= 30
         self.keypoints *= self.imwidth / 178.
 
         normalize = transforms.Normalize(mean=[0.5084, 0.4224, 0.3769],
                                          std=[0.2599, 0.2371, 0.2323])
         augmentations = [
-            JPEGNoise(),
+            JPEGNoise(fast=fast_jpeg),
             transforms.transforms.ColorJitter(.4, .4, .4),
             transforms.ToTensor(),
             PcaAug()
@@ -650,9 +1066,11 @@ class CelebAPrunedAligned_MAFLVal(CelebABase):
         self.initial_transforms = transforms.Compose(
             [initial_crop, transforms.Resize(self.imwidth)])
         self.transforms = transforms.Compose(augmentations + [normalize])
-
-    def __len__(self):
-        return len(self.data.index)
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        if image_store is not None:
+            self.open_image_store(image_store, initial_crop=self.initial_crop)
+        compact_metadata(self)
 
 
 class MAFLAligned(CelebABase):
@@ -660,9 +1078,14 @@ class MAFLAligned(CelebABase):
 
     def __init__(self, root, train=True, pair_warper=None, imwidth=100, crop=18,
                  do_augmentations=True, use_keypoints=False, use_hq_ims=True,
-                 use_ims=True, visualize=False, **kwargs):
+                 use_ims=True, visualize=False, image_store=None, anno_cache=True,
+                 fast_decode=False, batch_warp=False, payload=None, tensor_augs=False,
+                 fast_jpeg=False, **kwargs):
         self.root = root
         self.imwidth = imwidth
+        self.fast_decode = fast_decode
+        self.batch_warp = batch_warp
+        self.payload = payload
         self.use_hq_ims = use_hq_ims
         self.use_ims = use_ims
         self.visualize = visualize
@@ -672,43 +1095,31 @@ class MAFLAligned(CelebABase):
         self.use_keypoints = use_keypoints
         subdir = "img_align_celeba_hq" if use_hq_ims else "img_align_celeba"
         self.subdir = os.path.join(root, 'Img', subdir)
-        annos_path = os.path.join(root, 'Anno', 'list_landmarks_align_celeba.txt')
-        anno = pd.read_csv(annos_path , header=1, delim_whitespace=True)
-
-        assert len(anno.index) == 202599
-        split = pd.read_csv(os.path.join(root, 'Eval', 'list_eval_partition.txt'),
-                            header=None, delim_whitespace=True, index_col=0)
-        assert len(split.index) == 202599
-        mafltest = pd.read_csv(os.path.join(root, 'MAFL', 'testing.txt'), header=None,
-                               delim_whitespace=True, index_col=0)
-        split.loc[mafltest.index] = 4
-        mafltrain = pd.read_csv(os.path.join(root, 'MAFL', 'training.txt'), header=None,
-                                delim_whitespace=True, index_col=0)
-        split.loc[mafltrain.index] = 5
-        assert (split[1] == 4).sum() == 1000
-        assert (split[1] == 5).sum() == 19000
+        annos = celeba_annotations(root, anno_cache=anno_cache)
+        assert (annos["mafl"] == 2).sum() == 1000
+        assert (annos["mafl"] == 1).sum() == 19000
 
         if train:
-            self.data = anno.loc[split[split[1] == 5].index]
+            keep = np.flatnonzero(annos["mafl"] == 1)
         else:
-            self.data = anno.loc[split[split[1] == 4].index]
+            keep = np.flatnonzero(annos["mafl"] == 2)
 
         # keypoint ordering
         # lefteye_x lefteye_y ; righteye_x righteye_y ; nose_x nose_y ;
         # leftmouth_x leftmouth_y ; rightmouth_x rightmouth_y
-        self.keypoints = np.array(self.data, dtype=np.float32).reshape(-1, 5, 2)
-        self.filenames = list(self.data.index)
+        self.keypoints = annos["keypoints"][keep]
+        self.filenames = annos["filenames"][keep].tolist()
 
         # Move head up a bit
         vertical_shift = 30
-        crop_params = dict(i=vertical_shift, j=0, h=178, w=178)
-        initial_crop = lambda im: transforms.functional.crop(im, **crop_params)
+        self.initial_crop = (vertical_shift, 0, 178, 178)
+        initial_crop = lambda im: transforms.functional.crop(im, *self.initial_crop)
         self.keypoints[:, :, 1] -= vertical_shift
         self.keypoints *= self.imwidth / 178.
         normalize = transforms.Normalize(mean=[0.5084, 0.4224, 0.3769],
                                          std=[0.2599, 0.2371, 0.2323])
         augmentations = [
-            JPEGNoise(),
+            JPEGNoise(fast=fast_jpeg),
             transforms.transforms.ColorJitter(.4, .4, .4),
             transforms.ToTensor(),
             PcaAug()
@@ -717,6 +1128,157 @@ class MAFLAligned(CelebABase):
         self.initial_transforms = transforms.Compose(
             [initial_crop, transforms.Resize(self.imwidth)])
         self.transforms = transforms.Compose(augmentations + [normalize])
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        if image_store is not None:
+            self.open_image_store(image_store, initial_crop=self.initial_crop)
+        compact_metadata(self)
+
+
+class CelebAShards(CelebABase, IterableDataset):
+    """Streaming counterpart of `CelebAPrunedAligned_MAFLVal`, which reads the
+    sequential shards written by `data_loader.shards` (see that module for details).
+
+    Each pass over the dataset visits the shards in a random order that is shared by
+    all processes, so that they can be split between distributed ranks and then
+    between DataLoader workers without overlap.  Every shard is read with a single
+    sequential read and its records are shuffled further with a buffer of
+    `shuffle_buffer` samples.  Training (`train=True`) streams `root/train`, otherwise
+    `root/val` is streamed in order.
+
+    NOTE: when used with DistributedDataParallel, `set_epoch` should be called before
+    every epoch so that all ranks agree on the shard order.
+
+    NOTE: this requires torch>=1.2 (for `IterableDataset` and `get_worker_info`).
+    """
+    eye_kp_idxs = [0, 1]
+
+    def __init__(self, root, train=True, pair_warper=None, imwidth=100, crop=18,
+                 do_augmentations=True, use_keypoints=False, visualize=False,
+                 use_ims=True, fast_decode=False, batch_warp=False, payload=None,
+                 tensor_augs=False,
+                 fast_jpeg=False, shuffle_buffer=1000, seed=0, **kwargs):
+        if not HAS_ITERABLE_DATASET:
+            msg = "CelebAShards requires torch>=1.2, found {}"
+            raise RuntimeError(msg.format(torch.__version__))
+        self.root = root
+        self.imwidth = imwidth
+        self.train = train
+        self.fast_decode = fast_decode
+        self.batch_warp = batch_warp
+        self.payload = payload
+        self.use_ims = use_ims
+        self.warper = pair_warper
+        self.visualize = visualize
+        self.crop = crop
+        self.use_keypoints = use_keypoints
+        self.shuffle = train
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = None
+        self.passes = 0
+
+        self.shards = ShardIndex(Path(root) / ("train" if train else "val"),
+                                 imwidth=imwidth)
+        self.filenames = self.shards.filenames
+        self.keypoints = self.shards.keypoints.copy()
+        self.initial_crop = tuple(self.shards.meta["initial_crop"])
+        initial_crop = lambda im: transforms.functional.crop(im, *self.initial_crop)
+
+        normalize = transforms.Normalize(mean=[0.5084, 0.4224, 0.3769],
+                                         std=[0.2599, 0.2371, 0.2323])
+        augmentations = [
+            JPEGNoise(fast=fast_jpeg),
+            transforms.transforms.ColorJitter(.4, .4, .4),
+            transforms.ToTensor(),
+            PcaAug()
+        ] if (train and do_augmentations) else [transforms.ToTensor()]
+
+        self.initial_transforms = transforms.Compose(
+            [initial_crop, transforms.Resize(self.imwidth)])
+        self.transforms = transforms.Compose(augmentations + [normalize])
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        compact_metadata(self)
+
+    def __len__(self):
+        # the shards are split between ranks, so this is the expected number of
+        # samples produced by each rank
+        return len(self.filenames) // self.world()[1]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def world():
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def decode(self, buf):
+        im = Image.open(BytesIO(buf))
+        if self.fast_decode:
+            return draft_crop_resize(im, self.initial_crop, self.imwidth)
+        return self.initial_transforms(im.convert("RGB"))
+
+    def load_image(self, index, as_tensor=False):
+        # shard records are always decoded, so there is no copy to avoid
+        return self.decode(self.shards.read(index))
+
+    def assigned_shards(self):
+        """Return the shards for this (rank, worker) pair and a seed for shuffling."""
+        info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        rank, world_size = self.world()
+        if self.epoch is not None:
+            seed = self.seed + self.epoch
+        elif info is not None:
+            # shared by all the workers of the current pass (but not across ranks)
+            seed = info.seed - info.id
+        else:
+            self.passes += 1
+            seed = self.seed + self.passes
+        order = np.arange(self.shards.num_shards)
+        if self.shuffle:
+            order = np.random.RandomState(seed % 2 ** 32).permutation(order)
+        slot, num_slots = rank * num_workers + worker_id, world_size * num_workers
+        if self.shards.num_shards < num_slots:
+            print("WARNING: {} shards cannot keep {} readers busy".format(
+                self.shards.num_shards, num_slots))
+        return order[slot::num_slots], seed + 7919 * (slot + 1)
+
+    def __iter__(self):
+        shards, seed = self.assigned_shards()
+        rng = np.random.RandomState(seed % 2 ** 32)
+        if not self.use_ims:
+            # no point reading the shards (e.g. after caching descriptors)
+            for shard in shards:
+                for index in self.shards.records(shard):
+                    yield self[index]
+            return
+
+        buffer = []
+        for shard in shards:
+            contents = self.shards.read_shard(shard)
+            records = self.shards.records(shard)
+            if self.shuffle:
+                records = rng.permutation(records)
+            for index in records:
+                record = (index, self.shards.record(contents, index))
+                if not self.shuffle:
+                    yield self.stream_sample(*record)
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(record)
+                else:
+                    pick = rng.randint(len(buffer))
+                    yield self.stream_sample(*buffer[pick])
+                    buffer[pick] = record
+        for pick in rng.permutation(len(buffer)):
+            yield self.stream_sample(*buffer[pick])
+
+    def stream_sample(self, index, buf):
+        kp = self.keypoints[index].copy() if self.use_keypoints else None
+        return self.build_sample(int(index), self.decode(buf), kp)
 
 
 class AFLW_MTFL(CelebABase):
@@ -730,7 +1292,11 @@ class AFLW_MTFL(CelebABase):
     eye_kp_idxs = [0, 1]
 
     def __init__(self, root, train=True, pair_warper=None, imwidth=70, use_ims=True,
-                 crop=0, do_augmentations=True, use_keypoints=False, visualize=False, **kwargs):
+                 crop=0, do_augmentations=True, use_keypoints=False, visualize=False,
+                 batch_warp=False, payload=None, tensor_augs=False,
+                 fast_jpeg=False, **kwargs):
+        self.batch_warp = batch_warp
+        self.payload = payload
         # MTFL from http://mmlab.ie.cuhk.edu.hk/projects/TCDCN/data/MTFL.zip
         self.test_root = os.path.join(root, 'MTFL')  
         # AFLW cropped from www.robots.ox.ac.uk/~jdt/aflw_10122train_cropped.zip
@@ -789,7 +1355,7 @@ class AFLW_MTFL(CelebABase):
         normalize = transforms.Normalize(mean=[0.5084, 0.4224, 0.3769],
                                          std=[0.2599, 0.2371, 0.2323])
         augmentations = [
-            JPEGNoise(),
+            JPEGNoise(fast=fast_jpeg),
             transforms.transforms.ColorJitter(.4, .4, .4),
             transforms.ToTensor(),
             PcaAug()
@@ -797,6 +1363,9 @@ class AFLW_MTFL(CelebABase):
         self.initial_transforms = transforms.Compose(
             [initial_crop, transforms.Resize(self.imwidth)])
         self.transforms = transforms.Compose(augmentations + [normalize])
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        compact_metadata(self)
 
 
 class ThreeHundredW(Dataset):
@@ -812,56 +1381,74 @@ class ThreeHundredW(Dataset):
     controlled environment and is too simple"
     """
     eye_kp_idxs = [36, 45]
+    # faces are scaled to `face_width` pixels and cropped to `preresize_sz` pixels,
+    # which are then resized to `imwidth`
+    face_width = 52
+    preresize_sz = 100
+    cached_images = None
 
     def __init__(self, root, train=True, pair_warper=None, imwidth=100, use_ims=True,
-                 crop=15, do_augmentations=True, use_keypoints=False, visualize=False, **kwargs):
-        from scipy.io import loadmat
-
+                 crop=15, do_augmentations=True, use_keypoints=False, visualize=False,
+                 anno_cache=True, batch_warp=False, payload=None, tensor_augs=False,
+                 fast_jpeg=False, crop_cache=None, **kwargs):
         self.root = root
         self.imwidth = imwidth
         self.train = train
         self.warper = pair_warper
+        self.batch_warp = batch_warp
+        self.payload = payload
         self.crop = crop
         self.use_ims = use_ims
         self.use_keypoints = use_keypoints
         self.visualize = visualize
 
-        afw = loadmat(os.path.join(root, 'Bounding Boxes/bounding_boxes_afw.mat'))
-        helentr = loadmat(os.path.join(root, 'Bounding Boxes/bounding_boxes_helen_trainset.mat'))
-        helente = loadmat(os.path.join(root, 'Bounding Boxes/bounding_boxes_helen_testset.mat'))
-        lfpwtr = loadmat(os.path.join(root, 'Bounding Boxes/bounding_boxes_lfpw_trainset.mat'))
-        lfpwte = loadmat(os.path.join(root, 'Bounding Boxes/bounding_boxes_lfpw_testset.mat'))
-        ibug = loadmat(os.path.join(root, 'Bounding Boxes/bounding_boxes_ibug.mat'))
-
-        self.filenames = []
-        self.bounding_boxes = []
-        self.keypoints = []
-
         if train:
-            datasets = [(afw, 'afw'), (helentr, 'helen/trainset'), (lfpwtr, 'lfpw/trainset')]
+            datasets = [('afw', 'afw'), ('helen_trainset', 'helen/trainset'),
+                        ('lfpw_trainset', 'lfpw/trainset')]
         else:
-            datasets = [(helente, 'helen/testset'), (lfpwte, 'lfpw/testset'), (ibug, 'ibug')]
-
-        for dset in datasets:
-            ds = dset[0]
-            ds_imroot = dset[1]
-            imnames = [ds['bounding_boxes'][0, i]['imgName'][0, 0][0] for i in range(ds['bounding_boxes'].shape[1])]
-            bbs = [ds['bounding_boxes'][0, i]['bb_ground_truth'][0, 0][0] for i in range(ds['bounding_boxes'].shape[1])]
-
-            for i, imn in enumerate(imnames):
-                # only some of the images given in ibug boxes exist (those that start with 'image')
-                if ds is not ibug or imn.startswith('image'):
-                    self.filenames.append(os.path.join(ds_imroot, imn))
-                    self.bounding_boxes.append(bbs[i])
-
-                    kpfile = os.path.join(root, ds_imroot, imn[:-3] + 'pts')
-                    with open(kpfile) as kpf:
-                        kp = kpf.read()
-                    kp = kp.split()[5:-1]
-                    kp = [float(k) for k in kp]
-                    assert len(kp) == 68 * 2
-                    kp = np.array(kp).astype(np.float32).reshape(-1, 2)
-                    self.keypoints.append(kp)
+            datasets = [('helen_testset', 'helen/testset'), ('lfpw_testset', 'lfpw/testset'),
+                        ('ibug', 'ibug')]
+        bb_template = os.path.join(root, 'Bounding Boxes/bounding_boxes_{}.mat')
+
+        def builder():
+            filenames, bounding_boxes, keypoints = [], [], []
+            for bb_name, ds_imroot in datasets:
+                ds = loadmat(bb_template.format(bb_name))
+                imnames = [ds['bounding_boxes'][0, i]['imgName'][0, 0][0] for i in range(ds['bounding_boxes'].shape[1])]
+                bbs = [ds['bounding_boxes'][0, i]['bb_ground_truth'][0, 0][0] for i in range(ds['bounding_boxes'].shape[1])]
+
+                for i, imn in enumerate(imnames):
+                    # only some of the images given in ibug boxes exist (those that start with 'image')
+                    if bb_name != 'ibug' or imn.startswith('image'):
+                        filenames.append(os.path.join(ds_imroot, imn))
+                        bounding_boxes.append(bbs[i])
+
+                        kpfile = os.path.join(root, ds_imroot, imn[:-3] + 'pts')
+                        with open(kpfile) as kpf:
+                            kp = kpf.read()
+                        kp = kp.split()[5:-1]
+                        kp = [float(k) for k in kp]
+                        assert len(kp) == 68 * 2
+                        kp = np.array(kp).astype(np.float32).reshape(-1, 2)
+                        keypoints.append(kp)
+            return {
+                "filenames": np.array(filenames, dtype=str),
+                "bounding_boxes": np.stack(bounding_boxes),
+                "keypoints": np.stack(keypoints),
+            }
+
+        # NOTE: the index is invalidated by the bounding box files, edits to the
+        # individual .pts files require the index to be removed by hand
+        annos = load_annotation_index(
+            name="300w-{}".format("train" if train else "test"),
+            sources=[bb_template.format(bb_name) for bb_name, _ in datasets],
+            builder=builder,
+            cache_dir=os.path.join(root, "anno_cache"),
+            use_cache=anno_cache,
+        )
+        self.filenames = annos["filenames"].tolist()
+        self.bounding_boxes = annos["bounding_boxes"]
+        self.keypoints = annos["keypoints"]
 
         if train:
             assert len(self.filenames) == 3148
@@ -869,11 +1456,16 @@ class ThreeHundredW(Dataset):
             assert len(self.filenames) == 689
 
         normalize = transforms.Normalize(mean=[0.5084, 0.4224, 0.3769], std=[0.2599, 0.2371, 0.2323])
-        augmentations = [JPEGNoise(), transforms.transforms.ColorJitter(.4, .4, .4),
+        augmentations = [JPEGNoise(fast=fast_jpeg),
+                         transforms.transforms.ColorJitter(.4, .4, .4),
                          transforms.ToTensor(), PcaAug()] if (train and do_augmentations) else [transforms.ToTensor()]
 
-        self.initial_transforms = transforms.Compose([transforms.Resize(self.imwidth)])
         self.transforms = transforms.Compose(augmentations + [normalize])
+        if tensor_augs:
+            self.transforms = tensor_pipeline(self.transforms)
+        if crop_cache is not None:
+            self.open_crop_cache(crop_cache)
+        compact_metadata(self)
 
         # print("HARDCODING DEBGGER")
         # self.filenames = self.filenames[:100]
@@ -882,12 +1474,13 @@ class ThreeHundredW(Dataset):
     def __len__(self):
         return len(self.filenames)
 
-    def __getitem__(self, index):
-        if self.use_ims:
-            im = Image.open(os.path.join(self.root, self.filenames[index])).convert("RGB")
-        # Crop bounding box
+    def warp_batch(self, batch, device=None):
+        return warp_collated_batch(self, batch, device=device)
+
+    def crop_geometry(self, index):
+        """Return the scale factor and (1-indexed) top-left corner of the face crop
+        in the rescaled image, following the original matlab preprocessing."""
         xmin, ymin, xmax, ymax = self.bounding_boxes[index]
-        keypts = self.keypoints[index]
 
         # This is basically copied from matlab code and assumes matlab indexing
         bw = xmax - xmin + 1
@@ -895,61 +1488,154 @@ class ThreeHundredW(Dataset):
         bcy = ymin + (bh + 1) / 2
         bcx = xmin + (bw + 1) / 2
 
-        # To simplify the preprocessing, we do two image resizes (can fix later if speed
-        # is an issue)
-        preresize_sz = 100
-
-        bw_ = 52  # make the (tightly cropped) face 52px
+        bw_ = self.face_width
         fac = bw_ / bw
-        if self.use_ims:
-            imr = im.resize((int(im.width * fac), int(im.height * fac)))
-
         bcx_ = int(np.floor(fac * bcx))
         bcy_ = int(np.floor(fac * bcy))
         bx = bcx_ - bw_ / 2 + 1
-        bX = bcx_ + bw_ / 2
         by = bcy_ - bw_ / 2 + 1
-        bY = bcy_ + bw_ / 2
-        pp = (preresize_sz - bw_) / 2
+        pp = (self.preresize_sz - bw_) / 2
         bx = int(bx - pp)
-        bX = int(bX + pp)
         by = int(by - pp - 2)
-        bY = int(bY + pp - 2)
-
-        if self.use_ims:
-            imr = pad_and_crop(np.array(imr), [(by - 1), bY, (bx - 1), bX])
-            im = Image.fromarray(imr)
+        return fac, bx, by
+
+    def crop_keypoints(self, index):
+        """Return the keypoints for `index` in (python style) output pixels."""
+        fac, bx, by = self.crop_geometry(index)
+        keypts = self.keypoints[index].copy() * fac
+        keypts[:, 0] = keypts[:, 0] - (bx - 1)
+        keypts[:, 1] = keypts[:, 1] - (by - 1)
+        keypts = keypts - 1  # from matlab to python style
+        return keypts * self.imwidth / self.preresize_sz
+
+    def crop_image(self, index):
+        """Return the imwidth x imwidth face crop for `index`.
+
+        The rescaling of the full image, the (zero padded) crop and the final resize
+        to `imwidth` are composed into a single affine map, so only the pixels inside
+        the crop are resampled (with antialiasing) in one pass.
+
+        NOTE: this intentionally changes the pixels relative to `reference_crop` (the
+        original preprocessing), whose first rescaling used PIL's default NEAREST
+        filter (Pillow<7), i.e. aliased crops.  `crop_check` bounds the difference.
+        """
+        path = os.path.join(self.root, decode_name(self.filenames[index]))
+        im = Image.open(path).convert("RGB")
+        fac, bx, by = self.crop_geometry(index)
+        scale = self.imwidth / self.preresize_sz
+        # the rescaled image is rounded down to whole pixels
+        fx = int(im.width * fac) / im.width
+        fy = int(im.height * fac) / im.height
+
+        # map the image extent to the output, keeping only whole output pixels
+        ox0 = max(0, int(np.ceil(-(bx - 1) * scale)))
+        oy0 = max(0, int(np.ceil(-(by - 1) * scale)))
+        ox1 = min(self.imwidth, int(np.floor((im.width * fx - (bx - 1)) * scale)))
+        oy1 = min(self.imwidth, int(np.floor((im.height * fy - (by - 1)) * scale)))
+
+        out = Image.new("RGB", (self.imwidth, self.imwidth))
+        if ox1 > ox0 and oy1 > oy0:
+            box = ((ox0 / scale + bx - 1) / fx, (oy0 / scale + by - 1) / fy,
+                   (ox1 / scale + bx - 1) / fx, (oy1 / scale + by - 1) / fy)
+            patch = im.resize((ox1 - ox0, oy1 - oy0), Image.BILINEAR, box=box)
+            out.paste(patch, (ox0, oy0))
+        return out
+
+    def reference_crop(self, index):
+        """Return the face crop for `index` computed by the original preprocessing:
+        a NEAREST rescale of the full image, a zero padded crop and a bilinear resize
+        to `imwidth`."""
+        path = os.path.join(self.root, decode_name(self.filenames[index]))
+        im = Image.open(path).convert("RGB")
+        fac, bx, by = self.crop_geometry(index)
+        imr = im.resize((int(im.width * fac), int(im.height * fac)), Image.NEAREST)
+        bX, bY = bx - 1 + self.preresize_sz, by - 1 + self.preresize_sz
+        imr = pad_and_crop(np.array(imr), [(by - 1), bY, (bx - 1), bX])
+        return transforms.Resize(self.imwidth)(Image.fromarray(imr))
+
+    def crop_check(self, num_ims=100, tol=8.):
+        """Bound the pixel differences between `crop_image` and the original
+        preprocessing (`reference_crop`).
+
+        Args:
+            num_ims (int :: 100): the number of images to compare.
+            tol (float :: 8.): the largest allowed mean absolute difference (in uint8
+                intensity levels) for any single image.  The difference is expected
+                to be non-zero, since the original path did not antialias.
+        """
+        diffs, worst = [], []
+        for index in np.linspace(0, len(self) - 1, num_ims).astype(int):
+            ref = np.asarray(self.reference_crop(index), dtype=np.float32)
+            out = np.asarray(self.crop_image(index), dtype=np.float32)
+            assert ref.shape == out.shape, "{} vs {}".format(ref.shape, out.shape)
+            diff = np.abs(ref - out)
+            diffs.append(diff.mean())
+            worst.append(np.percentile(diff, 99))
+        msg = ("300W crops: mean abs diff {:.3f}, worst image {:.3f}, "
+               "mean p99 pixel diff {:.1f} (tol {})")
+        print(msg.format(np.mean(diffs), np.max(diffs), np.mean(worst), tol))
+        assert np.max(diffs) <= tol, "300W crops differ from the reference path"
+
+    def open_crop_cache(self, cache_dir):
+        """Load (building them first if necessary) the face crops and keypoints."""
+        cache_dir = Path(cache_dir)
+        meta_path = cache_dir / "meta.json"
+        meta = {"imwidth": self.imwidth, "num_images": len(self.filenames)}
+        fresh = False
+        if meta_path.exists():
+            with open(meta_path, "r") as f:
+                fresh = json.load(f) == meta
+            names = np.load(str(cache_dir / "filenames.npy"))
+            fresh = fresh and names.tolist() == [decode_name(x) for x in self.filenames]
+        if not fresh:
+            cache_dir.mkdir(exist_ok=True, parents=True)
+            shape = (len(self.filenames), self.imwidth, self.imwidth, 3)
+            images = np.lib.format.open_memmap(str(cache_dir / "images.npy"),
+                                               mode="w+", dtype=np.uint8, shape=shape)
+            for ii in range(len(self.filenames)):
+                images[ii] = np.asarray(self.crop_image(ii))
+            images.flush()
+            del images
+            keypoints = np.stack([self.crop_keypoints(ii)
+                                  for ii in range(len(self.filenames))])
+            np.save(str(cache_dir / "keypoints.npy"), keypoints.astype(np.float32))
+            names = [decode_name(x) for x in self.filenames]
+            np.save(str(cache_dir / "filenames.npy"), np.array(names, dtype=str))
+            with open(meta_path, "w") as f:
+                json.dump(meta, f, indent=4)
+            print("cached {} 300W face crops to {}".format(len(self.filenames), cache_dir))
+        self.cached_images = np.load(str(cache_dir / "images.npy"), mmap_mode="r")
+        self.cached_keypoints = np.load(str(cache_dir / "keypoints.npy"))
 
-        cutl = bx - 1
-        keypts = keypts.copy() * fac
-        keypts[:, 0] = keypts[:, 0] - cutl
-        cutt = by - 1
-        keypts[:, 1] = keypts[:, 1] - cutt
+    def __getitem__(self, index):
+        if self.cached_images is not None:
+            if self.use_ims:
+                im = Image.fromarray(np.asarray(self.cached_images[index]), mode="RGB")
+            keypts = self.cached_keypoints[index].copy()
+        else:
+            if self.use_ims:
+                im = self.crop_image(index)
+            keypts = self.crop_keypoints(index) if self.use_keypoints else None
 
         kp = None
         if self.use_keypoints:
-            kp = keypts - 1  # from matlab to python style
-            kp = kp * self.imwidth / preresize_sz
-            kp = torch.tensor(kp)
+            kp = torch.tensor(keypts)
         meta = {}
 
+        if self.batch_warp and self.warper is not None and self.use_ims:
+            meta = {'index': index}
+            if self.use_keypoints:
+                meta['keypts'] = kp
+            return {"data": to_uint8_tensor(im), "meta": meta}
+
         if self.warper is not None:
             if self.warper.returns_pairs:
-                im1 = self.initial_transforms(im.convert("RGB"))
-                im1 = TF.to_tensor(im1) * 255
+                im1 = TF.to_tensor(im) * 255
 
                 im1, im2, flow, grid, kp1, kp2 = self.warper(im1, keypts=kp, crop=self.crop)
 
-                im1 = im1.to(torch.uint8)
-                im2 = im2.to(torch.uint8)
-
-                C, H, W = im1.shape
-
-                im1 = TF.to_pil_image(im1)
-                im2 = TF.to_pil_image(im2)
-
-                im1 = self.transforms(im1)
-                im2 = self.transforms(im2)
+                im1 = apply_transforms(self.transforms, im1.to(torch.uint8))
+                im2 = apply_transforms(self.transforms, im2.to(torch.uint8))
 
                 C, H, W = im1.shape
                 data = torch.stack((im1, im2), 0)
@@ -957,14 +1643,11 @@ class ThreeHundredW(Dataset):
                 if self.use_keypoints:
                     meta = {**meta, **{'kp1': kp1, 'kp2': kp2}}
             else:
-                im1 = self.initial_transforms(im.convert("RGB"))
-                im1 = TF.to_tensor(im1) * 255
+                im1 = TF.to_tensor(im) * 255
 
                 im1, kp = self.warper(im1, keypts=kp, crop=self.crop)
 
-                im1 = im1.to(torch.uint8)
-                im1 = TF.to_pil_image(im1)
-                im1 = self.transforms(im1)
+                im1 = apply_transforms(self.transforms, im1.to(torch.uint8))
 
                 C, H, W = im1.shape
                 data = im1
@@ -973,7 +1656,7 @@ class ThreeHundredW(Dataset):
 
         else:
             if self.use_ims:
-                data = self.transforms(self.initial_transforms(im.convert("RGB")))
+                data = apply_transforms(self.transforms, im)
                 if self.crop != 0:
                     data = data[:, self.crop:-self.crop, self.crop:-self.crop]
                 C, H, W = data.shape
@@ -1007,7 +1690,7 @@ class ThreeHundredW(Dataset):
                     ax.scatter(kp_x, kp_y)
             import ipdb; ipdb.set_trace()
 
-        return {"data": data, "meta": meta}
+        return {"data": data, "meta": select_payload(meta, self.payload)}
 
 
 if __name__ == '__main__':
@@ -1026,6 +1709,8 @@ if __name__ == '__main__':
     parser.add_argument("--downsample_labels", type=int, default=2)
     parser.add_argument("--show", type=int, default=2)
     parser.add_argument("--restrict_seed", type=int, default=0)
+    parser.add_argument("--fast_decode_check", action="store_true")
+    parser.add_argument("--crop_check", action="store_true")
     parser.add_argument("--root")
     args = parser.parse_args()
 
@@ -1067,7 +1752,15 @@ if __name__ == '__main__':
     show = args.show
     if args.restrict_to:
         show = min(args.restrict_to, show)
-    if args.dataset == "IJBB":
+    if args.fast_decode_check:
+        kwargs.update({"visualize": False, "pair_warper": None})
+        dataset = globals()[args.dataset](**kwargs)
+        dataset.fast_decode_check()
+    elif args.crop_check:
+        kwargs.update({"visualize": False, "pair_warper": None})
+        dataset = globals()[args.dataset](**kwargs)
+        dataset.crop_check()
+    elif args.dataset == "IJBB":
         dataset = IJBB('data/ijbb', prototypes=True, imwidth=128, train=False)
         for ii in range(show):
             dataset[ii]
@@ -0,0 +1,238 @@
+"""Pre-decoded, memory-mapped image stores for the CelebA family of datasets and Helen.
+
+Packing a store writes the cropped and resized uint8 images (i.e. the output of
+`initial_transforms`) for a given `imwidth` into a single `.npy` array that can be
+memory-mapped by every DataLoader worker, removing JPEG decoding and resizing from
+the per-sample path.  Helen stores additionally hold the fused, resized segmentation
+label maps, replacing the ten label images that are otherwise decoded per sample.
+
+python -m data_loader.image_store \
+        --root data/celeba \
+        --imwidth 100 \
+        --dest data/celeba/packed/imwidth100
+
+python -m data_loader.image_store \
+        --dataset Helen \
+        --root data/SmithCVPR2013_dataset_resized \
+        --imwidth 128 \
+        --dest data/SmithCVPR2013_dataset_resized/packed/imwidth128
+"""
+import json
+import time
+import argparse
+import torch
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from utils.util import decode_name
+
+IMAGES_NAME = "images.npy"
+LABELS_NAME = "labels.npy"
+INDEX_NAME = "filenames.npy"
+META_NAME = "meta.json"
+
+
+class PackedImageStore(object):
+    """Read-only view onto a packed image store.
+
+    Filenames are stored as a sorted fixed-width byte array, so lookups are a binary
+    search and the index does not create per-worker copies of Python strings.  Rows
+    of the image array are slices of the memory map: `get_tensor` returns them as
+    uint8 tensors without copying (for the warping and tensor pipelines), while `get`
+    copies them into a PIL image for the PIL transform pipelines that require one.
+
+    The name of the image directory the store was packed from is checked against
+    `subdir` (when given), so that e.g. a store of HQ images is not served to a
+    dataset configured with `use_hq_ims=False`.
+    """
+
+    def __init__(self, store_dir, imwidth=None, initial_crop=None, label_width=None,
+                 thresh=None, subdir=None):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / META_NAME, "r") as f:
+            self.meta = json.load(f)
+        requested = {
+            "imwidth": imwidth,
+            "initial_crop": None if initial_crop is None else list(initial_crop),
+            "label_width": label_width,
+            "thresh": thresh,
+        }
+        msg = "image store at {} was packed with {} {}, but {} was requested"
+        for key, val in requested.items():
+            if val is not None and self.meta.get(key) != val:
+                raise ValueError(msg.format(store_dir, key, self.meta.get(key), val))
+        # only the directory name is compared, so that stores remain valid when the
+        # data root is moved
+        packed = Path(self.meta.get("subdir", "")).name
+        if subdir is not None and packed != Path(subdir).name:
+            raise ValueError(msg.format(store_dir, "subdir", packed, Path(subdir).name))
+        self.images = np.load(str(self.store_dir / IMAGES_NAME), mmap_mode="r")
+        self.filenames = np.load(str(self.store_dir / INDEX_NAME))
+        self.labels = None
+        if (self.store_dir / LABELS_NAME).exists():
+            self.labels = np.load(str(self.store_dir / LABELS_NAME), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, name):
+        return self.row(name) is not None
+
+    def row(self, name):
+        key = np.array(name, dtype=self.filenames.dtype)
+        pos = np.searchsorted(self.filenames, key)
+        if pos < len(self.filenames) and self.filenames[pos] == key:
+            return int(pos)
+        return None
+
+    def _checked_row(self, name):
+        row = self.row(name)
+        if row is None:
+            raise KeyError("{} is not contained in {}".format(name, self.store_dir))
+        return row
+
+    def get_array(self, name):
+        """Return the (H x W x 3) uint8 memory-mapped slice for `name`."""
+        return self.images[self._checked_row(name)]
+
+    def get(self, name):
+        """Return a PIL copy of the image for `name`."""
+        return Image.fromarray(np.asarray(self.get_array(name)), mode="RGB")
+
+    def get_tensor(self, name):
+        """Return the (3 x H x W) uint8 tensor for `name`, sharing memory with the
+        memory map (it is read-only, so callers must not modify it in place)."""
+        return torch.from_numpy(self.get_array(name)).permute(2, 0, 1)
+
+    def get_labels(self, name):
+        """Return a copy of the (H x W) uint8 label map for `name`."""
+        assert self.labels is not None, "{} has no label maps".format(self.store_dir)
+        return np.array(self.labels[self._checked_row(name)])
+
+
+def pack_images(datasets, dest, log_interval=5000):
+    """Write the initial-transformed images for `datasets` into a single store.
+
+    Args:
+        datasets (list[CelebABase]): datasets sharing the same `subdir`, `imwidth`
+            and `initial_transforms` (e.g. the train and val splits).  The union of
+            their filenames is packed.
+        dest (str): the directory to which the store will be written.
+    """
+    ref = datasets[0]
+    for dataset in datasets:
+        assert dataset.subdir == ref.subdir, "datasets must share an image directory"
+        assert dataset.imwidth == ref.imwidth, "datasets must share an image width"
+
+    filenames = sorted(set(decode_name(x) for dataset in datasets
+                           for x in dataset.filenames))
+    dest = Path(dest)
+    dest.mkdir(exist_ok=True, parents=True)
+    shape = (len(filenames), ref.imwidth, ref.imwidth, 3)
+    images = np.lib.format.open_memmap(str(dest / IMAGES_NAME), mode="w+",
+                                       dtype=np.uint8, shape=shape)
+    tic = time.time()
+    for ii, fname in enumerate(filenames):
+        im = Image.open(str(Path(ref.subdir) / fname)).convert("RGB")
+        im = np.asarray(ref.initial_transforms(im))
+        msg = "expected packed image of shape {}, found {} for {}"
+        assert im.shape == shape[1:], msg.format(shape[1:], im.shape, fname)
+        images[ii] = im
+        if ii % log_interval == 0:
+            print("packed {}/{} images in {:.1f}s".format(ii, len(filenames),
+                                                          time.time() - tic))
+    images.flush()
+    del images
+    meta = {
+        "imwidth": ref.imwidth,
+        "initial_crop": list(ref.initial_crop),
+        "subdir": str(ref.subdir),
+    }
+    write_index(dest, filenames, meta)
+    print("wrote {} images to {} in {:.1f}s".format(len(filenames), dest,
+                                                     time.time() - tic))
+
+
+def pack_helen(datasets, dest, log_interval=500):
+    """Write the resized images and fused label maps for Helen datasets to a store.
+
+    Args:
+        datasets (list[Helen]): datasets sharing the same `root`, `imwidth`,
+            `downsample_labels` and `thresh` (e.g. the train and test splits).
+        dest (str): the directory to which the store will be written.
+    """
+    ref = datasets[0]
+    for dataset in datasets:
+        for attr in ("root", "imwidth", "label_width", "thresh"):
+            msg = "datasets must share the same {}".format(attr)
+            assert getattr(dataset, attr) == getattr(ref, attr), msg
+
+    names = sorted(set(decode_name(x) for dataset in datasets for x in dataset.im_list))
+    dest = Path(dest)
+    dest.mkdir(exist_ok=True, parents=True)
+    images = np.lib.format.open_memmap(
+        str(dest / IMAGES_NAME), mode="w+", dtype=np.uint8,
+        shape=(len(names), ref.imwidth, ref.imwidth, 3))
+    labels = np.lib.format.open_memmap(
+        str(dest / LABELS_NAME), mode="w+", dtype=np.uint8,
+        shape=(len(names), ref.label_width, ref.label_width))
+    tic = time.time()
+    for ii, name in enumerate(names):
+        im, seg = ref.decode_sample(name)
+        images[ii] = np.asarray(im)
+        labels[ii] = seg
+        if ii % log_interval == 0:
+            print("packed {}/{} images in {:.1f}s".format(ii, len(names),
+                                                          time.time() - tic))
+    images.flush()
+    labels.flush()
+    del images, labels
+    meta = {
+        "imwidth": ref.imwidth,
+        "initial_crop": None,
+        "label_width": ref.label_width,
+        "thresh": ref.thresh,
+        "subdir": str(ref.root),
+    }
+    write_index(dest, names, meta)
+    print("wrote {} images and label maps to {} in {:.1f}s".format(
+        len(names), dest, time.time() - tic))
+
+
+def write_index(dest, filenames, meta):
+    np.save(str(dest / INDEX_NAME), np.array(filenames, dtype=np.string_))
+    meta = {**meta, "num_images": len(filenames)}
+    with open(dest / META_NAME, "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+if __name__ == '__main__':
+    import data_loader.data_loaders as module_data
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default="CelebA", choices=["CelebA", "Helen"])
+    parser.add_argument("--root", default="data/celeba")
+    parser.add_argument("--imwidth", type=int, default=100)
+    parser.add_argument("--dest", required=True)
+    parser.add_argument("--use_hq_ims", type=int, default=1)
+    parser.add_argument("--downsample_labels", type=int, default=0)
+    parser.add_argument("--thresh", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.dataset == "Helen":
+        common = dict(root=args.root, imwidth=args.imwidth, thresh=args.thresh,
+                      downsample_labels=args.downsample_labels)
+        splits = [module_data.Helen(train=True, **common),
+                  module_data.Helen(train=False, **common)]
+        pack_helen(splits, dest=args.dest)
+    else:
+        common = dict(root=args.root, imwidth=args.imwidth,
+                      use_hq_ims=args.use_hq_ims, do_augmentations=False)
+        splits = [
+            module_data.CelebAPrunedAligned_MAFLVal(train=True, **common),
+            module_data.CelebAPrunedAligned_MAFLVal(train=False, val_split="celeba",
+                                                    val_size=None, **common),
+            module_data.MAFLAligned(train=True, **common),
+            module_data.MAFLAligned(train=False, **common),
+        ]
+        pack_images(splits, dest=args.dest)
@@ -0,0 +1,158 @@
+"""Sequential shard files for streaming the CelebA training images.
+
+Random reads of ~160k small JPEGs perform poorly on network and object-backed storage.
+A shard directory instead holds a handful of large files, each of which is the raw
+bytes of many image files concatenated back to back, together with a single index:
+
+    shard-00000.bin, shard-00001.bin, ...  (raw image file bytes)
+    index.npz                              (filenames, keypoints, shard, offset, length)
+    meta.json                              (format version, imwidth, crop, ...)
+
+Images are stored exactly as they appear on disk (no re-encoding), so they are decoded
+with the same `initial_transforms` (or draft decoding) as the original dataset.  The
+shards are consumed by `data_loader.data_loaders.CelebAShards`.
+
+python -m data_loader.shards \
+        --root data/celeba \
+        --imwidth 100 \
+        --dest data/celeba/shards/imwidth100
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from utils.util import decode_name
+
+SHARD_FORMAT_VERSION = 1
+INDEX_NAME = "index.npz"
+META_NAME = "meta.json"
+
+
+def shard_name(shard):
+    return "shard-{:05d}.bin".format(shard)
+
+
+class ShardIndex(object):
+    """Read-only view onto a directory of shards written by `write_shards`."""
+
+    def __init__(self, shard_dir, imwidth=None):
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir / META_NAME, "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != SHARD_FORMAT_VERSION:
+            msg = "shards at {} have format version {}, expected {}"
+            raise ValueError(msg.format(shard_dir, self.meta["version"],
+                                        SHARD_FORMAT_VERSION))
+        if imwidth is not None and self.meta["imwidth"] != imwidth:
+            msg = "shards at {} were written with imwidth {}, but {} was requested"
+            raise ValueError(msg.format(shard_dir, self.meta["imwidth"], imwidth))
+        with np.load(str(self.shard_dir / INDEX_NAME)) as index:
+            self.filenames = index["filenames"]
+            self.keypoints = index["keypoints"]
+            self.shard = index["shard"]
+            self.offset = index["offset"]
+            self.length = index["length"]
+        self.num_shards = self.meta["num_shards"]
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def records(self, shard):
+        """Return the indices of the records stored in `shard` (in file order)."""
+        return np.flatnonzero(self.shard == shard)
+
+    def read_shard(self, shard):
+        """Read an entire shard with a single sequential read."""
+        with open(str(self.shard_dir / shard_name(shard)), "rb") as f:
+            return f.read()
+
+    def record(self, buf, index):
+        """Return the bytes of record `index` from the contents of its shard."""
+        start = self.offset[index]
+        return buf[start:start + self.length[index]]
+
+    def read(self, index):
+        """Random access to a single record (e.g. for visualization)."""
+        with open(str(self.shard_dir / shard_name(self.shard[index])), "rb") as f:
+            f.seek(int(self.offset[index]))
+            return f.read(int(self.length[index]))
+
+
+def write_shards(dataset, dest, shard_bytes=256 * 2 ** 20, log_interval=10000):
+    """Pack the image files and keypoints of `dataset` into sequential shards.
+
+    Args:
+        dataset (CelebABase): the dataset to pack (its `keypoints` are stored as they
+            are, i.e. already scaled to its `imwidth`).
+        dest (str): the directory to which the shards will be written.
+        shard_bytes (int :: 256MiB): shards are closed once they reach this size.
+    """
+    dest = Path(dest)
+    dest.mkdir(exist_ok=True, parents=True)
+    shard, pos = 0, 0
+    shards, offsets, lengths = [], [], []
+    f = open(str(dest / shard_name(shard)), "wb")
+    tic = time.time()
+    for ii, fname in enumerate(dataset.filenames):
+        with open(os.path.join(dataset.subdir, decode_name(fname)), "rb") as g:
+            buf = g.read()
+        if pos and pos + len(buf) > shard_bytes:
+            f.close()
+            shard, pos = shard + 1, 0
+            f = open(str(dest / shard_name(shard)), "wb")
+        f.write(buf)
+        shards.append(shard)
+        offsets.append(pos)
+        lengths.append(len(buf))
+        pos += len(buf)
+        if ii % log_interval == 0:
+            print("packed {}/{} images in {:.1f}s".format(ii, len(dataset.filenames),
+                                                          time.time() - tic))
+    f.close()
+    np.savez(
+        str(dest / INDEX_NAME),
+        filenames=np.array(dataset.filenames, dtype=np.string_),
+        keypoints=np.asarray(dataset.keypoints, dtype=np.float32),
+        shard=np.array(shards, dtype=np.int32),
+        offset=np.array(offsets, dtype=np.int64),
+        length=np.array(lengths, dtype=np.int64),
+    )
+    meta = {
+        "version": SHARD_FORMAT_VERSION,
+        "imwidth": dataset.imwidth,
+        "initial_crop": list(dataset.initial_crop),
+        "num_shards": shard + 1,
+        "num_images": len(dataset.filenames),
+        "subdir": str(dataset.subdir),
+    }
+    with open(dest / META_NAME, "w") as f:
+        json.dump(meta, f, indent=4)
+    print("wrote {} images to {} shards in {} ({:.1f}s)".format(
+        len(dataset.filenames), shard + 1, dest, time.time() - tic))
+
+
+if __name__ == '__main__':
+    import data_loader.data_loaders as module_data
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default="data/celeba")
+    parser.add_argument("--imwidth", type=int, default=100)
+    parser.add_argument("--dest", required=True)
+    parser.add_argument("--use_hq_ims", type=int, default=1)
+    parser.add_argument("--val_size", type=int, default=2000)
+    parser.add_argument("--shard_mb", type=int, default=256)
+    args = parser.parse_args()
+
+    common = dict(root=args.root, imwidth=args.imwidth, use_hq_ims=args.use_hq_ims,
+                  do_augmentations=False)
+    splits = {
+        "train": module_data.CelebAPrunedAligned_MAFLVal(train=True, **common),
+        "val": module_data.CelebAPrunedAligned_MAFLVal(train=False, val_split="celeba",
+                                                       val_size=args.val_size,
+                                                       **common),
+    }
+    for split, dataset in splits.items():
+        write_shards(dataset, dest=Path(args.dest) / split,
+                     shard_bytes=args.shard_mb * 2 ** 20)
@@ -0,0 +1,279 @@
+"""Augmentations that operate directly on image tensors.
+
+These mirror the PIL based training transforms (JPEGNoise, ColorJitter, ToTensor,
+PcaAug, Normalize) but avoid the round trips between tensors and PIL images.  Every
+transform accepts either a single C x H x W image or a B x C x H x W minibatch, in
+which case independent random parameters are drawn for each sample.
+"""
+import math
+import random
+import torch
+import torch.nn.functional as F
+
+
+def _batched(fn):
+    """Allow a transform written for B x C x H x W tensors to accept C x H x W."""
+    def wrapper(self, im):
+        if im.dim() == 3:
+            return fn(self, im.unsqueeze(0)).squeeze(0)
+        return fn(self, im)
+    return wrapper
+
+
+class Compose(object):
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, im):
+        for t in self.transforms:
+            im = t(im)
+        return im
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.transforms)
+
+
+class ToFloat(object):
+    """uint8 images in [0, 255] -> float images in [0, 1] (cf. `ToTensor`)."""
+
+    def __call__(self, im):
+        return im.float().div_(255)
+
+
+class Normalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).reshape(-1, 1, 1)
+        self.std = torch.tensor(std).reshape(-1, 1, 1)
+
+    def __call__(self, im):
+        return (im - self.mean.to(im.device)) / self.std.to(im.device)
+
+
+def _factors(B, spread, device):
+    lo = max(0., 1. - spread)
+    return torch.empty(B, 1, 1, 1, device=device).uniform_(lo, 1. + spread)
+
+
+def _groups(keys):
+    """Map each distinct key to the indices (a LongTensor) of the samples that drew
+    it, so that a parameter which fixes the shape of an operation (or the order of
+    several) can be drawn per sample and applied per group."""
+    groups = {}
+    for ii, key in enumerate(keys):
+        groups.setdefault(key, []).append(ii)
+    return {key: torch.tensor(idx) for key, idx in groups.items()}
+
+
+def grayscale(im):
+    """ITU-R 601-2 luma transform, as used by PIL for "L" images."""
+    r, g, b = im[:, 0:1], im[:, 1:2], im[:, 2:3]
+    return 0.299 * r + 0.587 * g + 0.114 * b
+
+
+class ColorJitter(object):
+    """Tensor version of `transforms.ColorJitter` (without hue jitter).
+
+    Brightness, contrast and saturation are adjusted in a random order, with the same
+    blending operations as the `PIL.ImageEnhance` operations used by torchvision.
+    Both the factors and the order are drawn for each sample of a minibatch (the
+    samples that drew the same order are adjusted together).
+    """
+
+    def __init__(self, brightness=0, contrast=0, saturation=0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    @_batched
+    def __call__(self, im):
+        B = im.shape[0]
+        ops = []
+        if self.brightness:
+            bright = _factors(B, self.brightness, im.device)
+            ops.append(lambda x, idx: x * bright[idx])
+        if self.contrast:
+            cont = _factors(B, self.contrast, im.device)
+            def contrast(x, idx):
+                mean = grayscale(x).mean((1, 2, 3), keepdim=True)
+                return mean + cont[idx] * (x - mean)
+            ops.append(contrast)
+        if self.saturation:
+            sat = _factors(B, self.saturation, im.device)
+            def saturation(x, idx):
+                gray = grayscale(x)
+                return gray + sat[idx] * (x - gray)
+            ops.append(saturation)
+        orders = []
+        for _ in range(B):
+            order = list(range(len(ops)))
+            random.shuffle(order)
+            orders.append(tuple(order))
+        out = torch.empty_like(im)
+        for order, idx in _groups(orders).items():
+            idx = idx.to(im.device)
+            x = im[idx]
+            for ii in order:
+                x = ops[ii](x, idx).clamp_(0, 1)
+            out[idx] = x
+        return out
+
+
+class PcaAug(object):
+    _eigval = torch.Tensor([0.2175, 0.0188, 0.0045])
+    _eigvec = torch.Tensor([
+        [-0.5675, 0.7192, 0.4009],
+        [-0.5808, -0.0045, -0.8140],
+        [-0.5836, -0.6948, 0.4203],
+    ])
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+
+    @_batched
+    def __call__(self, im):
+        B = im.shape[0]
+        alpha = torch.randn(B, 1, 3) * self.alpha
+        rgb = (self._eigvec[None] * alpha * self._eigval[None, None]).sum(2)
+        return im + rgb.reshape(B, 3, 1, 1).to(im.device)
+
+
+# ---------------------------------------------------------
+# JPEG style compression noise
+# ---------------------------------------------------------
+# Standard (IJG) quantisation tables for the luminance and chrominance channels
+LUMA_TABLE = torch.Tensor([
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99],
+])
+CHROMA_TABLE = torch.Tensor([
+    [17, 18, 24, 47, 99, 99, 99, 99],
+    [18, 21, 26, 66, 99, 99, 99, 99],
+    [24, 26, 56, 99, 99, 99, 99, 99],
+    [47, 66, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+])
+# JFIF RGB <-> YCbCr (offsets are handled separately)
+RGB2YCBCR = torch.Tensor([
+    [0.299, 0.587, 0.114],
+    [-0.168736, -0.331264, 0.5],
+    [0.5, -0.418688, -0.081312],
+])
+YCBCR2RGB = torch.Tensor([
+    [1., 0., 1.402],
+    [1., -0.344136, -0.714136],
+    [1., 1.772, 0.],
+])
+
+
+def dct_matrix(n=8):
+    k = torch.arange(n, dtype=torch.float32).reshape(-1, 1)
+    i = torch.arange(n, dtype=torch.float32).reshape(1, -1)
+    D = torch.cos(math.pi * (2 * i + 1) * k / (2 * n)) * math.sqrt(2. / n)
+    D[0] = D[0] / math.sqrt(2.)
+    return D
+
+
+def quant_tables(quality):
+    """Return the B x 3 x 8 x 8 (Y, Cb, Cr) quantisation tables that libjpeg uses for
+    a tensor of B quality settings."""
+    quality = quality.float().clamp(1, 100).reshape(-1, 1, 1, 1)
+    scale = torch.where(quality < 50, 5000. / quality, 200. - 2 * quality)
+    tables = torch.stack((LUMA_TABLE, CHROMA_TABLE, CHROMA_TABLE))[None]
+    return torch.floor((tables * scale + 50) / 100).clamp(1, 255)
+
+
+def block_quantize(x, tables):
+    """Quantise the 8 x 8 block DCT coefficients of (level shifted) B x C x H x W
+    planes with B x C x 8 x 8 tables and return the reconstructed planes."""
+    B, C, H, W = x.shape
+    Hp, Wp = 8 * math.ceil(H / 8), 8 * math.ceil(W / 8)
+    if (Hp, Wp) != (H, W):
+        x = F.pad(x, (0, Wp - W, 0, Hp - H), mode="replicate")
+    blocks = x.reshape(B, C, Hp // 8, 8, Wp // 8, 8).permute(0, 1, 2, 4, 3, 5)
+    D = dct_matrix().to(x.device)
+    coeffs = torch.matmul(torch.matmul(D, blocks), D.t())
+    Q = tables.to(x.device)[:, :, None, None]
+    coeffs = torch.round(coeffs / Q) * Q
+    blocks = torch.matmul(torch.matmul(D.t(), coeffs), D)
+    return blocks.permute(0, 1, 2, 4, 3, 5).reshape(B, C, Hp, Wp)[:, :, :H, :W]
+
+
+def jpeg_quantize(im, tables, subsample=True):
+    """Apply blockwise DCT quantisation (the lossy step of JPEG) to images.
+
+    Args:
+        im (torch.Tensor): B x 3 x H x W images in [0, 1].
+        tables (torch.Tensor): B x 3 x 8 x 8 quantisation tables.
+        subsample (bool :: True): whether to quantise the chroma channels at half
+            resolution (4:2:0 subsampling, which is what PIL uses by default).
+
+    Returns:
+        (torch.Tensor): the B x 3 x H x W decompressed images.
+    """
+    B, C, H, W = im.shape
+    device = im.device
+    ycc = torch.einsum('ij,bjhw->bihw', RGB2YCBCR.to(device), im * 255)
+    ycc[:, 0] -= 128
+    if subsample:
+        luma = block_quantize(ycc[:, :1], tables[:, :1])
+        chroma = F.avg_pool2d(ycc[:, 1:], 2, ceil_mode=True)
+        chroma = block_quantize(chroma, tables[:, 1:])
+        chroma = F.interpolate(chroma, scale_factor=2, mode="bilinear",
+                               align_corners=False)[:, :, :H, :W]
+        ycc = torch.cat((luma, chroma), 1)
+    else:
+        ycc = block_quantize(ycc, tables)
+    ycc[:, 0] += 128
+    rgb = torch.einsum('ij,bjhw->bihw', YCBCR2RGB.to(device), ycc)
+    return (rgb / 255).clamp(0, 1)
+
+
+class JPEGNoise(object):
+    """Tensor version of the PIL `JPEGNoise` augmentation: images are rescaled by a
+    random factor, JPEG quantised at a random quality and resized back.  The factor
+    and the quality are drawn for each sample of a minibatch (the samples that drew
+    the same rescaled width are processed together).
+
+    Args:
+        low, high (int): the range [low, high) from which qualities are drawn.
+        subsample (bool :: True): see `jpeg_quantize`.
+        cache_tables (bool :: True): whether to compute the quantisation tables for
+            every quality in the range once, rather than for every call.
+    """
+
+    def __init__(self, low=30, high=99, subsample=True, cache_tables=True):
+        self.low = low
+        self.high = high
+        self.subsample = subsample
+        self.tables = None
+        if cache_tables:
+            self.tables = quant_tables(torch.arange(low, high))
+
+    def quality_tables(self, quality):
+        if self.tables is None:
+            return quant_tables(quality)
+        return self.tables[quality - self.low]
+
+    @_batched
+    def __call__(self, im):
+        B, C, H, W = im.shape
+        widths = [max(int(0.8 * W), int(W * (1 + 0.5 * r))) for r in torch.randn(B)]
+        quality = torch.randint(self.low, self.high, (B,))
+        out = torch.empty_like(im)
+        for rW, idx in _groups(widths).items():
+            x = F.interpolate(im[idx.to(im.device)], size=(rW, rW), mode="bilinear",
+                              align_corners=False)
+            x = jpeg_quantize(x, self.quality_tables(quality[idx]),
+                              subsample=self.subsample)
+            out[idx.to(im.device)] = F.interpolate(x, size=(H, W), mode="bilinear",
+                                                   align_corners=False)
+        return out
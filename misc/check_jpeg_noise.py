@@ -0,0 +1,104 @@
+"""Compare the tensor JPEG noise augmentation against the PIL encoder round trip.
+
+python -m misc.check_jpeg_noise \
+    --images data/celeba/Img/img_align_celeba \
+    --num_images 200 \
+    --imwidth 100
+
+Two comparisons are made on the same images:
+  1. at fixed qualities, the PSNR of a PIL JPEG encode/decode against that of
+     `tensor_transforms.jpeg_quantize` (with and without chroma subsampling);
+  2. the distribution of the PSNR (relative to the clean image) produced by the full
+     `JPEGNoise` augmentation, for the PIL and fast implementations, together with
+     their throughput.
+The check fails if the mean PSNR of the two augmentations differs by more than `--tol`.
+"""
+import io
+import time
+import argparse
+import numpy as np
+import torch
+from pathlib import Path
+from PIL import Image
+import data_loader.tensor_transforms as tensor_transforms
+from data_loader.data_loaders import JPEGNoise, to_uint8_tensor
+
+
+def psnr(x, y):
+    mse = ((x.float() - y.float()) ** 2).mean().item()
+    return 10 * np.log10(255. ** 2 / max(mse, 1e-10))
+
+
+def pil_round_trip(im, quality):
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=quality)
+    return Image.open(buf).convert("RGB")
+
+
+def tensor_round_trip(im, quality, subsample):
+    x = to_uint8_tensor(im).float().div_(255)[None]
+    tables = tensor_transforms.quant_tables(torch.tensor([quality]))
+    x = tensor_transforms.jpeg_quantize(x, tables, subsample=subsample)[0]
+    return x.mul(255).round_().byte()
+
+
+def summarise(vals):
+    vals = np.array(vals)
+    return "mean {:6.2f} p10 {:6.2f} p50 {:6.2f} p90 {:6.2f}".format(
+        vals.mean(), *np.percentile(vals, [10, 50, 90]))
+
+
+def load_images(image_dir, num_images, imwidth):
+    paths = sorted(x for x in Path(image_dir).iterdir()
+                   if x.suffix.lower() in {".jpg", ".jpeg", ".png"})[:num_images]
+    assert paths, "no images found in {}".format(image_dir)
+    return [Image.open(str(x)).convert("RGB").resize((imwidth, imwidth),
+                                                     Image.BILINEAR)
+            for x in paths]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", required=True, help="a directory of images")
+    parser.add_argument("--num_images", type=int, default=200)
+    parser.add_argument("--imwidth", type=int, default=100)
+    parser.add_argument("--draws", type=int, default=5,
+                        help="the number of augmentations drawn per image")
+    parser.add_argument("--tol", type=float, default=1.,
+                        help="the allowed difference in mean PSNR (dB)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ims = load_images(args.images, args.num_images, args.imwidth)
+    print("fixed quality PSNR (dB) over {} images:".format(len(ims)))
+    for quality in (30, 50, 70, 90):
+        ref = [psnr(to_uint8_tensor(pil_round_trip(im, quality)), to_uint8_tensor(im))
+               for im in ims]
+        line = "q={:2d} PIL {:6.2f}".format(quality, np.mean(ref))
+        for subsample in (True, False):
+            vals = [psnr(tensor_round_trip(im, quality, subsample), to_uint8_tensor(im))
+                    for im in ims]
+            line += " | tensor (subsample={}) {:6.2f}".format(subsample, np.mean(vals))
+        print(line)
+
+    results = {}
+    for name, fast in (("PIL", False), ("fast", True)):
+        torch.manual_seed(args.seed)
+        noise = JPEGNoise(fast=fast)
+        vals = []
+        tic = time.perf_counter()
+        for im in ims:
+            for _ in range(args.draws):
+                vals.append(psnr(to_uint8_tensor(noise(im)), to_uint8_tensor(im)))
+        elapsed = time.perf_counter() - tic
+        results[name] = vals
+        print("JPEGNoise {:<4s} PSNR {} ({:.3f} ms per image)".format(
+            name, summarise(vals), 1000 * elapsed / len(vals)))
+
+    diff = abs(np.mean(results["PIL"]) - np.mean(results["fast"]))
+    print("difference in mean PSNR: {:.2f}dB".format(diff))
+    assert diff <= args.tol, "fast JPEGNoise deviates from the PIL augmentation"
+
+
+if __name__ == "__main__":
+    main()
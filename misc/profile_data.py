@@ -0,0 +1,282 @@
+"""Profile the stages of the data pipeline for any dataset and warper configuration.
+
+python -m misc.profile_data \
+    --config configs/celeba/smallnet-64d-dve.json \
+    --num_samples 500 \
+    --workers 8 \
+    --json data/profiles/celeba-smallnet-64d-dve.json
+
+Every sample is produced by the dataset's own `__getitem__`, while the building blocks
+it relies on (file reads, decoding, the initial transforms, the TPS warper functions
+and each of the augmentations) are wrapped with timers.  Time that is not covered by
+any of the wrapped stages is reported as "other".  Collation is timed separately on
+minibatches of the produced samples.
+
+With `--workers N`, the memory of N DataLoader workers is also measured (on Linux),
+reporting both their resident set size and the part of it that is private to each
+worker (i.e. pages that are no longer shared with the parent after forking).
+"""
+import io
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from pathlib import Path
+from collections import defaultdict, OrderedDict
+from torch.utils.data import DataLoader
+import data_loader.data_loaders as module_data
+from data_loader.data_loaders import IterableDataset
+from utils import tps, get_instance, dict_coll, coll
+from utils.util import read_json
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.times = defaultdict(list)
+        self.current = defaultdict(float)
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            tic = time.perf_counter()
+            out = func(*args, **kwargs)
+            self.current[name] += time.perf_counter() - tic
+            return out
+        return timed
+
+    def end_sample(self, total):
+        covered = sum(self.current.values())
+        self.current["other"] += max(0., total - covered)
+        self.current["total"] = total
+        for name, val in self.current.items():
+            self.times[name].append(val)
+        self.current.clear()
+
+    def summary(self, num_samples):
+        stats = OrderedDict()
+        for name, vals in self.times.items():
+            # stages that do not run for every sample count as zero time
+            vals = np.array(vals + [0.] * (num_samples - len(vals))) * 1000
+            stats[name] = {
+                "mean_ms": float(vals.mean()),
+                "p50_ms": float(np.percentile(vals, 50)),
+                "p90_ms": float(np.percentile(vals, 90)),
+                "p99_ms": float(np.percentile(vals, 99)),
+            }
+        return stats
+
+
+class TimedModule(object):
+    """Forward attribute lookups to `module`, timing the named functions."""
+
+    def __init__(self, module, timed):
+        self._module = module
+        self._timed = timed
+
+    def __getattr__(self, name):
+        if name in self._timed:
+            return self._timed[name]
+        return getattr(self._module, name)
+
+
+class TimedTransform(object):
+    def __init__(self, timer, transform):
+        self.transform = transform
+        self.timed = timer.wrap(type(transform).__name__, transform)
+
+    def __call__(self, im):
+        return self.timed(im)
+
+
+def instrument(dataset, timer):
+    """Wrap the stages used by `dataset` (and its warper) with timers."""
+    image_module = module_data.Image
+    decode_eagerly = not getattr(dataset, "fast_decode", False)
+    read = timer.wrap("file_read", lambda path: Path(path).read_bytes())
+
+    def decode(buf):
+        im = image_module.open(io.BytesIO(buf))
+        if decode_eagerly:
+            im.load()
+        return im
+    decode = timer.wrap("decode", decode)
+
+    def open_image(fp, *args, **kwargs):
+        if isinstance(fp, (str, Path)):
+            return decode(read(fp))
+        return image_module.open(fp, *args, **kwargs)
+    module_data.Image = TimedModule(image_module, {"open": open_image})
+
+    if hasattr(dataset, "initial_transforms"):
+        dataset.initial_transforms = timer.wrap("initial_transforms",
+                                                dataset.initial_transforms)
+    dataset.transforms.transforms = [TimedTransform(timer, t)
+                                     for t in dataset.transforms.transforms]
+
+    timed = {name: timer.wrap(stage, getattr(tps, name)) for name, stage in (
+        ("random_tps_weights", "tps_weights"),
+        ("random_tps_weights_batch", "tps_weights"),
+        ("tps_grids", "tps_grid"),
+        ("tps_warp_keypoints", "keypoint_warp"),
+    )}
+    for name, func in timed.items():
+        setattr(tps, name, func)
+    tps.F = TimedModule(tps.F, {"grid_sample": timer.wrap("grid_sample",
+                                                          tps.F.grid_sample)})
+
+
+def num_bytes(obj):
+    if torch.is_tensor(obj):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(num_bytes(x) for x in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(num_bytes(x) for x in obj)
+    return 0
+
+
+def process_memory(pid):
+    """Return the resident and private memory (in bytes) of a process, or None if
+    /proc/<pid>/smaps_rollup is not available."""
+    fields = {}
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return None
+    return {"rss": fields.get("Rss", 0),
+            "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+
+def profile_worker_memory(dataset, num_workers, num_batches, batch_size=32,
+                          collate_fn=dict_coll):
+    """Load `num_batches` minibatches with `num_workers` workers, then measure the
+    memory of each worker (before it is shut down)."""
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                        shuffle=not isinstance(dataset, IterableDataset),
+                        collate_fn=collate_fn)
+    batches = iter(loader)
+    for _ in range(num_batches):
+        next(batches)
+    # the worker processes are `workers` in torch<=1.1 and `_workers` afterwards
+    workers = getattr(batches, "_workers", None) or batches.workers
+    stats = [process_memory(w.pid) for w in workers]
+    main = process_memory(os.getpid())
+    del batches
+    if main is None or None in stats:
+        return None
+    mib = 2 ** 20
+    return {
+        "num_workers": num_workers,
+        "main_rss_mib": main["rss"] / mib,
+        "worker_rss_mib": float(np.mean([x["rss"] for x in stats])) / mib,
+        "worker_private_mib": float(np.mean([x["private"] for x in stats])) / mib,
+    }
+
+
+def profile_dataset(dataset, num_samples, batch_size=32, collate_fn=dict_coll, seed=0):
+    timer = StageTimer()
+    instrument(dataset, timer)
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), min(num_samples, len(dataset)), replace=False)
+    samples, sample_bytes = [], []
+    for index in indices:
+        tic = time.perf_counter()
+        sample = dataset[int(index)]
+        timer.end_sample(time.perf_counter() - tic)
+        sample_bytes.append(num_bytes(sample))
+        samples.append(sample)
+
+    collate_ms = []
+    for start in range(0, len(samples) - batch_size + 1, batch_size):
+        tic = time.perf_counter()
+        collate_fn(samples[start:start + batch_size])
+        collate_ms.append((time.perf_counter() - tic) * 1000 / batch_size)
+
+    stats = timer.summary(len(indices))
+    if collate_ms:
+        stats["collate (per sample)"] = {
+            "mean_ms": float(np.mean(collate_ms)),
+            "p50_ms": float(np.percentile(collate_ms, 50)),
+            "p90_ms": float(np.percentile(collate_ms, 90)),
+            "p99_ms": float(np.percentile(collate_ms, 99)),
+        }
+    return {
+        "dataset": type(dataset).__name__,
+        "num_samples": len(indices),
+        "samples_per_sec": len(indices) / sum(timer.times["total"]),
+        "bytes_per_sample": float(np.mean(sample_bytes)),
+        "stages": stats,
+    }
+
+
+def report(results):
+    print("{}: {} samples, {:.1f} samples/sec, {:.1f} KiB per sample".format(
+        results["dataset"], results["num_samples"], results["samples_per_sec"],
+        results["bytes_per_sample"] / 1024))
+    print("{:<24s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+        "stage", "mean(ms)", "p50(ms)", "p90(ms)", "p99(ms)"))
+    for name, stat in results["stages"].items():
+        print("{:<24s} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            name, stat["mean_ms"], stat["p50_ms"], stat["p90_ms"], stat["p99_ms"]))
+    if "worker_memory" in results:
+        mem = results["worker_memory"]
+        print("{} workers: {:.1f} MiB RSS per worker ({:.1f} MiB private), main "
+              "process {:.1f} MiB RSS".format(mem["num_workers"], mem["worker_rss_mib"],
+                                              mem["worker_private_mib"],
+                                              mem["main_rss_mib"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--num_samples", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--val", action="store_true",
+                        help="profile the validation split instead of training")
+    parser.add_argument("--no_warper", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="if given, report the memory used per DataLoader worker")
+    parser.add_argument("--worker_batches", type=int, default=50)
+    parser.add_argument("--json", help="if given, write the results to this file")
+    args = parser.parse_args()
+
+    config = read_json(Path(args.config))
+    imwidth = config["dataset"]["args"]["imwidth"]
+    warper = None
+    if "warper" in config and not args.no_warper:
+        warper = get_instance(tps, "warper", config, imwidth, imwidth)
+    dataset = get_instance(module_data, "dataset", config, pair_warper=warper,
+                           train=not args.val)
+    collate_fn = coll if config.get("collate_fn", "dict_flatten") == "flatten" \
+        else dict_coll
+    torch.manual_seed(args.seed)
+    memory = None
+    if args.workers:
+        # measured before `profile_dataset` instruments the dataset
+        memory = profile_worker_memory(dataset, args.workers, args.worker_batches,
+                                       batch_size=args.batch_size,
+                                       collate_fn=collate_fn)
+    results = profile_dataset(dataset, num_samples=args.num_samples,
+                              batch_size=args.batch_size, collate_fn=collate_fn,
+                              seed=args.seed)
+    results["config"] = str(args.config)
+    if memory is not None:
+        results["worker_memory"] = memory
+    report(results)
+    if args.json:
+        Path(args.json).parent.mkdir(exist_ok=True, parents=True)
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+        print("wrote profile to {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from utils import tps
 import time
 from collections import defaultdict
 from torch.autograd import gradcheck
+from model.loss import correlation_targets, chunks
 
 LOCAL_CHECKS = False
 PROFILE = False
@@ -14,7 +15,8 @@ PROFILE = False
 class DenseCorr(torch.autograd.Function):
 
     @staticmethod
-    def forward(ctx, feats1, feats2, xxyy, batch_grid_u, stride, pow=0.5):
+    def forward(ctx, feats1, feats2, xxyy, batch_grid_u, stride, pow=0.5,
+                chunk_size=None, expand=False):
         """Compute the folded dense correlation loss forward pass.
 
         Args:
@@ -28,29 +30,28 @@ class DenseCorr(torch.autograd.Function):
                 `H = h * stride`).
             pow (float :: 0.5): power by which to raise the root distances
                 between pixel locations.
+            chunk_size (int): the number of minibatch elements processed together
+                (defaults to the whole minibatch).
+            expand (bool): whether to compute the distance targets from the
+                expansion of the squared distances.
 
         Returns:
             (torch.Tensor): The total loss for the given minibatch of inputs.
         """
         with torch.no_grad():
             B, C, H, W = feats1.shape
-            params = torch.IntTensor([B, C, H, W, stride])
+            params = torch.IntTensor([B, C, H, W, stride, expand])
             pow_tensor = torch.FloatTensor([pow])
             ctx.save_for_backward(feats1, feats2, xxyy, batch_grid_u,
                                   params, pow_tensor)
 
+            f1 = feats1.reshape(B, C, H * W)  # source
+            f2 = feats2.reshape(B, C, H * W)  # target
             loss = 0.
-            for b in range(B):
-                f1 = feats1[b].reshape(C, H * W)  # source
-                f2 = feats2[b].reshape(C, H * W)  # target
-                corr = torch.matmul(f1.t(), f2)
-                corr = corr.reshape(H, W, H, W)
-                diff = batch_grid_u[b, :, :, None, None, :] - \
-                    xxyy[None, None, ::stride, ::stride, :]
-                diff = (diff * diff).sum(4).sqrt()
-                diff = diff.pow(pow)
-                smcorr = F.softmax(corr.reshape(H, W, -1), dim=2)
-                smcorr = smcorr.reshape(corr.shape)
+            for sl in chunks(B, chunk_size):
+                corr = torch.bmm(f1[sl].transpose(1, 2), f2[sl])
+                diff = correlation_targets(batch_grid_u[sl], xxyy, stride, pow, expand)
+                smcorr = F.softmax(corr, dim=2)
                 L = diff * smcorr
                 loss += L.sum()
         return loss / (H * W * B)
@@ -71,6 +72,8 @@ class DenseCorr(torch.autograd.Function):
             (None): no gradient for `batch_grid_u`
             (None): no gradient for `stride`
             (None): no gradient for `pow`
+            (None): no gradient for `chunk_size`
+            (None): no gradient for `expand`
         """
         if PROFILE:
             batch_tic = time.time()
@@ -81,7 +84,7 @@ class DenseCorr(torch.autograd.Function):
 
         """We needed to store the integers as part of a tensor, so the
         unpacking code here is a little convoluted."""
-        B, C, H, W, stride = [x.item() for x in params]
+        B, C, H, W, stride, expand = [x.item() for x in params]
         pow = pow.item()
 
         """This is a pattern that is very convenient - at the top of backward
@@ -90,7 +93,7 @@ class DenseCorr(torch.autograd.Function):
         ignored, the return statement is simple even when the function has
         optional inputs."""
         grad_feats1 = grad_feats2 = grad_xxyy = grad_batch_u = None
-        grad_stride = grad_pow = None
+        grad_stride = grad_pow = grad_chunk_size = grad_expand = None
 
         """Returning gradients for inputs that don't require it is
         not an error."""
@@ -129,10 +132,9 @@ class DenseCorr(torch.autograd.Function):
                     tic = time.time()
 
                 with torch.no_grad():
-                    diff = batch_grid_u[b, :, :, None, None, :] - \
-                           xxyy[None, None, ::stride, ::stride, :]
-                    diff = (diff * diff).sum(4).sqrt()
-                    diff = diff.pow(pow)
+                    diff = correlation_targets(batch_grid_u[b:b + 1], xxyy,
+                                               stride, pow, expand)
+                    diff = diff.view(H, W, H, W)
 
                 if PROFILE:
                     timings["diff-grid"] += time.time() - tic
@@ -318,7 +320,7 @@ class DenseCorr(torch.autograd.Function):
                 print("==============")
 
         return (grad_feats1, grad_feats2, grad_xxyy, grad_batch_u,
-                grad_stride, grad_pow)
+                grad_stride, grad_pow, grad_chunk_size, grad_expand)
 
 
 def rel_diff(x1, x2, name):
@@ -6,6 +6,7 @@ from utils import tps
 import time
 from collections import defaultdict
 from torch.autograd import gradcheck
+from model.loss import correlation_targets, chunks, dense_correlation_loss_dve
 
 PROFILE = False
 PRINT_MEM = False
@@ -46,7 +47,8 @@ def estimate_mem(x):
 class DenseCorrDve(torch.autograd.Function):
 
     @staticmethod
-    def forward(ctx, feats1, feats2, xxyy, batch_grid_u, stride, norm, pow=0.5):
+    def forward(ctx, feats1, feats2, xxyy, batch_grid_u, stride, norm, pow=0.5,
+                chunk_size=None, expand=False):
         """Compute the folded dense correlation loss forward pass.
 
         Args:
@@ -61,6 +63,10 @@ class DenseCorrDve(torch.autograd.Function):
             norm (bool): whether to remove normalisation.
             pow (float :: 0.5): power by which to raise the root distances
                 between pixel locations.
+            chunk_size (int): the number of minibatch elements processed together
+                (defaults to the whole minibatch).
+            expand (bool): whether to compute the distance targets from the
+                expansion of the squared distances.
 
         Returns:
             (torch.Tensor): The total loss for the given minibatch of inputs.
@@ -68,41 +74,32 @@ class DenseCorrDve(torch.autograd.Function):
         with torch.no_grad():
             B, C, H, W = feats1.shape
             h, w = H, W
-            params = torch.IntTensor([B, C, H, W, stride, norm])
+            params = torch.IntTensor([B, C, H, W, stride, norm, expand])
             pow_tensor = torch.FloatTensor([pow])
             ctx.save_for_backward(feats1, feats2, xxyy, batch_grid_u,
                                   params, pow_tensor)
 
-            loss = 0.
-            for b in range(B):
-                f1 = feats1[b].reshape(C, H * W)  # source
-                f2 = feats2[b].reshape(C, h * w)  # target
-                fa = feats1[(b + 1) % B].reshape(C, h * w)  # auxiliary
+            f1 = feats1.reshape(B, C, H * W)  # source
+            f2 = feats2.reshape(B, C, h * w)  # target
+            if norm:
+                f1 = F.normalize(f1, p=2, dim=1) * JDT_FACTOR
+                f2 = F.normalize(f2, p=2, dim=1) * JDT_FACTOR
+            aux = (torch.arange(B, device=feats1.device) + 1) % B
 
-                if norm:
-                    f1 = F.normalize(f1, p=2, dim=0) * JDT_FACTOR
-                    f2 = F.normalize(f2, p=2, dim=0) * JDT_FACTOR
-                    fa = F.normalize(fa, p=2, dim=0) * JDT_FACTOR
+            loss = 0.
+            for sl in chunks(B, chunk_size):
+                fa = f1[aux[sl]]  # auxiliary
 
-                corr = torch.matmul(f1.t(), fa)
-                corr = corr.reshape(H, W, h, w)
-                smcorr = F.softmax(corr.reshape(H, W, -1), dim=2).reshape(corr.shape)
-                smcorr_fa = smcorr[None, ...] * fa.reshape(-1, 1, 1, h, w)
+                corr = torch.bmm(f1[sl].transpose(1, 2), fa)
+                smcorr = F.softmax(corr, dim=2)
+                f1_via_fa = torch.bmm(fa, smcorr.transpose(1, 2))
                 del smcorr
 
-                f1_via_fa = smcorr_fa.sum((3, 4)).reshape(C, H * w)
-                del smcorr_fa
-
-                corr2 = torch.matmul(f1_via_fa.t(), f2).reshape(corr.shape)
-                smcorr2 = F.softmax(corr2.reshape(H, W, -1), dim=2).reshape(corr.shape)
+                corr2 = torch.bmm(f1_via_fa.transpose(1, 2), f2[sl])
+                smcorr2 = F.softmax(corr2, dim=2)
                 del corr2
 
-                with torch.no_grad():
-                    diff = batch_grid_u[b, :, :, None, None, :] - \
-                            xxyy[None, None, ::stride, ::stride, :]
-                    diff = (diff * diff).sum(4).sqrt()
-                    diff = diff.pow(pow)
-
+                diff = correlation_targets(batch_grid_u[sl], xxyy, stride, pow, expand)
                 L = diff * smcorr2
 
                 loss += L.float().sum()
@@ -124,6 +121,8 @@ class DenseCorrDve(torch.autograd.Function):
             (None): no gradient for `batch_grid_u`
             (None): no gradient for `stride`
             (None): no gradient for `pow`
+            (None): no gradient for `chunk_size`
+            (None): no gradient for `expand`
         """
         if PROFILE:
             batch_tic = time.time()
@@ -134,7 +133,7 @@ class DenseCorrDve(torch.autograd.Function):
 
         """We needed to store the integers as part of a tensor, so the
         unpacking code here is a little convoluted."""
-        B, C, H, W, stride, norm = [x.item() for x in params]
+        B, C, H, W, stride, norm, expand = [x.item() for x in params]
         h, w = H, W
         pow = pow.item()
 
@@ -144,7 +143,7 @@ class DenseCorrDve(torch.autograd.Function):
         ignored, the return statement is simple even when the function has
         optional inputs."""
         grad_feats1 = grad_feats2 = grad_xxyy = grad_batch_u = None
-        grad_stride = grad_norm = grad_pow = None
+        grad_stride = grad_norm = grad_pow = grad_chunk_size = grad_expand = None
 
         """Returning gradients for inputs that don't require it is
         not an error."""
@@ -183,10 +182,9 @@ class DenseCorrDve(torch.autograd.Function):
                     tic = time.time()
 
                 with torch.no_grad():
-                    diff = batch_grid_u[b, :, :, None, None, :] - \
-                           xxyy[None, None, ::stride, ::stride, :]
-                    diff = (diff * diff).sum(4).sqrt()
-                    diff = diff.pow(pow)
+                    diff = correlation_targets(batch_grid_u[b:b + 1], xxyy,
+                                               stride, pow, expand)
+                    diff = diff.view(H, W, h, w)
 
                 if PROFILE:
                     timings["diff-grid"] += time.time() - tic
@@ -251,13 +249,10 @@ class DenseCorrDve(torch.autograd.Function):
                 if LOCAL_CHECKS:
                     # cache a copy of the mega tensor for numerical checks
                     smcorr_fa = smcorr[None, ...] * fa_norm.view(-1, 1, 1, h, w)
-                    f1_via_fa = smcorr_fa.sum((3, 4))
-                else:
-                    """This is one of the largest tensors....."""
-                    f1_via_fa = (smcorr[None, ...] *
-                        fa_norm.view(-1, 1, 1, h, w)).sum((3, 4))
 
-                f1_via_fa = f1_via_fa.view(C, H * W)
+                # Reconstruct the source features from the auxiliaries as a
+                # matrix product, rather than summing a C x H x W x h x w tensor
+                f1_via_fa = torch.matmul(fa_norm, smcorr.view(H * W, h * w).t())
 
                 # Main correlation computation
                 corr2 = torch.matmul(f1_via_fa.t(), f2_norm).view(corr.shape)
@@ -374,13 +369,12 @@ class DenseCorrDve(torch.autograd.Function):
                     # Desired gradients ->
                     # (grad_fa_, grad_smcorr)
 
-                    grad_f1_via_fa = grad_f1_via_fa.view(-1, H, W, 1, 1)
-
                     # safety checks over the summation
                     if LOCAL_CHECKS:
                         # This tensor is crashing the GPU, so should only be
                         # used for numerical checks
-                        grad_smcorr_fa = grad_f1_via_fa.repeat(1, 1, 1, h, w)
+                        grad_smcorr_fa = grad_f1_via_fa.view(-1, H, W, 1, 1)
+                        grad_smcorr_fa = grad_smcorr_fa.repeat(1, 1, 1, h, w)
                         with torch.enable_grad():
 
                             smcorr_fa_num = smcorr_fa.clone().requires_grad_()
@@ -390,27 +384,17 @@ class DenseCorrDve(torch.autograd.Function):
                             grad_smcorr_fa_num = torch.autograd.grad(
                                 outputs=f1_via_fa_num,
                                 inputs=(smcorr_fa_num,),
-                                grad_outputs=grad_f1_via_fa.view(-1, H, w),
+                                grad_outputs=grad_f1_via_fa.view(-1, H, W),
                             )
                             rel_diff(grad_smcorr_fa, grad_smcorr_fa_num[0],
                                      "summation of grad_smcorr-fa")
 
-                    # Use for-loop over EVC dimension to avoid memory issues
-                    if feats1.is_cuda:
-                        if grad_f1_via_fa.dtype == torch.float64:
-                            grad_smcorr =  torch.cuda.DoubleTensor(H, W, h, w).fill_(0)
-                            grad_fa_ =  torch.cuda.DoubleTensor(C, h, w).fill_(0)
-                        else:
-                            grad_smcorr =  torch.cuda.FloatTensor(H, W, h, w).fill_(0)
-                            grad_fa_ =  torch.cuda.FloatTensor(C, h, w).fill_(0)
-                    else:
-                        grad_smcorr =  torch.zeros((H, W, h, w), dtype=feats1.dtype)
-                        grad_fa_ =  torch.zeros((C, h, w), dtype=feats1.dtype)
-
-                    for cc in range(C):
-                        grad_smcorr += (grad_f1_via_fa[cc] * fa_norm[cc].view(1, 1, h, w))
-                        grad_fa_[cc] = (grad_f1_via_fa[cc] * smcorr).sum((0, 1))
-                    grad_fa_ = grad_fa_.reshape(C, h * w)
+                    # [Fwd op] -> `f1_via_fa = fa_norm @ smcorr^T`, so both
+                    # gradients are matrix products and nothing of size
+                    # C x H x W x h x w (or a loop over C) is needed
+                    grad_smcorr = torch.matmul(grad_f1_via_fa.t(), fa_norm)
+                    grad_smcorr = grad_smcorr.view(H, W, h, w)
+                    grad_fa_ = torch.matmul(grad_f1_via_fa, smcorr.view(H * W, h * w))
 
                     # safety checks over the weighted sum
                     if LOCAL_CHECKS:
@@ -712,7 +696,7 @@ class DenseCorrDve(torch.autograd.Function):
                 print("==============")
 
         return (grad_feats1, grad_feats2, grad_xxyy, grad_batch_u,
-                grad_stride, grad_norm, grad_pow)
+                grad_stride, grad_norm, grad_pow, grad_chunk_size, grad_expand)
 
 
 def rel_diff(x1, x2, name):
@@ -748,13 +732,69 @@ def dense_corr_check(use_dve=False):
     xxyy = tps.spatial_grid_unnormalized(H_input, W_input).double()
     xxyy.requires_grad = False
     args = (feats1, feats2, xxyy, batch_grid_u, stride, norm)
-    feats2.cuda()
-    xxyy.cuda()
-    batch_grid_u.cuda()
     test = gradcheck(dense_corr, args, eps=1e-6, atol=ATOL,
                      raise_exception=True)
     print("passed test: {}".format(test))
 
 
+def reconstruction_check():
+    """Check that expressing the reconstruction of the source features as the
+    matrix product `fa @ smcorr^T` matches (in value and gradient) the broadcast
+    sum over a C x H x W x h x w tensor that it replaces."""
+    C, H, W = 4, 4, 4
+    h, w = H, W
+    common = {"dtype": torch.double, "requires_grad": True}
+    fa = torch.randn(C, h * w, **common)
+    corr = torch.randn(H * W, h * w, **common)
+
+    def broadcast(fa, corr):
+        smcorr = F.softmax(corr, dim=1).reshape(H, W, h, w)
+        smcorr_fa = smcorr[None, ...] * fa.reshape(-1, 1, 1, h, w)
+        return smcorr_fa.sum((3, 4)).reshape(C, H * W)
+
+    def matmul(fa, corr):
+        return torch.matmul(fa, F.softmax(corr, dim=1).t())
+
+    out, out_ref = matmul(fa, corr), broadcast(fa, corr)
+    grad_out = torch.randn(out.shape, dtype=torch.double)
+    grads = torch.autograd.grad(out, (fa, corr), grad_outputs=grad_out)
+    grads_ref = torch.autograd.grad(out_ref, (fa, corr), grad_outputs=grad_out)
+    rel_diff(out, out_ref, "reconstruction")
+    for name, grad, grad_ref in zip(("fa", "corr"), grads, grads_ref):
+        rel_diff(grad, grad_ref, "reconstruction grad {}".format(name))
+        assert torch.allclose(grad, grad_ref, atol=ATOL)
+    assert torch.allclose(out, out_ref, atol=ATOL)
+    test = gradcheck(matmul, (fa, corr), eps=1e-6, atol=ATOL,
+                     raise_exception=True)
+    print("passed test: {}".format(test))
+
+
+def dense_corr_parity_check(norm=False):
+    """Check that the folded loss and the autograd loss agree on both the loss
+    value and the gradients with respect to the features."""
+    B, C, H, W = 4, 4, 4, 4
+    common = {"dtype": torch.double, "requires_grad": True}
+    feats1 = torch.randn(B, C, H, W, **common)
+    feats2 = torch.randn(B, C, H, W, **common)
+    grid = torch.rand(B, H, W, 2, dtype=torch.double) * 2 - 1
+
+    # the losses expect the two views of each pair to be interleaved
+    feats = torch.stack((feats1, feats2), dim=1).reshape(2 * B, C, H, W)
+    outs = {}
+    for fold_corr in (False, True):
+        loss = dense_correlation_loss_dve([feats], {"grid": grid}, fold_corr=fold_corr,
+                                          normalize_vectors=norm)
+        grads = torch.autograd.grad(loss, (feats1, feats2))
+        outs[fold_corr] = (loss,) + grads
+    for name, out, out_ref in zip(("loss", "feats1", "feats2"), outs[True],
+                                  outs[False]):
+        rel_diff(out, out_ref, "folded vs autograd {}".format(name))
+        assert torch.allclose(out, out_ref, atol=ATOL)
+    print("passed test: True")
+
+
 if __name__ == "__main__":
     dense_corr_check()
+    reconstruction_check()
+    dense_corr_parity_check(norm=False)
+    dense_corr_parity_check(norm=True)
@@ -3,6 +3,9 @@ import time
 import torch
 from utils import tps
 
+# Squared distances below this fraction of the largest squared norm are recomputed
+# exactly by `distance_targets(expand=True)`
+EXPAND_REFINE = 1e-4
 
 
 def regression_loss(prediction_normalized, meta, alpha=1., **kwargs):
@@ -24,7 +27,71 @@ def segmentation_loss(x, meta, weight=None, size_average=True, **kwargs):
     # return F.cross_entropy(x, target, weight=weight, size_average=size_average)
 
 
-def dense_correlation_loss(feats, meta, pow=0.5, fold_corr=False, normalize_vectors=True):
+def correlation_targets(batch_grid_u, xxyy, stride, pow=0.5, expand=False):
+    """Return the B x (H * W) x (h * w) targets of the dense correlation losses: the
+    distance (raised to `pow`) between the location in the second image from which
+    each pixel of the first image came, and every (strided) location of the second.
+
+    For a single sample, this is equivalent to
+
+        diff = torch.zeros(H_input, W_input, H_input, W_input, 2)
+        for I in range(H_input):
+            for J in range(W_input):
+                for i in range(H_input):
+                    for j in range(W_input):
+                        diff[I, J, i, j, 0] = J + flow[b, I, J, 0] - j
+                        diff[I, J, i, j, 1] = I + flow[b, I, J, 1] - i
+
+        diff = diff[::stride, ::stride, ::stride, ::stride]
+        diff = (diff * diff).sum(4).sqrt()
+        diff = diff.pow(pow)
+    """
+    B = batch_grid_u.shape[0]
+    locs = xxyy[::stride, ::stride].reshape(-1, 2)
+    return distance_targets(batch_grid_u.reshape(B, -1, 2), locs, pow, expand)
+
+
+def distance_targets(points, locs, pow=0.5, expand=False):
+    """Return the B x N x M distances (raised to `pow`) between a B x N x 2 batch of
+    points and an M x 2 set of locations.
+
+    If `expand` is set, the squared distances are expanded as
+    ||g - x||^2 = ||g||^2 + ||x||^2 - 2 <g, x>, so that the B x N x M x 2 tensor of
+    differences is never built. The coordinates are first centred on the locations
+    to limit the cancellation, which still leaves an absolute error of a few `eps`
+    times S = max ||g||^2 + max ||x||^2 in every squared distance (~1e-3 in float32
+    at pixel coordinates). Since the square root amplifies this error near zero, the
+    (few) squared distances below T = EXPAND_REFINE * S are recomputed from their
+    differences. For pow <= 1, the error of the targets is then at most
+    pow / 2 * T^(pow / 2) * (a few eps / EXPAND_REFINE), i.e. ~1e-4 at pixel
+    coordinates in float32 (see `expanded_targets_check`).
+    """
+    if expand:
+        centre = locs.mean(0)
+        points, locs = points - centre, locs - centre
+        points_sq = (points * points).sum(2, keepdim=True)
+        locs_sq = (locs * locs).sum(1)
+        sq = points_sq + locs_sq - 2 * torch.matmul(points, locs.t())
+        near = (sq < EXPAND_REFINE * (points_sq.max() + locs_sq.max())).nonzero()
+        if near.numel():
+            b, n, m = near[:, 0], near[:, 1], near[:, 2]
+            diff = points[b, n] - locs[m]
+            sq[b, n, m] = (diff * diff).sum(1)
+        return sq.clamp(min=0).sqrt().pow(pow)
+    diff = points[:, :, None, :] - locs[None, None, :, :]
+    diff = (diff * diff).sum(3).sqrt()
+    return diff.pow(pow)
+
+
+def chunks(B, chunk_size=None):
+    """Split a minibatch of `B` elements into slices of at most `chunk_size` (which
+    bounds the size of the B x (H * W) x (h * w) intermediates of the losses)."""
+    chunk_size = chunk_size or B
+    return [slice(start, min(start + chunk_size, B)) for start in range(0, B, chunk_size)]
+
+
+def dense_correlation_loss(feats, meta, pow=0.5, fold_corr=False, normalize_vectors=True,
+                           chunk_size=None, tile_size=None, expand_targets=False):
     feats = feats[0]
     device = feats.device
     grid = meta['grid']
@@ -52,45 +119,36 @@ def dense_correlation_loss(feats, meta, pow=0.5, fold_corr=False, normalize_vect
         """This function computes the gradient explicitly to avoid the memory
         issues with using autorgrad in a for loop."""
         assert not normalize_vectors
+        assert not tile_size, "the folded and tiled losses are alternatives"
         dense_corr = DenseCorr.apply
-        return dense_corr(feats1, feats2, xxyy, batch_grid_u, stride, pow)
+        return dense_corr(feats1, feats2, xxyy, batch_grid_u, stride, pow, chunk_size,
+                          expand_targets)
 
-    loss = 0.
-    for b in range(B):
-        f1 = feats1[b].reshape(C, H * W)  # source
-        f2 = feats2[b].reshape(C, h * w)  # target
+    f1 = feats1.reshape(B, C, H * W)  # source
+    f2 = feats2.reshape(B, C, h * w)  # target
+
+    if normalize_vectors:
+        f1 = F.normalize(f1, p=2, dim=1) * 20
+        f2 = F.normalize(f2, p=2, dim=1) * 20
 
-        if normalize_vectors:
-            f1 = F.normalize(f1, p=2, dim=0) * 20
-            f2 = F.normalize(f2, p=2, dim=0) * 20
+    if tile_size:
+        from model.tiled_correlation import TiledCorr
+        """This function streams over tiles of the correlation matrix so that
+        memory grows linearly with the number of feature locations."""
+        locs = xxyy[::stride, ::stride].reshape(-1, 2)
+        loss = TiledCorr.apply(f1, f2, batch_grid_u.reshape(B, -1, 2), locs, pow,
+                               tile_size, expand_targets)
+        return loss / (H * W * B)
 
-        corr = torch.matmul(f1.t(), f2)
-        corr = corr.reshape(H, W, h, w)
+    loss = 0.
+    for sl in chunks(B, chunk_size):
+        corr = torch.bmm(f1[sl].transpose(1, 2), f2[sl])
 
         with torch.no_grad():
-            diff = batch_grid_u[b, :, :, None, None, :] - \
-                    xxyy[None, None, ::stride, ::stride, :]
-            diff = (diff * diff).sum(4).sqrt()
-            diff = diff.pow(pow)
-
-        # grid_u = tps.grid_unnormalize(grid[b], H_input, W_input)
-        # diff = grid_u[:, :, None, None, :] - xxyy[None, None, :, :, :]
-
-        # Equivalent to this
-        #
-        # diff = torch.zeros(H_input, W_input, H_input, W_input, 2)
-        # for I in range(H_input):
-        #     for J in range(W_input):
-        #         for i in range(H_input):
-        #             for j in range(W_input):
-        #                 diff[I, J, i, j, 0] = J + flow[b, I, J, 0] - j
-        #                 diff[I, J, i, j, 1] = I + flow[b, I, J, 1] - i
-
-        # diff = diff[::stride, ::stride, ::stride, ::stride]
-        # diff = (diff * diff).sum(4).sqrt()
-        # diff = diff.pow(pow)
-
-        smcorr = F.softmax(corr.reshape(H, W, -1), dim=2).reshape(corr.shape)
+            diff = correlation_targets(batch_grid_u[sl], xxyy, stride, pow,
+                                       expand_targets)
+
+        smcorr = F.softmax(corr, dim=2)
 
         L = diff * smcorr
 
@@ -111,7 +169,8 @@ def estimate_mem(x):
     return torch.numel(x) * nbytes / (1024) ** 3
 
 
-def dense_correlation_loss_dve(feats, meta, pow=0.5, fold_corr=False, normalize_vectors=True):
+def dense_correlation_loss_dve(feats, meta, pow=0.5, fold_corr=False, normalize_vectors=True,
+                               chunk_size=None, tile_size=None, expand_targets=False):
     feats = feats[0]
     device = feats.device
 
@@ -164,39 +223,50 @@ def dense_correlation_loss_dve(feats, meta, pow=0.5, fold_corr=False, normalize_
         """This function computes the gradient explicitly to avoid the memory
         issues with using autorgrad in a for loop."""
         from model.folded_correlation_dve import DenseCorrDve
+        assert not tile_size, "the folded and tiled losses are alternatives"
         dense_corr = DenseCorrDve.apply
         return dense_corr(feats1, feats2, xxyy, batch_grid_u, stride,
-                          normalize_vectors, pow)
+                          normalize_vectors, pow, chunk_size, expand_targets)
+
+    f1 = feats1.reshape(B, C, H * W)  # source
+    f2 = feats2.reshape(B, C, h * w)  # target
+
+    if normalize_vectors:
+        f1 = F.normalize(f1, p=2, dim=1) * 20
+        f2 = F.normalize(f2, p=2, dim=1) * 20
+
+    # the auxiliary features of each sample are the (normalized) source features of
+    # the next sample in the minibatch
+    aux = (torch.arange(B, device=device) + 1) % B
+
+    if tile_size:
+        from model.tiled_correlation import TiledCorr, TiledAttention
+        """This function streams over tiles of both correlation matrices so that
+        memory grows linearly with the number of feature locations."""
+        fa = f1[aux]  # auxiliary
+        f1_via_fa = TiledAttention.apply(f1, fa, fa, tile_size)
+        locs = xxyy[::stride, ::stride].reshape(-1, 2)
+        loss = TiledCorr.apply(f1_via_fa, f2, batch_grid_u.reshape(B, -1, 2), locs,
+                               pow, tile_size, expand_targets)
+        return loss / (H * W * B)
 
     loss = 0.
-    for b in range(B):
-        f1 = feats1[b].reshape(C, H * W)  # source
-        f2 = feats2[b].reshape(C, h * w)  # target
-        fa = feats1[(b + 1) % B].reshape(C, h * w)  # auxiliary
-
-        if normalize_vectors:
-            f1 = F.normalize(f1, p=2, dim=0) * 20
-            f2 = F.normalize(f2, p=2, dim=0) * 20
-            fa = F.normalize(fa, p=2, dim=0) * 20
-
-        corr = torch.matmul(f1.t(), fa)
-        corr = corr.reshape(H, W, h, w)
-        smcorr = F.softmax(corr.reshape(H, W, -1), dim=2).reshape(corr.shape)
-        smcorr_fa = smcorr[None, ...] * fa.reshape(-1, 1, 1, h, w)
-        del smcorr
+    for sl in chunks(B, chunk_size):
+        fa = f1[aux[sl]]  # auxiliary
+
+        corr = torch.bmm(f1[sl].transpose(1, 2), fa)
+        smcorr = F.softmax(corr, dim=2)
 
-        f1_via_fa = smcorr_fa.sum((3, 4)).reshape(C, H * W)
-        del smcorr_fa
+        f1_via_fa = torch.bmm(fa, smcorr.transpose(1, 2))
+        del smcorr
 
-        corr2 = torch.matmul(f1_via_fa.t(), f2).reshape(corr.shape)
-        smcorr2 = F.softmax(corr2.reshape(H, W, -1), dim=2).reshape(corr.shape)
+        corr2 = torch.bmm(f1_via_fa.transpose(1, 2), f2[sl])
+        smcorr2 = F.softmax(corr2, dim=2)
         del corr2
 
         with torch.no_grad():
-            diff = batch_grid_u[b, :, :, None, None, :] - \
-                    xxyy[None, None, ::stride, ::stride, :]
-            diff = (diff * diff).sum(4).sqrt()
-            diff = diff.pow(pow)
+            diff = correlation_targets(batch_grid_u[sl], xxyy, stride, pow,
+                                       expand_targets)
 
         L = diff * smcorr2
 
@@ -206,81 +276,14 @@ def dense_correlation_loss_dve(feats, meta, pow=0.5, fold_corr=False, normalize_
 
 
 def dense_correlation_loss_trick(feats, meta, pow=0.5, fold_corr=False,
-        normalize_vectors=True):
-    feats = feats[0]
-    device = feats.device
-    grid = meta['grid']
-
-    # Grid (B,H,W,2): For each pixel in im1, where did it come from in im2
-    grid = grid.to(device)
-
-    H_input = grid.shape[1]
-    W_input = grid.shape[2]
-
-    feats1 = feats[0::2]
-    feats2 = feats[1::2]
-
-    B, C, H, W = feats1.shape
-    h, w = H, W
-
-    stride = H_input // H
-
-    batch_grid_u = tps.grid_unnormalize(grid, H_input, W_input)
-    batch_grid_u = batch_grid_u[:, ::stride, ::stride, :]
-    xxyy = tps.spatial_grid_unnormalized(H_input, W_input).to(device)
-
-    if fold_corr:
-        from model.folded_correlation import DenseCorr
-        """This function computes the gradient explicitly to avoid the memory
-        issues with using autorgrad in a for loop."""
-        assert not normalize_vectors
-        dense_corr = DenseCorr.apply
-        return dense_corr(feats1, feats2, xxyy, batch_grid_u, stride, pow)
-
-    loss = 0.
-    for b in range(B):
-        f1 = feats1[b].reshape(C, H * W)  # source
-        f2 = feats2[b].reshape(C, h * w)  # target
-
-        if normalize_vectors:
-            f1 = F.normalize(f1, p=2, dim=0) * 20
-            f2 = F.normalize(f2, p=2, dim=0) * 20
-
-        corr = torch.matmul(f1.t(), f2)
-        corr = corr.reshape(H, W, h, w)
-
-        with torch.no_grad():
-            # replace with expanded terms for efficiency
-            import ipdb; ipdb.set_trace()
-            diff = batch_grid_u[b, :, :, None, None, :] - \
-                    xxyy[None, None, ::stride, ::stride, :]
-            diff = (diff * diff).sum(4).sqrt()
-            diff = diff.pow(pow)
-
-        # grid_u = tps.grid_unnormalize(grid[b], H_input, W_input)
-        # diff = grid_u[:, :, None, None, :] - xxyy[None, None, :, :, :]
-
-        # Equivalent to this
-        #
-        # diff = torch.zeros(H_input, W_input, H_input, W_input, 2)
-        # for I in range(H_input):
-        #     for J in range(W_input):
-        #         for i in range(H_input):
-        #             for j in range(W_input):
-        #                 diff[I, J, i, j, 0] = J + flow[b, I, J, 0] - j
-        #                 diff[I, J, i, j, 1] = I + flow[b, I, J, 1] - i
-
-        # diff = diff[::stride, ::stride, ::stride, ::stride]
-        # diff = (diff * diff).sum(4).sqrt()
-        # diff = diff.pow(pow)
-
-        smcorr = F.softmax(corr.reshape(H, W, -1), dim=2).reshape(corr.shape)
-
-        L = diff * smcorr
-
-        loss += L.sum()
-
-    return loss / (H * W * B)
+        normalize_vectors=True, chunk_size=None, tile_size=None):
+    """The dense correlation loss, with the distance targets computed from the
+    expansion of the squared distances rather than a broadcast difference (this is
+    equivalent to passing `expand_targets` to `dense_correlation_loss`)."""
+    return dense_correlation_loss(feats, meta, pow=pow, fold_corr=fold_corr,
+                                  normalize_vectors=normalize_vectors,
+                                  chunk_size=chunk_size, tile_size=tile_size,
+                                  expand_targets=True)
 
 
 def rel_diff(x1, x2, name):
@@ -297,12 +300,48 @@ def dense_corr_trick_check():
     batch_grid_u = torch.randn(B, H, W, 2, dtype=torch.double,
                                requires_grad=False)
 
-    feats = feats.cuda().float()
-    batch_grid_u = batch_grid_u.cuda().float()
     out = dense_correlation_loss([feats], {"grid": batch_grid_u})
     out2 = dense_correlation_loss_trick([feats], {"grid": batch_grid_u})
+    grad, = torch.autograd.grad(out, (feats,))
+    grad2, = torch.autograd.grad(out2, (feats,))
     rel_diff(out, out2, "trick")
+    rel_diff(grad, grad2, "trick grad")
+    assert torch.allclose(out, out2, atol=1e-6)
+    assert torch.allclose(grad, grad2, atol=1e-6)
+
+    # compare the targets themselves at the scale of pixel coordinates
+    xxyy = tps.spatial_grid_unnormalized(H, W).double()
+    diff = correlation_targets(batch_grid_u * H, xxyy, 1)
+    diff2 = correlation_targets(batch_grid_u * H, xxyy, 1, expand=True)
+    rel_diff(diff, diff2, "trick targets")
+    assert torch.allclose(diff, diff2, atol=1e-6)
+
+
+def expanded_targets_check(num_points=500, tol=2e-3):
+    """Bound the largest error of the expanded distance targets for float32 inputs at
+    realistic image widths and strides, against the broadcast form in float64 (the
+    expected bound is ~1e-4, see `distance_targets`)."""
+    for imwidth, stride in ((100, 1), (136, 4)):
+        xxyy = tps.spatial_grid_unnormalized(imwidth, imwidth)
+        locs = xxyy[::stride, ::stride].reshape(-1, 2)
+        points = torch.rand(2, num_points, 2) * (imwidth - 1)
+        # include points on (and very close to) the locations, where the targets
+        # are smallest and the square root amplifies errors the most
+        num_near = num_points // 5
+        near = locs[torch.randint(locs.shape[0], (2, num_near))]
+        points[:, :num_near] = near + 1e-3 * torch.randn(2, num_near, 2)
+        points[:, :num_near // 2] = near[:, :num_near // 2]
+
+        for pow in (0.5, 1.):
+            ref = distance_targets(points.double(), locs.double(), pow)
+            out = distance_targets(points, locs, pow, expand=True)
+            assert out.dtype == torch.float32, "expected float32 targets"
+            err = (out.double() - ref).abs().max().item()
+            msg = "imwidth {} stride {} pow {}: max target error {:.2e}"
+            print(msg.format(imwidth, stride, pow, err))
+            assert err <= tol, "expanded targets deviate from the broadcast form"
 
 
 if __name__ == "__main__":
     dense_corr_trick_check()
+    expanded_targets_check()
@@ -0,0 +1,249 @@
+"""Tiled versions of the dense correlation losses.
+
+Rather than materialising the (H * W) x (h * w) correlation matrix (and the
+matching distance targets) of each sample, these functions stream over blocks of
+`tile_size` target locations, keeping a running log-sum-exp of the softmax for
+every source location (as is done for memory efficient attention). The backward
+passes recompute the tiles instead of storing them, so that memory grows linearly
+with the number of feature locations.
+"""
+import torch
+import torch.nn.functional as F
+from torch.autograd import gradcheck
+from model.loss import (distance_targets, chunks, dense_correlation_loss,
+                        dense_correlation_loss_dve)
+
+# Risk appetite
+ATOL = 1E-4
+
+
+class TiledCorr(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, f1, f2, grid_u, locs, pow=0.5, tile_size=1024, expand=False):
+        """Compute the tiled dense correlation loss forward pass.
+
+        Args:
+            f1 (torch.Tensor): B x C x N tensor of (normalised) source features
+            f2 (torch.Tensor): B x C x M tensor of (normalised) target features
+            grid_u (torch.Tensor): B x N x 2 locations in the target image from
+                which each source feature came.
+            locs (torch.Tensor): M x 2 locations of the target features.
+            pow (float :: 0.5): power by which to raise the root distances
+                between pixel locations.
+            tile_size (int :: 1024): the number of source and target locations
+                processed together.
+            expand (bool): whether to compute the distance targets from the
+                expansion of the squared distances.
+
+        Returns:
+            (torch.Tensor): The sum over the minibatch and the source locations of
+                the expected distance under the softmax of the correlations.
+        """
+        with torch.no_grad():
+            B, N, M = f1.shape[0], f1.shape[2], f2.shape[2]
+            lse = f1.new_empty(B, N)
+            expected = f1.new_empty(B, N)
+            for qs in chunks(N, tile_size):
+                q = f1[:, :, qs].transpose(1, 2)
+                points = grid_u[:, qs]
+
+                # running max, sum of exponentials and weighted sum of distances
+                m = q.new_full(points.shape[:2], float("-inf"))
+                l = q.new_zeros(points.shape[:2])
+                acc = q.new_zeros(points.shape[:2])
+                for ks in chunks(M, tile_size):
+                    corr = torch.bmm(q, f2[:, :, ks])
+                    diff = distance_targets(points, locs[ks], pow, expand)
+                    m_new = torch.max(m, corr.max(2)[0])
+                    scale = torch.exp(m - m_new)
+                    p = torch.exp(corr - m_new[:, :, None])
+                    l = l * scale + p.sum(2)
+                    acc = acc * scale + (p * diff).sum(2)
+                    m = m_new
+                lse[:, qs] = m + l.log()
+                expected[:, qs] = acc / l
+
+            params = torch.IntTensor([tile_size, expand])
+            pow_tensor = torch.FloatTensor([pow])
+            ctx.save_for_backward(f1, f2, grid_u, locs, lse, expected, params,
+                                  pow_tensor)
+        return expected.sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        """Compute the tiled dense correlation loss backward pass.
+
+        Args:
+            (torch.Tensor): The gradient of the total loss with respect to the
+                output of the tiled correlation loss.
+
+        Returns:
+            (torch.Tensor): B x C x N tensor of gradients
+            (torch.Tensor): B x C x M tensor of gradients
+            (None): no gradient for `grid_u`
+            (None): no gradient for `locs`
+            (None): no gradient for `pow`
+            (None): no gradient for `tile_size`
+            (None): no gradient for `expand`
+        """
+        f1, f2, grid_u, locs, lse, expected, params, pow = ctx.saved_tensors
+        tile_size, expand = [x.item() for x in params]
+        pow = pow.item()
+        N, M = f1.shape[2], f2.shape[2]
+
+        with torch.no_grad():
+            grad_f1 = torch.zeros_like(f1)
+            grad_f2 = torch.zeros_like(f2)
+            for qs in chunks(N, tile_size):
+                q = f1[:, :, qs]
+                points = grid_u[:, qs]
+                for ks in chunks(M, tile_size):
+                    k = f2[:, :, ks]
+                    corr = torch.bmm(q.transpose(1, 2), k)
+                    smcorr = torch.exp(corr - lse[:, qs, None])
+                    diff = distance_targets(points, locs[ks], pow, expand)
+
+                    # softmax backward, using the expected distance of each row
+                    grad_corr = smcorr * (diff - expected[:, qs, None])
+                    grad_corr = grad_corr * grad_output
+                    grad_f1[:, :, qs] += torch.bmm(k, grad_corr.transpose(1, 2))
+                    grad_f2[:, :, ks] += torch.bmm(q, grad_corr)
+        return grad_f1, grad_f2, None, None, None, None, None
+
+
+class TiledAttention(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, q, k, v, tile_size=1024):
+        """Compute the tiled softmax attention forward pass, `v @ softmax(q^T k)^T`.
+        This is the reconstruction of the source features from the auxiliary
+        features used by the DVE loss.
+
+        Args:
+            q (torch.Tensor): B x C x N tensor of queries
+            k (torch.Tensor): B x C x M tensor of keys
+            v (torch.Tensor): B x D x M tensor of values
+            tile_size (int :: 1024): the number of query and key locations
+                processed together.
+
+        Returns:
+            (torch.Tensor): B x D x N tensor of softmax weighted values.
+        """
+        with torch.no_grad():
+            B, N, M = q.shape[0], q.shape[2], k.shape[2]
+            lse = q.new_empty(B, N)
+            out = q.new_empty(B, v.shape[1], N)
+            for qs in chunks(N, tile_size):
+                q_ = q[:, :, qs].transpose(1, 2)
+                m = q_.new_full(q_.shape[:2], float("-inf"))
+                l = q_.new_zeros(q_.shape[:2])
+                acc = q_.new_zeros(q_.shape[:2] + (v.shape[1],))
+                for ks in chunks(M, tile_size):
+                    corr = torch.bmm(q_, k[:, :, ks])
+                    m_new = torch.max(m, corr.max(2)[0])
+                    scale = torch.exp(m - m_new)
+                    p = torch.exp(corr - m_new[:, :, None])
+                    l = l * scale + p.sum(2)
+                    acc = acc * scale[:, :, None] + torch.bmm(p, v[:, :, ks].transpose(1, 2))
+                    m = m_new
+                lse[:, qs] = m + l.log()
+                out[:, :, qs] = (acc / l[:, :, None]).transpose(1, 2)
+
+            params = torch.IntTensor([tile_size])
+            ctx.save_for_backward(q, k, v, lse, out, params)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        """Compute the tiled softmax attention backward pass.
+
+        Args:
+            (torch.Tensor): B x D x N gradient of the loss with respect to the
+                output of the attention.
+
+        Returns:
+            (torch.Tensor): B x C x N tensor of gradients
+            (torch.Tensor): B x C x M tensor of gradients
+            (torch.Tensor): B x D x M tensor of gradients
+            (None): no gradient for `tile_size`
+        """
+        q, k, v, lse, out, params = ctx.saved_tensors
+        tile_size = params[0].item()
+        N, M = q.shape[2], k.shape[2]
+
+        with torch.no_grad():
+            grad_q = torch.zeros_like(q)
+            grad_k = torch.zeros_like(k)
+            grad_v = torch.zeros_like(v)
+            delta = (grad_out * out).sum(1)
+            for qs in chunks(N, tile_size):
+                q_ = q[:, :, qs]
+                grad_out_ = grad_out[:, :, qs]
+                for ks in chunks(M, tile_size):
+                    k_, v_ = k[:, :, ks], v[:, :, ks]
+                    corr = torch.bmm(q_.transpose(1, 2), k_)
+                    smcorr = torch.exp(corr - lse[:, qs, None])
+                    grad_v[:, :, ks] += torch.bmm(grad_out_, smcorr)
+
+                    # softmax backward
+                    grad_smcorr = torch.bmm(grad_out_.transpose(1, 2), v_)
+                    grad_corr = smcorr * (grad_smcorr - delta[:, qs, None])
+                    grad_q[:, :, qs] += torch.bmm(k_, grad_corr.transpose(1, 2))
+                    grad_k[:, :, ks] += torch.bmm(q_, grad_corr)
+        return grad_q, grad_k, grad_v, None
+
+
+def rel_diff(x1, x2, name):
+    out = torch.abs(x1 - x2).sum() / torch.abs(x2).mean()
+    print("rel diff for {}: {}".format(name, out))
+
+
+def tiled_corr_check():
+    # tiles that do not divide the number of locations, to exercise the edges
+    B, C, N, M, tile_size = 3, 4, 16, 12, 5
+    common = {"dtype": torch.double, "requires_grad": True}
+    f1 = torch.randn(B, C, N, **common)
+    f2 = torch.randn(B, C, M, **common)
+    v = torch.randn(B, 3, M, **common)
+    grid_u = torch.rand(B, N, 2, dtype=torch.double) * 4
+    locs = torch.rand(M, 2, dtype=torch.double) * 4
+
+    args = (f1, f2, grid_u, locs, 0.5, tile_size)
+    test = gradcheck(TiledCorr.apply, args, eps=1e-6, atol=ATOL,
+                     raise_exception=True)
+    print("passed test: {}".format(test))
+
+    args = (f1, f2, v, tile_size)
+    test = gradcheck(TiledAttention.apply, args, eps=1e-6, atol=ATOL,
+                     raise_exception=True)
+    print("passed test: {}".format(test))
+
+    out = TiledAttention.apply(f1, f2, v, tile_size)
+    out_ref = torch.bmm(v, F.softmax(torch.bmm(f1.transpose(1, 2), f2), dim=2)
+                        .transpose(1, 2))
+    rel_diff(out, out_ref, "tiled attention")
+    assert torch.allclose(out, out_ref, atol=ATOL)
+
+
+def tiled_loss_check():
+    """Check that the tiled losses agree with the dense ones on both the loss value
+    and the gradients with respect to the features."""
+    B, C, H, W = 4, 4, 6, 6
+    feats = torch.randn(2 * B, C, H, W, dtype=torch.double, requires_grad=True)
+    grid = torch.rand(B, H, W, 2, dtype=torch.double) * 2 - 1
+    for loss_fn in (dense_correlation_loss, dense_correlation_loss_dve):
+        outs = {}
+        for tile_size in (None, 7):
+            loss = loss_fn([feats], {"grid": grid}, tile_size=tile_size)
+            grad, = torch.autograd.grad(loss, (feats,))
+            outs[tile_size] = (loss, grad)
+        for name, out, out_ref in zip(("loss", "feats"), outs[7], outs[None]):
+            rel_diff(out, out_ref, "{} tiled {}".format(loss_fn.__name__, name))
+            assert torch.allclose(out, out_ref, atol=ATOL)
+    print("passed test: True")
+
+
+if __name__ == "__main__":
+    tiled_corr_check()
+    tiled_loss_check()
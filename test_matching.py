@@ -18,6 +18,7 @@ from pathlib import Path
 from utils.visualization import norm_range
 import torch.nn.functional as F
 from utils.util import dict_coll
+from utils.loader_tuning import tuned_loader_settings
 from utils.tps import spatial_grid_unnormalized, tps_grid
 try:
     from tensorboardX import SummaryWriter
@@ -158,8 +159,10 @@ def evaluation(config, logger=None, eval_data=None):
     # NOTE: Since the matching is performed with pairs, we fix the ordering and then
     # use all pairs for datasets with even numbers of images, and all but one for
     # datasets that have odd numbers of images (via drop_last=True)
+    loader_settings = tuned_loader_settings(config, val_dataset, batch_size=2,
+                                            collate_fn=dict_coll, logger=logger)
     data_loader = DataLoader(val_dataset, batch_size=2, collate_fn=dict_coll,
-                             shuffle=False, drop_last=True)
+                             shuffle=False, drop_last=True, **loader_settings)
 
     # build model architecture
     model = get_instance(module_arch, 'arch', config)
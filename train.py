@@ -12,10 +12,12 @@ import utils.visualization as module_visualization
 from trainer import Trainer
 from utils import Logger, dict_coll
 from utils import tps, clean_state_dict, coll, NoGradWrapper, Up, get_instance
+from utils.loader_tuning import tuned_loader_settings
 from test_matching import evaluation
 import torch.nn as nn
 from parse_config import ConfigParser
 from torch.utils.data import DataLoader
+from data_loader.data_loaders import IterableDataset
 import torch.utils.data.dataloader
 
 
@@ -85,22 +87,29 @@ def main(config, resume):
 
         dataset = get_instance(module_data, 'dataset', config, pair_warper=warper,
                                train=True)
-        if config["disable_workers"]:
-            num_workers = 0
-        else:
-            num_workers = 4
 
         if config.get("restrict_annos", False):
             dataset.restrict_annos(num=config["restrict_annos"])
             logger.info(f"restricting annotation to {config['restrict_annos']} samples...")
 
+        loader_settings = tuned_loader_settings(
+            config,
+            dataset,
+            batch_size=int(config["batch_size"]),
+            collate_fn=loader_kwargs["collate_fn"],
+            default={"num_workers": 4, "pin_memory": True},
+            logger=logger,
+        )
+        # few-shot datasets (see `restrict_annos`) repeat their indices via a sampler
+        sampler = getattr(dataset, "repeat_sampler", None)
         data_loader = DataLoader(
             dataset,
             batch_size=int(config["batch_size"]),
-            num_workers=num_workers,
-            shuffle=True,
+            # streaming datasets shuffle their own shards
+            shuffle=sampler is None and not isinstance(dataset, IterableDataset),
+            sampler=sampler,
             drop_last=True,
-            pin_memory=True,
+            **loader_settings,
             **loader_kwargs,
         )
 
@@ -112,7 +121,14 @@ def main(config, resume):
             train=False,
             pair_warper=warper if warp_val else None,
         )
-        valid_data_loader = DataLoader(val_dataset, batch_size=32, **loader_kwargs)
+        # the validation loader only uses workers when they have been tuned, and only
+        # takes the worker count (the other settings were tuned for the training
+        # dataset and batch size)
+        val_settings = {}
+        if config.get("loader_autotune", False) and "num_workers" in loader_settings:
+            val_settings = {"num_workers": loader_settings["num_workers"]}
+        valid_data_loader = DataLoader(val_dataset, batch_size=32, **val_settings,
+                                       **loader_kwargs)
 
         # get function handles of loss and metrics
         loss = getattr(module_loss, config['loss'])
@@ -202,6 +218,8 @@ if __name__ == '__main__':
     parser.add_argument('--mini_train', action="store_true")
     parser.add_argument('--train_single_epoch', action="store_true")
     parser.add_argument('--disable_workers', action="store_true")
+    parser.add_argument('--autotune_loader', action="store_true",
+                        help='benchmark and pick the DataLoader worker settings')
     parser.add_argument('--check_bn_working', action="store_true")
     parser.add_argument('--vis', action="store_true")
     config = ConfigParser(parser)
@@ -217,6 +235,9 @@ if __name__ == '__main__':
     config["profile"] = args.profile
     config["vis"] = args.vis
     config["disable_workers"] = args.disable_workers
+    if args.autotune_loader and not config.get("loader_autotune", False):
+        # (a dict of autotuning options in the config is kept as it is)
+        config["loader_autotune"] = True
     config["trainer"]["check_bn_working"] = args.check_bn_working
 
     if args.train_single_epoch:
@@ -2,11 +2,14 @@ import numpy as np
 import torch
 import time
 import datetime
+from pathlib import Path
 from torchvision.utils import make_grid
 from pkg_resources import parse_version
 from base import BaseTrainer
 from torch.nn.modules.batchnorm import _BatchNorm
 from model.metric import runningIOU
+from utils.val_cache import BatchCache, VAL_CACHE_VERSION
+from utils.loader_tuning import config_hash
 
 
 class AverageMeter(object):
@@ -107,15 +110,18 @@ class Trainer(BaseTrainer):
             # preallocation of the tensor caches
             init_batcher = torch.utils.data.DataLoader(datasets["train"], batch_size=1)
             with torch.no_grad():
-                batch = next(iter(init_batcher))
+                batch = self._prepare_batch(next(iter(init_batcher)), datasets["train"])
                 dd, mm = batch["data"], batch["meta"]
                 feat_shape = self.model[0].forward(dd.to(self.device))[0].shape
                 keypts_shape = mm["keypts"].shape
 
 
             for key, dataset in datasets.items():
-                batcher = torch.utils.data.DataLoader(dataset, batch_size=100,
-                                                       num_workers=4)
+                batcher = torch.utils.data.DataLoader(
+                    dataset,
+                    batch_size=100,
+                    num_workers=self.data_loader.num_workers,
+                )
                 self.cache[key] = torch.zeros(len(dataset), *feat_shape[1:])
                 self.meta_cache[key] = {
                     "keypts": torch.zeros(len(dataset), *keypts_shape[1:]),
@@ -123,6 +129,7 @@ class Trainer(BaseTrainer):
                 }
                 for ii, batch in enumerate(batcher):
                     with torch.no_grad():
+                        batch = self._prepare_batch(batch, dataset)
                         dd, mm = batch["data"], batch["meta"]
                         fw = self.model[0].forward(dd.to(self.device))[0].to('cpu')
                         self.cache[key][mm["index"]] = fw
@@ -145,6 +152,42 @@ class Trainer(BaseTrainer):
         # done directly via an AverageMeter
         self.log_miou = self.config["trainer"].get("log_miou", False)
 
+        # Optionally replay the (deterministic) validation batches after the first pass
+        self.val_cache = None
+        val_cache = self.config.get("val_cache", False)
+        if val_cache and self.do_validation:
+            opts = {"mode": val_cache} if isinstance(val_cache, str) else dict(val_cache)
+            opts.setdefault("cache_dir", Path(config["trainer"]["save_dir"]) / "val_cache")
+            checksum = config_hash(
+                config["dataset"],
+                config.get("warper", None),
+                config.get("warp_val", True),
+                config.get("cache_descriptors", False),
+                type(self.valid_data_loader.dataset).__name__,
+                len(self.valid_data_loader.dataset),
+                self.valid_data_loader.batch_size,
+                VAL_CACHE_VERSION,
+            )
+            self.val_cache = BatchCache(checksum, **opts)
+
+    def _prepare_batch(self, batch, dataset):
+        """Apply any warping that the dataset defers until after collation."""
+        if getattr(dataset, "batch_warp", False) and dataset.warper is not None:
+            batch = dataset.warp_batch(batch, device=self.device)
+        return batch
+
+    def _valid_batches(self):
+        """Iterate over the prepared validation batches, which are replayed from the
+        validation cache (if enabled) after the first complete pass."""
+        dataset = self.valid_data_loader.dataset
+        if self.val_cache is not None and self.val_cache.ready:
+            return self.val_cache.replay()
+        batches = (self._prepare_batch(batch, dataset)
+                   for batch in self.valid_data_loader)
+        if self.val_cache is not None:
+            return self.val_cache.record(batches)
+        return batches
+
     def _eval_metrics(self, output, target):
         acc_metrics = np.zeros(len(self.metrics))
         for i, metric in enumerate(self.metrics):
@@ -189,6 +232,7 @@ class Trainer(BaseTrainer):
         if profile:
             batch_tic = time.time()
         for batch_idx, batch in enumerate(self.data_loader):
+            batch = self._prepare_batch(batch, self.data_loader.dataset)
             data, meta = batch["data"], batch["meta"]
             data = data.to(self.device)
             seen_batch = data.shape[0]
@@ -349,7 +393,7 @@ class Trainer(BaseTrainer):
 
         with torch.no_grad():
             torch.manual_seed(0)
-            for batch_idx, batch in enumerate(self.valid_data_loader):
+            for batch_idx, batch in enumerate(self._valid_batches()):
                 data, meta = batch["data"], batch["meta"]
                 data = data.to(self.device)
 
@@ -411,7 +455,7 @@ class Trainer(BaseTrainer):
             avg_val_loss_trainbn = AverageMeter()
             with torch.no_grad():
                 torch.manual_seed(0)
-                for batch_idx, batch in enumerate(self.valid_data_loader):
+                for batch_idx, batch in enumerate(self._valid_batches()):
                     data, meta = batch["data"], batch["meta"]
                     data = data.to(self.device)
 
@@ -0,0 +1,199 @@
+"""Pick DataLoader settings by benchmarking them on the dataset that will be used.
+
+The best number of workers (and the related prefetching/pinning options) depends on
+the machine, the dataset and the warper configuration, so a fixed value either leaves
+cores idle or oversubscribes them.  `autotune_loader` runs a short staged search,
+reports the throughput of every candidate and caches the winner per host and config.
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import inspect
+import torch
+from pathlib import Path
+from torch.utils.data import DataLoader
+from data_loader.data_loaders import IterableDataset
+
+AUTOTUNE_CACHE = Path.home() / ".cache" / "dve" / "loader_autotune.json"
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def supported_options():
+    """`prefetch_factor` and `persistent_workers` require torch>=1.7."""
+    params = inspect.signature(DataLoader.__init__).parameters
+    return [x for x in ("prefetch_factor", "persistent_workers") if x in params]
+
+
+def config_hash(*parts):
+    """Summarise the parts of a config that influence loading speed."""
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.md5(blob.encode("utf-8")).hexdigest()[:12]
+
+
+def benchmark_loader(dataset, settings, batch_size, num_batches, collate_fn=None,
+                     prepare=None, passes=2):
+    """Measure the throughput (samples/sec) of a DataLoader.
+
+    The batches are split over `passes` iterators, so that the cost of (re)starting
+    the workers at the beginning of every epoch is included in the measurement.
+
+    Args:
+        dataset (Dataset): the dataset to be loaded.
+        settings (dict): the DataLoader keyword arguments to be benchmarked.
+        batch_size (int): the minibatch size.
+        num_batches (int): the total number of minibatches to be loaded.
+        collate_fn (callable): the collation function (if any).
+        prepare (callable): applied to each minibatch (e.g. deferred warping).
+        passes (int :: 2): the number of simulated epochs.
+
+    Returns:
+        (float): the number of samples loaded per second.
+    """
+    kwargs = dict(settings)
+    if collate_fn is not None:
+        kwargs["collate_fn"] = collate_fn
+    sampler = getattr(dataset, "repeat_sampler", None)
+    loader = DataLoader(dataset, batch_size=batch_size, drop_last=True, sampler=sampler,
+                        shuffle=sampler is None and not isinstance(dataset, IterableDataset),
+                        **kwargs)
+    per_pass = max(1, num_batches // passes)
+    samples = 0
+    tic = time.time()
+    for _ in range(passes):
+        for ii, batch in enumerate(loader):
+            if prepare is not None:
+                batch = prepare(batch)
+            samples += batch_size
+            if ii + 1 == per_pass:
+                break
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    rate = samples / (time.time() - tic)
+    del loader
+    return rate
+
+
+def load_cache(cache_path):
+    if not Path(cache_path).exists():
+        return {}
+    with open(str(cache_path), "r") as f:
+        return json.load(f)
+
+
+def autotune_loader(dataset, batch_size, key, collate_fn=None, prepare=None,
+                    num_batches=200, max_workers=None, cache_path=AUTOTUNE_CACHE,
+                    refresh=False, logger=None):
+    """Return the fastest DataLoader settings for `dataset` on the current host.
+
+    The search is staged: the number of workers is chosen first, followed by
+    `pin_memory`, `prefetch_factor` and `persistent_workers` (where supported), each
+    keeping the best settings found so far.
+
+    Args:
+        dataset (Dataset): the dataset to be loaded.
+        batch_size (int): the minibatch size.
+        key (str): identifies the dataset/warper configuration (see `config_hash`).
+        collate_fn (callable): the collation function (if any).
+        prepare (callable): applied to each minibatch during benchmarking.
+        num_batches (int :: 200): the number of minibatches loaded per candidate.
+        max_workers (int): the largest number of workers to try (defaults to the
+            number of available cpus).
+        cache_path (str): the json file in which tuned settings are stored.
+        refresh (bool :: False): whether to ignore previously cached settings.
+        logger (logging.Logger): used to report results (defaults to print).
+
+    Returns:
+        (dict): DataLoader keyword arguments.
+    """
+    log = print if logger is None else logger.info
+    cache_key = "{}/{}".format(socket.gethostname(), key)
+    cache = load_cache(cache_path)
+    if cache_key in cache and not refresh:
+        entry = cache[cache_key]
+        log("Using cached DataLoader settings {} ({:.1f} samples/sec)".format(
+            entry["settings"], entry["samples_per_sec"]))
+        return entry["settings"]
+
+    max_workers = max_workers or available_cpus()
+    worker_counts = [x for x in (0, 2, 4, 8, 12, 16, 24, 32, 48, 64, 96)
+                     if x <= max_workers]
+    results = []
+
+    def trial(settings):
+        rate = benchmark_loader(dataset, settings, batch_size=batch_size,
+                                num_batches=num_batches, collate_fn=collate_fn,
+                                prepare=prepare)
+        results.append({"settings": settings, "samples_per_sec": rate})
+        log("DataLoader autotune: {} -> {:.1f} samples/sec".format(settings, rate))
+        return rate
+
+    def stage(best, best_rate, option, values):
+        for value in values:
+            candidate = {**best, option: value}
+            if candidate == best:
+                continue
+            rate = trial(candidate)
+            if rate > best_rate:
+                best, best_rate = candidate, rate
+        return best, best_rate
+
+    best = {"num_workers": 0, "pin_memory": torch.cuda.is_available()}
+    best, best_rate = stage(best, trial(best), "num_workers", worker_counts)
+    if torch.cuda.is_available():
+        best, best_rate = stage(best, best_rate, "pin_memory", [False])
+    if best["num_workers"] > 0:
+        options = supported_options()
+        if "prefetch_factor" in options:
+            best, best_rate = stage(best, best_rate, "prefetch_factor", [2, 4, 8])
+        if "persistent_workers" in options:
+            best, best_rate = stage(best, best_rate, "persistent_workers", [True])
+    log("Selected DataLoader settings {} ({:.1f} samples/sec)".format(best, best_rate))
+
+    cache = load_cache(cache_path)
+    cache[cache_key] = {
+        "settings": best,
+        "samples_per_sec": best_rate,
+        "results": results,
+        "timestamp": time.strftime("%Y-%m-%d_%H-%M-%S"),
+    }
+    try:
+        Path(cache_path).parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = "{}.tmp-{}".format(cache_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, str(cache_path))
+    except OSError as exc:
+        log("could not write DataLoader settings to {} ({})".format(cache_path, exc))
+    return best
+
+
+def tuned_loader_settings(config, dataset, batch_size, collate_fn=None, default=None,
+                          logger=None):
+    """Return the DataLoader settings to be used for `dataset` under `config`.
+
+    If `loader_autotune` is set in the config (either `true` or a dict of keyword
+    arguments for `autotune_loader`), the settings are tuned for the current host.
+    Otherwise `default` is returned.
+    """
+    if config.get("disable_workers", False):
+        return {"num_workers": 0}
+    opts = config.get("loader_autotune", False)
+    if not opts:
+        return dict(default or {})
+    opts = {} if opts is True else dict(opts)
+    key = config_hash(config["dataset"], config.get("warper", None), batch_size,
+                      type(dataset).__name__, torch.cuda.device_count())
+    prepare = None
+    if getattr(dataset, "batch_warp", False) and dataset.warper is not None:
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        prepare = lambda batch: dataset.warp_batch(batch, device=device)
+    return autotune_loader(dataset, batch_size, key=key, collate_fn=collate_fn,
+                           prepare=prepare, logger=logger, **opts)
@@ -1,6 +1,13 @@
+import os
+import json
+import math
+import shutil
+import hashlib
+import tempfile
 import torch
+import numpy as np
 import torch.nn.functional as F
-import math
+from pathlib import Path
 
 
 def tps_grid(H, W):
@@ -34,41 +41,259 @@ def tps_U(grid1, grid2):
 # return x.reshape(grid.shape)
 
 def grid_unnormalize(grid, H, W):
-    x = grid.reshape(-1, H, W, 2)
-    constants = torch.tensor([W - 1., H - 1.], dtype=x.dtype)
-    constants = constants.reshape(1, 1, 1, 2).to(x.device)
-    x = (x + 1.) / 2. * constants
-    return x.reshape(grid.shape)
+    """Map normalized coordinates to pixels of an H x W image (the grid itself may
+    cover any region, e.g. the cropped part of an image)."""
+    constants = torch.tensor([W - 1., H - 1.], dtype=grid.dtype).to(grid.device)
+    return (grid + 1.) / 2. * constants
 
 
 def grid_normalize(grid, H, W):
-    x = grid.reshape(-1, H, W, 2)
-    x = 2. * x / torch.Tensor([W - 1., H - 1.]).reshape(1, 1, 1, 2).to(x.device) - 1
-    return x.reshape(grid.shape)
+    return 2. * grid / torch.Tensor([W - 1., H - 1.]).to(grid.device) - 1
 
 
-def random_tps_weights(nctrlpts, warpsd_all, warpsd_subset, transsd, scalesd, rotsd):
-    W = torch.randn(nctrlpts, 2) * warpsd_all
-    subset = torch.rand(W.shape) > 0.5
-    W[subset] = torch.randn(subset.sum()) * warpsd_subset
-    rot = torch.randn([]) * rotsd * math.pi / 180
-    sc = 1. + torch.randn([]) * scalesd
-    tx = torch.randn([]) * transsd
-    ty = torch.randn([]) * transsd
+def per_warp(sd, ndim):
+    """Broadcast a hyperparameter (a scalar, or a tensor with one value per warp)
+    against samples with `ndim` dimensions, the first of which indexes the warps."""
+    sd = torch.as_tensor(sd, dtype=torch.float32)
+    return sd.reshape((-1,) + (1,) * (ndim - 1))
+
 
-    aff = torch.Tensor([[tx, ty],
-                        [sc * torch.cos(rot), sc * -torch.sin(rot)],
-                        [sc * torch.sin(rot), sc * torch.cos(rot)]])
+def random_affine_batch(B, transsd, scalesd, rotsd):
+    """Sample the affine parts of `B` sets of TPS weights as a B x 3 x 2 tensor (the
+    translation, followed by the 2 x 2 linear map that is applied to row vectors of
+    grid coordinates)."""
+    rot = torch.randn(B) * per_warp(rotsd, 1) * math.pi / 180
+    sc = 1. + torch.randn(B) * per_warp(scalesd, 1)
+    trans = torch.randn(B, 2) * per_warp(transsd, 2)
+    cos, sin = sc * torch.cos(rot), sc * torch.sin(rot)
+    lin = torch.stack((torch.stack((cos, -sin), 1), torch.stack((sin, cos), 1)), 1)
+    return torch.cat((trans.unsqueeze(1), lin), 1)
 
-    Wa = torch.cat((W, aff), 0)
-    return Wa
+
+def random_tps_weights_batch(B, nctrlpts, warpsd_all, warpsd_subset, transsd, scalesd,
+                             rotsd):
+    """Sample weights for `B` independent warps, stacked as a (nctrlpts + 3) x 2B matrix
+    so that all of their grids can be evaluated with a single matmul against `F`.
+
+    Each hyperparameter is either a scalar, or a tensor with one value per warp (so
+    that e.g. both warps of a pair can be drawn together)."""
+    W = torch.randn(B, nctrlpts, 2) * per_warp(warpsd_all, 3)
+    subset = torch.rand(B, nctrlpts, 2) > 0.5
+    W = torch.where(subset, torch.randn(B, nctrlpts, 2) * per_warp(warpsd_subset, 3), W)
+    Wa = torch.cat((W, random_affine_batch(B, transsd, scalesd, rotsd)), 1)
+    return Wa.permute(1, 0, 2).reshape(nctrlpts + 3, 2 * B)
+
+
+def random_tps_weights(nctrlpts, warpsd_all, warpsd_subset, transsd, scalesd, rotsd):
+    return random_tps_weights_batch(1, nctrlpts, warpsd_all, warpsd_subset, transsd,
+                                    scalesd, rotsd)
+
+
+def tps_grids(F, weights, H, W):
+    """Evaluate the (B x H x W x 2) grids for a stack of weights from
+    `random_tps_weights_batch`."""
+    B = weights.shape[1] // 2
+    grids = torch.matmul(F, weights.to(F.device))
+    return grids.reshape(H, W, B, 2).permute(2, 0, 1, 3)
+
+
+def compose_grids(grid1, grid2):
+    """Return the grid that samples an image in the same way as sampling it with
+    `grid1` and then sampling the result with `grid2` (but with a single
+    interpolation).
+
+    Locations at which `grid2` falls outside the intermediate image are mapped
+    outside of the source image, so that they remain empty, as with zero padding.
+    """
+    composite = F.grid_sample(grid1.permute(0, 3, 1, 2), grid2, padding_mode="border")
+    composite = composite.permute(0, 2, 3, 1)
+    outside = (grid2.abs() > 1).sum(3, keepdim=True) > 0
+    return composite.masked_fill(outside, 2.)
+
+
+def batch_weights(weights):
+    """Reshape stacked weights from `random_tps_weights_batch` to B x (nctrlpts + 3) x 2."""
+    return weights.reshape(weights.shape[0], -1, 2).permute(1, 0, 2)
+
+
+def random_tps_warps(F, B, H, W, *args):
+    """Sample `B` warps (see `random_tps_weights_batch` for the hyperparameters).
+
+    Returns:
+        (torch.Tensor, torch.Tensor): the B x H x W x 2 grids, evaluated with a single
+            matmul against `F`, and the B x (nctrlpts + 3) x 2 weights.
+    """
+    weights = random_tps_weights_batch(B, F.shape[1] - 3, *args)
+    return tps_grids(F, weights, H, W), batch_weights(weights)
+
+
+def tps_warp_keypoints(keypoints, weights, ctrlpts, H, W, iters=5):
+    """Find the output locations of keypoints under the inverse TPS warp.
+
+    The warp maps each output pixel u to the source location g(u) from which it is
+    sampled, so the warped position of a source keypoint p is the solution of
+    g(u) = p.  This is found with a few Newton iterations, using the analytic
+    Jacobian of the TPS mapping (initialised from the inverse of its affine part).
+
+    Args:
+        keypoints (torch.Tensor): (B x) K x 2 keypoints in pixel coordinates.
+        weights (torch.Tensor): (B x) (nctrlpts + 3) x 2 TPS weights.
+        ctrlpts (torch.Tensor): nctrlpts x 2 grid of control points.
+        H, W (int): the size of the image in pixels.
+        iters (int :: 5): the number of Newton iterations.
+
+    Returns:
+        (torch.Tensor): (B x) K x 2 warped keypoints in pixel coordinates.
+    """
+    keypoints = torch.as_tensor(keypoints, dtype=torch.float32)
+    unbatched = keypoints.dim() == 2
+    if unbatched:
+        keypoints = keypoints.unsqueeze(0)
+        weights = weights.unsqueeze(0)
+    n = ctrlpts.shape[0]
+    wts, aff = weights[:, :n], weights[:, n:]
+    lin = aff[:, 1:].transpose(1, 2)  # B x 2 x 2, d g_i / d x_j of the affine part
+    scale = torch.tensor([W - 1., H - 1.])
+    target = 2. * keypoints / scale - 1
+
+    def inv2x2(M):
+        det = M[..., 0, 0] * M[..., 1, 1] - M[..., 0, 1] * M[..., 1, 0]
+        adj = torch.stack((torch.stack((M[..., 1, 1], -M[..., 0, 1]), -1),
+                           torch.stack((-M[..., 1, 0], M[..., 0, 0]), -1)), -2)
+        return adj / det[..., None, None]
+
+    x = torch.matmul(target - aff[:, :1], inv2x2(lin).transpose(1, 2))
+    for _ in range(iters):
+        D = x[:, :, None, :] - ctrlpts[None, None]
+        r2 = (D ** 2).sum(3)
+        logr2 = torch.log(r2 + 1e-5)
+        g = torch.matmul(r2 * logr2, wts) + aff[:, :1] + torch.matmul(x, aff[:, 1:])
+        dU = 2 * (logr2 + r2 / (r2 + 1e-5))
+        J = torch.einsum('bkn,bni,bknj->bkij', dU, wts, D) + lin[:, None]
+        step = torch.matmul(inv2x2(J), (g - target).unsqueeze(3)).squeeze(3)
+        x = x - step
+
+    x = x.clamp(-1, 1)
+    new_keypoints = (x + 1.) / 2. * scale
+    return new_keypoints.squeeze(0) if unbatched else new_keypoints
+
+
+def warp_keypoints_nearest(keypoints, grid_unnormalized, grid_pixels_unnormalized):
+    """Nearest-neighbour reference for `tps_warp_keypoints` (used for checks)."""
+    from scipy.spatial.kdtree import KDTree
+    warp_grid = grid_unnormalized.reshape(-1, 2)
+    regular_grid = grid_pixels_unnormalized.reshape(-1, 2)
+    kd = KDTree(warp_grid)
+    dists, idxs = kd.query(keypoints)
+    return regular_grid[idxs]
+
+
+class WarpBank(object):
+    """A memory-mapped bank of pre-generated TPS warps.
+
+    The bank stores the non-linear part of `size` random warps (with an identity
+    affine part) for each named family of warp hyperparameters, together with their
+    dense grids.  A sample composes a random entry with a freshly drawn affine map,
+    which is equivalent to composing the weights:
+
+        g(u) = (F_u W) A + t = F_u (W A + t e_n)
+
+    where e_n selects the row of the weights that multiplies the constant column
+    of F.  The affine part of the original warps is thereby reproduced exactly, and
+    only the (expensive) non-linear part is reused.
+
+    NOTE: the random linear map A also multiplies the non-linear TPS weights (W A),
+    i.e. the non-linear displacements are rotated and multiplied by the random scale
+    `1 + N(0, scalesd)` along with the image.  When warps are drawn directly, the
+    non-linear weights are independent of the affine part, so the distribution of
+    banked warps differs slightly (that of the non-linear displacements is widened).
+
+    Banks are generated in a temporary directory that is renamed into place, so
+    that concurrent runs (e.g. several jobs or distributed ranks) never read a
+    partially written bank.
+
+    Args:
+        bank_dir (str): the parent directory of the banks. Each bank is stored in a
+            sub-directory named after its dimensions and a hash of its settings.
+        F (torch.Tensor): the (H * W) x (nctrlpts + 3) TPS basis.
+        H, W (int): the size of the warp grids.
+        families (dict): maps family names to (warpsd_all, warpsd_subset).
+        size (int): the number of warps per family.
+    """
+
+    def __init__(self, bank_dir, F, H, W, families, size=2000, chunk=100):
+        self.size = size
+        self.nctrlpts = F.shape[1] - 3
+        settings = {"H": H, "W": W, "size": size, "nctrlpts": self.nctrlpts,
+                    "families": {k: list(v) for k, v in families.items()}}
+        digest = hashlib.md5(json.dumps(settings, sort_keys=True).encode("utf-8"))
+        self.bank_dir = Path(bank_dir) / "{}x{}-{}".format(H, W, digest.hexdigest()[:10])
+        if not (self.bank_dir / "meta.json").exists():
+            self.generate(F, H, W, families, settings, chunk)
+        self.grids = {}
+        self.weights = {}
+        for name in families:
+            path = self.bank_dir / "{}-grids.npy".format(name)
+            self.grids[name] = np.load(str(path), mmap_mode="r")
+            path = self.bank_dir / "{}-weights.npy".format(name)
+            self.weights[name] = torch.from_numpy(np.load(str(path)))
+
+    def generate(self, F, H, W, families, settings, chunk):
+        self.bank_dir.parent.mkdir(exist_ok=True, parents=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=str(self.bank_dir.parent),
+                                        prefix=self.bank_dir.name + ".tmp-"))
+        try:
+            for name, (warpsd_all, warpsd_subset) in families.items():
+                weights = random_tps_weights_batch(self.size, self.nctrlpts, warpsd_all,
+                                                   warpsd_subset, 0, 0, 0)
+                weights = batch_weights(weights)
+                grids = np.lib.format.open_memmap(
+                    str(tmp_dir / "{}-grids.npy".format(name)), mode="w+",
+                    dtype=np.float32, shape=(self.size, H, W, 2))
+                for start in range(0, self.size, chunk):
+                    stacked = weights[start:start + chunk].permute(1, 0, 2)
+                    stacked = stacked.reshape(self.nctrlpts + 3, -1)
+                    grids[start:start + chunk] = tps_grids(F, stacked, H, W).numpy()
+                grids.flush()
+                del grids
+                np.save(str(tmp_dir / "{}-weights.npy".format(name)), weights.numpy())
+            with open(str(tmp_dir / "meta.json"), "w") as f:
+                json.dump(settings, f, indent=4)
+            os.rename(str(tmp_dir), str(self.bank_dir))
+            print("generated TPS warp bank at {}".format(self.bank_dir))
+        except OSError:
+            # another process renamed its (identical) bank into place first
+            if not (self.bank_dir / "meta.json").exists():
+                raise
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(str(tmp_dir))
+
+    def sample(self, family, B, transsd, scalesd, rotsd):
+        """Draw `B` warps from a family, each composed with a random affine map.
+
+        Returns:
+            (torch.Tensor, torch.Tensor): the B x H x W x 2 grids and the
+                B x (nctrlpts + 3) x 2 weights of the composed warps.
+        """
+        picks = torch.randint(self.size, (B,))
+        grids = torch.from_numpy(np.stack([self.grids[family][int(k)] for k in picks]))
+        weights = self.weights[family][picks]
+        aff = random_affine_batch(B, transsd, scalesd, rotsd)
+        lin, trans = aff[:, 1:], aff[:, :1]
+        H, W = grids.shape[1:3]
+        grids = torch.matmul(grids.reshape(B, -1, 2), lin) + trans
+        weights = torch.matmul(weights, lin)
+        weights[:, self.nctrlpts] += trans[:, 0]
+        return grids.reshape(B, H, W, 2), weights
 
 
 class Warper(object):
     returns_pairs = True
 
     def __init__(self, H, W, warpsd_all=0.001, warpsd_subset=0.01, transsd=0.1,
-                 scalesd=0.1, rotsd=5, im1_multiplier=0.5, im1_multiplier_aff=1.):
+                 scalesd=0.1, rotsd=5, im1_multiplier=0.5, im1_multiplier_aff=1.,
+                 warp_bank=None, bank_size=2000, compose_warps=False):
         self.H = H
         self.W = W
         self.warpsd_all = warpsd_all
@@ -78,6 +303,7 @@ class Warper(object):
         self.rotsd = rotsd
         self.im1_multiplier = im1_multiplier
         self.im1_multiplier_aff = im1_multiplier_aff
+        self.compose_warps = compose_warps
 
         self.npixels = H * W
         self.nc = 10
@@ -90,45 +316,39 @@ class Warper(object):
         self.U_pixels_ctrlpts = tps_U(self.grid_pixels, self.grid_ctrlpts)
         self.F = torch.cat((self.U_pixels_ctrlpts, torch.ones(self.npixels, 1), self.grid_pixels), 1)
 
+        self.bank = None
+        if warp_bank is not None:
+            a = self.im1_multiplier
+            families = {"warp1": (a * warpsd_all, a * warpsd_subset),
+                        "warp2": (warpsd_all, warpsd_subset)}
+            self.bank = WarpBank(warp_bank, self.F, H, W, families, size=bank_size)
+
     def __call__(self, im1, im2=None, keypts=None, crop=0):
         Hc = self.H - crop - crop
         Wc = self.W - crop - crop
 
-        # im2 should be a copy of im1 with different colour jitter
-        if im2 is None:
-            im2 = im1
-
+        # im2 should be a copy of im1 with different colour jitter (if it is not
+        # given, both views are warped from im1)
         kp1 = kp2 = 0
 
         unsqueezed = False
         if len(im1.shape) == 3:
             im1 = im1.unsqueeze(0)
-            im2 = im2.unsqueeze(0)
+            if im2 is not None:
+                im2 = im2.unsqueeze(0)
             unsqueezed = True
 
-        assert im1.shape[0] == 1 and im2.shape[0] == 1
+        assert im1.shape[0] == 1 and (im2 is None or im2.shape[0] == 1)
 
-        a = self.im1_multiplier
-        b = self.im1_multiplier_aff
-        weights1 = random_tps_weights(self.nctrlpts, a * self.warpsd_all, a * self.warpsd_subset, b * self.transsd,
-                                      b * self.scalesd, b * self.rotsd)
-
-        grid1 = torch.matmul(self.F, weights1).reshape(1, self.H, self.W, 2)
-        grid1_unnormalized = grid_unnormalize(grid1, self.H, self.W)
+        # the second warp (and hence the flow and grid) is only evaluated on the
+        # retained region, while im2 must first be warped in full, since the second
+        # warp may sample from anywhere in it
+        grid1, grid2, weights1, weights2 = self.sample_pairs(1, im1.device, crop)
+        weights1, weights2 = weights1[0], weights2[0]
         if keypts is not None:
-            kp1 = self.warp_keypoints(keypts, grid1_unnormalized)
-
-        im1 = F.grid_sample(im1, grid1)
-        im2 = F.grid_sample(im2, grid1)
+            kp1 = self.warp_keypoints(keypts, weights1)
 
-        weights2 = random_tps_weights(self.nctrlpts, self.warpsd_all, self.warpsd_subset, self.transsd,
-                                      self.scalesd, self.rotsd)
-        grid2 = torch.matmul(self.F, weights2).reshape(1, self.H, self.W, 2)
-        im2 = F.grid_sample(im2, grid2)
-
-        if crop != 0:
-            im1 = im1[:, :, crop:-crop, crop:-crop]
-            im2 = im2[:, :, crop:-crop, crop:-crop]
+        im1, im2 = self.warp_views(im1, im2, grid1, grid2, crop)
 
         if unsqueezed:
             im1 = im1.squeeze(0)
@@ -138,20 +358,12 @@ class Warper(object):
         grid_unnormalized = grid_unnormalize(grid, self.H, self.W)
 
         if keypts is not None:
-            kp2 = self.warp_keypoints(kp1, grid_unnormalized)
+            kp2 = self.warp_keypoints(kp1, weights2)
 
-        flow = grid_unnormalized - self.grid_pixels_unnormalized
+        flow = grid_unnormalized - self.crop_pixels(crop, im1.device)
 
         if crop != 0:
-            flow = flow[:, crop:-crop, crop:-crop, :]
-
-            grid_cropped = grid_unnormalized[:, crop:-crop, crop:-crop, :] - crop
-            grid = grid_normalize(grid_cropped, Hc, Wc)
-
-            # hc = flow.shape[1]
-            # wc = flow.shape[2]
-            # gridc = flow + grid_unnormalize(tps_grid(hc, wc).reshape(1, hc, wc, 2), hc, wc)
-            # grid = grid_normalize(gridc, hc, wc)
+            grid = grid_normalize(grid_unnormalized - crop, Hc, Wc)
 
             if keypts is not None:
                 kp1 -= crop
@@ -161,21 +373,144 @@ class Warper(object):
         # and we want to be consistent with optical flow from videos
         return im2, im1, flow, grid, kp2, kp1
 
-    def warp_keypoints(self, keypoints, grid_unnormalized):
-        from scipy.spatial.kdtree import KDTree
-        warp_grid = grid_unnormalized.reshape(-1, 2)
-        regular_grid = self.grid_pixels_unnormalized.reshape(-1, 2)
-        kd = KDTree(warp_grid)
-        dists, idxs = kd.query(keypoints)
-        new_keypoints = regular_grid[idxs]
-        return new_keypoints
+    def warp_batch(self, ims, keypts=None, crop=0):
+        """Warp a minibatch of images with independent TPS warps.
+
+        Batched counterpart of `__call__` that can be run after collation (e.g. on
+        the training device). The grids for the whole minibatch are produced by
+        matmuls against `self.F`.
+
+        Args:
+            ims (torch.Tensor): B x C x H x W tensor of images (in the range 0-255).
+            keypts (torch.Tensor): B x K x 2 tensor of keypoints (or None).
+            crop (int :: 0): the border to be removed after warping.
+
+        Returns:
+            The same tuple as `__call__`, with a leading batch dimension on every
+            element.
+        """
+        B = ims.shape[0]
+        Hc = self.H - crop - crop
+        Wc = self.W - crop - crop
+        grid1, grid2, weights1, weights2 = self.sample_pairs(B, ims.device, crop)
+
+        im1, im2 = self.warp_views(ims, None, grid1, grid2, crop)
+
+        grid_unnormalized = grid_unnormalize(grid2, self.H, self.W)
+        kp1 = kp2 = 0
+        if keypts is not None:
+            kp1 = self.warp_keypoints(keypts.cpu(), weights1)
+            kp2 = self.warp_keypoints(kp1, weights2)
+
+        flow = grid_unnormalized - self.crop_pixels(crop, ims.device)
+        grid = grid2
+        if crop != 0:
+            grid = grid_normalize(grid_unnormalized - crop, Hc, Wc)
+            if keypts is not None:
+                kp1 -= crop
+                kp2 -= crop
+
+        return im2, im1, flow, grid, kp2, kp1
+
+    def warp_views(self, im1, im2, grid1, grid2, crop):
+        """Warp the first view by `grid1`, and the second view by `grid1` followed by
+        `grid2` (which covers the retained region only).  `im2=None` means that both
+        views are warped from `im1`, so the first warp is only applied once.
+
+        With `compose_warps`, the two warps of the second view are composed into a
+        single grid, so that it is interpolated once rather than twice.
+        """
+        region = (slice(None), slice(None), slice(crop, self.H - crop),
+                  slice(crop, self.W - crop))
+        if self.compose_warps:
+            src = im1 if im2 is None else im2
+            im2 = F.grid_sample(src, compose_grids(grid1, grid2))
+            im1 = F.grid_sample(im1, grid1[region[1:]])
+        elif im2 is None:
+            im1 = F.grid_sample(im1, grid1)
+            im2 = F.grid_sample(im1, grid2)
+            im1 = im1[region]
+        else:
+            im2 = F.grid_sample(F.grid_sample(im2, grid1), grid2)
+            im1 = F.grid_sample(im1, grid1[region[1:]])
+        return im1, im2
+
+    def pair_hyperparams(self, B):
+        """Return the warp hyperparameters (warpsd_all, warpsd_subset, transsd,
+        scalesd, rotsd) of the first and then the second warps of `B` pairs, each as a
+        tensor with 2B values."""
+        a = self.im1_multiplier
+        b = self.im1_multiplier_aff
+        sds = torch.tensor([self.warpsd_all, self.warpsd_subset, self.transsd,
+                            self.scalesd, self.rotsd])
+        multipliers = torch.tensor([[a, a, b, b, b], [1., 1., 1., 1., 1.]])
+        return (multipliers * sds).repeat_interleave(B, 0).t()
+
+    def sample_pairs(self, B, device, crop=0):
+        """Sample the first and second warps of `B` pairs.
+
+        The weights of all 2B warps are drawn together.  The grids of the second
+        warps are only evaluated for the pixels that remain after removing a border of
+        `crop` pixels.
+
+        Returns:
+            (tuple): the B x H x W x 2 grids of the first warps, the
+                B x (H - 2 crop) x (W - 2 crop) x 2 grids of the second warps, followed
+                by their B x (nctrlpts + 3) x 2 weights.
+        """
+        if self.bank is not None:
+            b = self.im1_multiplier_aff
+            grid1, weights1 = self.bank.sample("warp1", B, b * self.transsd,
+                                               b * self.scalesd, b * self.rotsd)
+            grid2, weights2 = self.bank.sample("warp2", B, self.transsd, self.scalesd,
+                                               self.rotsd)
+            grid2 = grid2[:, crop:self.H - crop, crop:self.W - crop]
+            return grid1.to(device), grid2.to(device), weights1, weights2
+        weights = random_tps_weights_batch(2 * B, self.nctrlpts,
+                                           *self.pair_hyperparams(B))
+        grid1 = tps_grids(self.basis(device), weights[:, :2 * B], self.H, self.W)
+        grid2 = tps_grids(self.crop_basis(crop, device), weights[:, 2 * B:],
+                          self.H - 2 * crop, self.W - 2 * crop)
+        weights = batch_weights(weights)
+        return grid1, grid2, weights[:B], weights[B:]
+
+    def basis(self, device):
+        """Return `self.F` on the given device (the copy is kept, so that it is only
+        transferred once)."""
+        device = torch.device(device)
+        if self.F.device == device:
+            return self.F
+        cached = getattr(self, "_F_device", None)
+        if cached is None or cached.device != device:
+            self._F_device = cached = self.F.to(device)
+        return cached
+
+    def crop_basis(self, crop, device):
+        """Return the rows of the basis (on `device`) for the pixels that remain after
+        removing a border of `crop` pixels."""
+        if crop == 0:
+            return self.basis(device)
+        key = (crop, str(torch.device(device)))
+        cache = self.__dict__.setdefault("_crop_bases", {})
+        if key not in cache:
+            F_ = self.F.reshape(self.H, self.W, -1)[crop:-crop, crop:-crop]
+            cache[key] = F_.reshape(-1, self.F.shape[1]).to(device)
+        return cache[key]
+
+    def crop_pixels(self, crop, device):
+        """The unnormalized pixel grid of the region retained after cropping."""
+        pixels = self.grid_pixels_unnormalized[:, crop:self.H - crop, crop:self.W - crop]
+        return pixels.to(device)
+
+    def warp_keypoints(self, keypoints, weights):
+        return tps_warp_keypoints(keypoints, weights, self.grid_ctrlpts, self.H, self.W)
 
 
 class WarperSingle(object):
     returns_pairs = False
 
     def __init__(self, H, W, warpsd_all=0.0005, warpsd_subset=0.0, transsd=0.02,
-                 scalesd=0.02, rotsd=2):
+                 scalesd=0.02, rotsd=2, warp_bank=None, bank_size=2000):
         self.H = H
         self.W = W
         self.warpsd_all = warpsd_all
@@ -195,6 +530,11 @@ class WarperSingle(object):
         self.U_pixels_ctrlpts = tps_U(self.grid_pixels, self.grid_ctrlpts)
         self.F = torch.cat((self.U_pixels_ctrlpts, torch.ones(self.npixels, 1), self.grid_pixels), 1)
 
+        self.bank = None
+        if warp_bank is not None:
+            families = {"warp1": (warpsd_all, warpsd_subset)}
+            self.bank = WarpBank(warp_bank, self.F, H, W, families, size=bank_size)
+
     def __call__(self, im1, keypts=None, crop=0):
         kp1 = 0
 
@@ -205,20 +545,13 @@ class WarperSingle(object):
 
         assert im1.shape[0] == 1
 
-        a = 1
-        weights1 = random_tps_weights(self.nctrlpts, a * self.warpsd_all, a * self.warpsd_subset, a * self.transsd,
-                                      a * self.scalesd, a * self.rotsd)
-
-        grid1 = torch.matmul(self.F, weights1).reshape(1, self.H, self.W, 2)
-        grid1_unnormalized = grid_unnormalize(grid1, self.H, self.W)
+        grid1, weights1 = self.sample_warps(1, im1.device, crop)
+        weights1 = weights1[0]
         if keypts is not None:
-            kp1 = self.warp_keypoints(keypts, grid1_unnormalized)
+            kp1 = self.warp_keypoints(keypts, weights1)
 
         im1 = F.grid_sample(im1, grid1)
 
-        if crop != 0:
-            im1 = im1[:, :, crop:-crop, crop:-crop]
-
         if unsqueezed:
             im1 = im1.squeeze(0)
 
@@ -229,11 +562,90 @@ class WarperSingle(object):
         # and we want to be consistent with optical flow from videos
         return im1, kp1
 
-    def warp_keypoints(self, keypoints, grid_unnormalized):
-        from scipy.spatial.kdtree import KDTree
-        warp_grid = grid_unnormalized.reshape(-1, 2)
-        regular_grid = self.grid_pixels_unnormalized.reshape(-1, 2)
-        kd = KDTree(warp_grid)
-        dists, idxs = kd.query(keypoints)
-        new_keypoints = regular_grid[idxs]
-        return new_keypoints
+    def warp_batch(self, ims, keypts=None, crop=0):
+        """Batched counterpart of `__call__` (see `Warper.warp_batch`)."""
+        grid1, weights1 = self.sample_warps(ims.shape[0], ims.device, crop)
+        im1 = F.grid_sample(ims, grid1)
+
+        kp1 = 0
+        if keypts is not None:
+            kp1 = self.warp_keypoints(keypts.cpu(), weights1)
+            if crop != 0:
+                kp1 -= crop
+        return im1, kp1
+
+    def sample_warps(self, B, device, crop=0):
+        """Sample `B` warps, returning their grids (only evaluated for the pixels that
+        remain after removing a border of `crop` pixels) and their
+        B x (nctrlpts + 3) x 2 weights."""
+        if self.bank is not None:
+            grids, weights = self.bank.sample("warp1", B, self.transsd, self.scalesd,
+                                              self.rotsd)
+            grids = grids[:, crop:self.H - crop, crop:self.W - crop]
+            return grids.to(device), weights
+        return random_tps_warps(self.crop_basis(crop, device), B, self.H - 2 * crop,
+                                self.W - 2 * crop, self.warpsd_all, self.warpsd_subset,
+                                self.transsd, self.scalesd, self.rotsd)
+
+    basis = Warper.basis
+    crop_basis = Warper.crop_basis
+    warp_keypoints = Warper.warp_keypoints
+
+
+def warp_keypoints_check(H=100, W=100, num_kpts=68, trials=20):
+    """Compare the analytic keypoint warping against a nearest-neighbour search over
+    the dense warp grid (which is accurate to within half a pixel)."""
+    warper = Warper(H, W)
+    worst = 0.
+    for _ in range(trials):
+        weights = random_tps_weights(warper.nctrlpts, warper.warpsd_all,
+                                     warper.warpsd_subset, warper.transsd,
+                                     warper.scalesd, warper.rotsd)
+        grid_u = grid_unnormalize(torch.matmul(warper.F, weights), H, W)
+        # keep away from the borders, where the nearest neighbour search is clamped
+        kp = torch.rand(num_kpts, 2) * torch.tensor([W / 2., H / 2.]) \
+            + torch.tensor([W / 4., H / 4.])
+        ref = warp_keypoints_nearest(kp, grid_u, warper.grid_pixels_unnormalized)
+        kp_warped = warper.warp_keypoints(kp, weights)
+        worst = max(worst, (kp_warped - ref).abs().max().item())
+    print("max abs diff against nearest neighbour search: {:.3f}px".format(worst))
+    assert worst <= 1., "analytic keypoint warping disagrees with the dense grid"
+
+
+def crop_parity_check(H=100, W=100, crop=15, num_kpts=5, seed=0):
+    """Compare the crop-aware `Warper` against warping the full image and cropping
+    the results afterwards."""
+    warper = Warper(H, W)
+    im = torch.rand(3, H, W) * 255
+    kp = torch.rand(num_kpts, 2) * torch.tensor([W / 2., H / 2.]) \
+        + torch.tensor([W / 4., H / 4.])
+    torch.manual_seed(seed)
+    out = warper(im, keypts=kp, crop=crop)
+
+    torch.manual_seed(seed)
+    weights = random_tps_weights_batch(2, warper.nctrlpts, *warper.pair_hyperparams(1))
+    grid1, grid2 = tps_grids(warper.F, weights, H, W)
+    weights1, weights2 = batch_weights(weights)
+    im1 = F.grid_sample(im[None], grid1[None])
+    im2 = F.grid_sample(im1, grid2[None])
+    grid_u = grid_unnormalize(grid2[None], H, W)
+    flow = grid_u - warper.grid_pixels_unnormalized
+    kp1 = warper.warp_keypoints(kp, weights1)
+    kp2 = warper.warp_keypoints(kp1, weights2)
+    region = (slice(crop, H - crop), slice(crop, W - crop))
+    ref = (im2[0][(slice(None),) + region], im1[0][(slice(None),) + region],
+           flow[(slice(None),) + region],
+           grid_normalize(grid_u[(slice(None),) + region] - crop, H - 2 * crop,
+                          W - 2 * crop),
+           kp2 - crop, kp1 - crop)
+    names = ("im2", "im1", "flow", "grid", "kp2", "kp1")
+    for name, x, y in zip(names, out, ref):
+        assert x.shape == y.shape, "{}: {} vs {}".format(name, x.shape, y.shape)
+        diff = (x - y).abs().max().item()
+        print("{}: max abs diff {:.2e}".format(name, diff))
+        assert diff < 1e-2, "crop-aware warping disagrees on {}".format(name)
+
+
+if __name__ == "__main__":
+    warp_keypoints_check()
+    crop_parity_check()
@@ -142,6 +142,14 @@ def write_json(content, fname):
         json.dump(content, handle, indent=4, sort_keys=False)
 
 
+def decode_name(name):
+    """Return a filename as a str, decoding the (utf-8) byte strings that are used
+    to store the filenames of the datasets compactly."""
+    if isinstance(name, bytes):
+        return name.decode()
+    return str(name)
+
+
 def pad_and_crop(im, rr):
     """Return im[rr[0]:rr[1],rr[2]:rr[3]]
 
@@ -0,0 +1,155 @@
+"""Record the minibatches of a deterministic validation pass and replay them later.
+
+The validation warps and augmentations are seeded identically before every pass, so
+decoding, warping and transforming the validation set produces the same minibatches
+each epoch.  A `BatchCache` materialises them on the first complete pass, either in
+RAM or in a memory-mapped file (which can be shared between runs), and replays them in
+later epochs.  The cache is keyed by a checksum of the configuration that produced
+the batches, so that stale files on disk are rebuilt.
+"""
+import os
+import json
+import numpy as np
+import torch
+from pathlib import Path
+from collections import namedtuple
+
+VAL_CACHE_VERSION = 1
+INDEX_NAME = "index.json"
+VALUES_NAME = "values.bin"
+
+# tensors are stored as numpy arrays, together with the device they came from
+StoredTensor = namedtuple("StoredTensor", ["array", "device"])
+
+
+def flatten(batch, prefix=()):
+    """Return the (key path, value) pairs of a (nested) dict minibatch."""
+    items = []
+    for key, val in batch.items():
+        if isinstance(val, dict):
+            items.extend(flatten(val, prefix + (key,)))
+        else:
+            items.append((prefix + (key,), val))
+    return items
+
+
+def unflatten(items):
+    batch = {}
+    for path, val in items:
+        node = batch
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = val
+    return batch
+
+
+class BatchCache(object):
+    """Store minibatches in RAM (`mode="ram"`) or on disk (`mode="mmap"`).
+
+    Args:
+        checksum (str): identifies the configuration that produced the batches.
+        mode (str :: "ram"): where the batches are stored.
+        cache_dir (str): the parent directory of the memory-mapped caches (only used
+            when `mode="mmap"`).
+    """
+
+    def __init__(self, checksum, mode="ram", cache_dir=None):
+        assert mode in {"ram", "mmap"}, "unknown validation cache mode {}".format(mode)
+        self.checksum = checksum
+        self.mode = mode
+        self.batches = None
+        if mode == "mmap":
+            assert cache_dir is not None, "a cache_dir is required for mmap caches"
+            self.cache_dir = Path(cache_dir) / checksum
+            self.load_index()
+
+    @property
+    def ready(self):
+        return self.batches is not None
+
+    def load_index(self):
+        index_path = self.cache_dir / INDEX_NAME
+        if not index_path.exists():
+            return
+        with open(str(index_path), "r") as f:
+            index = json.load(f)
+        if index["version"] != VAL_CACHE_VERSION or index["checksum"] != self.checksum:
+            return
+        values = np.memmap(str(self.cache_dir / VALUES_NAME), dtype=np.uint8, mode="r")
+        self.batches = []
+        for entries in index["batches"]:
+            items = []
+            for entry in entries:
+                path = tuple(entry["path"])
+                if "value" in entry:
+                    items.append((path, entry["value"]))
+                    continue
+                dtype = np.dtype(entry["dtype"])
+                count = int(np.prod(entry["shape"]))
+                start = entry["offset"]
+                view = values[start:start + count * dtype.itemsize].view(dtype)
+                items.append((path, StoredTensor(view.reshape(entry["shape"]),
+                                                 entry["device"])))
+            self.batches.append(items)
+
+    def replay(self):
+        for items in self.batches:
+            restored = []
+            for path, val in items:
+                if isinstance(val, StoredTensor):
+                    val = torch.from_numpy(np.array(val.array)).to(val.device)
+                restored.append((path, val))
+            yield unflatten(restored)
+
+    def record(self, batches):
+        """Pass through `batches`, keeping them if the pass runs to completion."""
+        recorded = []
+        for batch in batches:
+            items = []
+            for path, val in flatten(batch):
+                if torch.is_tensor(val):
+                    # copied, since numpy() shares memory with (CPU) tensors that the
+                    # consumer of the first pass may modify in place
+                    val = StoredTensor(val.detach().cpu().numpy().copy(), str(val.device))
+                items.append((path, val))
+            recorded.append(items)
+            yield batch
+        self.commit(recorded)
+
+    def commit(self, recorded):
+        if self.mode == "ram":
+            self.batches = recorded
+            return
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        tmp_suffix = ".tmp-{}".format(os.getpid())
+        values_path = self.cache_dir / VALUES_NAME
+        offset, index = 0, []
+        with open(str(values_path) + tmp_suffix, "wb") as f:
+            for items in recorded:
+                entries = []
+                for path, val in items:
+                    if not isinstance(val, StoredTensor):
+                        # e.g. lists of image paths, which must be json serialisable
+                        entries.append({"path": list(path), "value": val})
+                        continue
+                    array = np.ascontiguousarray(val.array)
+                    entries.append({
+                        "path": list(path),
+                        "dtype": array.dtype.str,
+                        "shape": list(array.shape),
+                        "offset": offset,
+                        "device": val.device,
+                    })
+                    f.write(array.tobytes())
+                    offset += array.nbytes
+                index.append(entries)
+        os.replace(str(values_path) + tmp_suffix, str(values_path))
+        index = {"version": VAL_CACHE_VERSION, "checksum": self.checksum,
+                 "batches": index}
+        with open(str(self.cache_dir / INDEX_NAME) + tmp_suffix, "w") as f:
+            json.dump(index, f)
+        os.replace(str(self.cache_dir / INDEX_NAME) + tmp_suffix,
+                   str(self.cache_dir / INDEX_NAME))
+        print("cached {} validation batches ({:.1f} MiB) to {}".format(
+            len(recorded), offset / 2 ** 20, self.cache_dir))
+        self.load_index()